@@ -0,0 +1,274 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Local stand-in for memcached, for load tests in a lab.
+
+This is a small in-memory server speaking the memcached text protocol, so
+that the memcached storage backend (and the tabs collection) can be load
+tested without a memcached install.  It is not meant to be fast, nor to
+evict anything: just to answer correctly.
+
+Run it like so::
+
+  python fakememcached.py --port 11211
+
+It supports get, gets, set, add, replace, append, prepend, cas, delete,
+incr, decr, touch, flush_all, version and quit.
+"""
+import sys
+import time
+import optparse
+import threading
+import SocketServer
+
+_MAX_RELATIVE_EXPTIME = 60 * 60 * 24 * 30
+
+
+class Store(object):
+    """The items, as a dict of key -> (flags, exptime, cas, value)."""
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+        self._cas = 0
+
+    def next_cas(self):
+        self._cas += 1
+        return self._cas
+
+    def get(self, key):
+        # must be called with the lock held
+        item = self.items.get(key)
+        if item is not None and item[1] and item[1] <= time.time():
+            del self.items[key]
+            return None
+        return item
+
+
+def _exptime(exptime):
+    exptime = int(exptime)
+    if exptime == 0:
+        return 0
+    if exptime <= _MAX_RELATIVE_EXPTIME:
+        return time.time() + exptime
+    return exptime
+
+
+class MemcachedHandler(SocketServer.StreamRequestHandler):
+    """Handles the commands of a client connection."""
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            parts = line.split()
+            if not parts:
+                self.wfile.write('ERROR\r\n')
+                continue
+            command = getattr(self, 'do_' + parts[0].lower(), None)
+            if command is None:
+                self.wfile.write('ERROR\r\n')
+                continue
+            try:
+                if command(*parts[1:]) is False:
+                    break
+            except (TypeError, ValueError), e:
+                self.wfile.write('CLIENT_ERROR %s\r\n' % e)
+            self.wfile.flush()
+
+    @property
+    def store(self):
+        return self.server.store
+
+    def _reply(self, noreply, message):
+        if noreply != 'noreply':
+            self.wfile.write(message + '\r\n')
+
+    def _read_data(self, size):
+        data = self.rfile.read(int(size) + 2)
+        if not data.endswith('\r\n'):
+            raise ValueError('bad data chunk')
+        return data[:-2]
+
+    def _retrieve(self, keys, with_cas):
+        store = self.store
+        with store.lock:
+            items = [(key, store.get(key)) for key in keys]
+        for key, item in items:
+            if item is None:
+                continue
+            flags, exptime, cas, value = item
+            if with_cas:
+                self.wfile.write('VALUE %s %d %d %d\r\n' % (key, flags,
+                                                           len(value), cas))
+            else:
+                self.wfile.write('VALUE %s %d %d\r\n' % (key, flags,
+                                                        len(value)))
+            self.wfile.write(value + '\r\n')
+        self.wfile.write('END\r\n')
+
+    def do_get(self, *keys):
+        self._retrieve(keys, False)
+
+    def do_gets(self, *keys):
+        self._retrieve(keys, True)
+
+    def _store(self, mode, key, flags, exptime, size, *args):
+        cas_unique = None
+        if mode == 'cas':
+            cas_unique, args = int(args[0]), args[1:]
+        noreply = args[0] if args else None
+        value = self._read_data(size)
+        store = self.store
+        with store.lock:
+            item = store.get(key)
+            if mode == 'add' and item is not None:
+                return self._reply(noreply, 'NOT_STORED')
+            if mode in ('replace', 'append', 'prepend') and item is None:
+                return self._reply(noreply, 'NOT_STORED')
+            if mode == 'cas':
+                if item is None:
+                    return self._reply(noreply, 'NOT_FOUND')
+                if item[2] != cas_unique:
+                    return self._reply(noreply, 'EXISTS')
+            if mode == 'append':
+                flags, exptime, value = item[0], item[1], item[3] + value
+            elif mode == 'prepend':
+                flags, exptime, value = item[0], item[1], value + item[3]
+            else:
+                flags, exptime = int(flags), _exptime(exptime)
+            store.items[key] = flags, exptime, store.next_cas(), value
+        self._reply(noreply, 'STORED')
+
+    def do_set(self, *args):
+        self._store('set', *args)
+
+    def do_add(self, *args):
+        self._store('add', *args)
+
+    def do_replace(self, *args):
+        self._store('replace', *args)
+
+    def do_append(self, *args):
+        self._store('append', *args)
+
+    def do_prepend(self, *args):
+        self._store('prepend', *args)
+
+    def do_cas(self, *args):
+        self._store('cas', *args)
+
+    def do_delete(self, key, *args):
+        noreply = args[-1] if args else None
+        store = self.store
+        with store.lock:
+            if store.get(key) is None:
+                return self._reply(noreply, 'NOT_FOUND')
+            del store.items[key]
+        self._reply(noreply, 'DELETED')
+
+    def _incr(self, key, delta, noreply, sign):
+        store = self.store
+        with store.lock:
+            item = store.get(key)
+            if item is None:
+                return self._reply(noreply, 'NOT_FOUND')
+            flags, exptime, cas, value = item
+            if not value.isdigit():
+                return self._reply(noreply, 'CLIENT_ERROR cannot increment '
+                                            'or decrement non-numeric value')
+            value = max(int(value) + sign * int(delta), 0) % 2 ** 64
+            store.items[key] = flags, exptime, store.next_cas(), str(value)
+        self._reply(noreply, str(value))
+
+    def do_incr(self, key, delta, noreply=None):
+        self._incr(key, delta, noreply, 1)
+
+    def do_decr(self, key, delta, noreply=None):
+        self._incr(key, delta, noreply, -1)
+
+    def do_touch(self, key, exptime, noreply=None):
+        store = self.store
+        with store.lock:
+            item = store.get(key)
+            if item is None:
+                return self._reply(noreply, 'NOT_FOUND')
+            store.items[key] = item[:1] + (_exptime(exptime),) + item[2:]
+        self._reply(noreply, 'TOUCHED')
+
+    def do_flush_all(self, *args):
+        noreply = args[-1] if args else None
+        store = self.store
+        with store.lock:
+            store.items.clear()
+        self._reply(noreply, 'OK')
+
+    def do_version(self):
+        self.wfile.write('VERSION fakememcached\r\n')
+
+    def do_quit(self):
+        return False
+
+
+class MemcachedServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        SocketServer.TCPServer.__init__(self, address, MemcachedHandler)
+        self.store = Store()
+
+
+def main(args=None):
+    """Main entry-point for running this script."""
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("", "--host", default="127.0.0.1",
+                      help="Address to listen on")
+    parser.add_option("", "--port", type="int", default=11211,
+                      help="Port to listen on")
+    opts, args = parser.parse_args(args)
+
+    server = MemcachedServer((opts.host, opts.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -35,19 +35,25 @@
 # ***** END LICENSE BLOCK *****
 """
 Load test for the Storage server
+
+By default this hits the stage cluster with the workload described below.
+Set the STRESS_PROFILE environment variable to the path of a profile file
+(see the profiles directory) to use another workload, or to target a local
+server; STRESS_SERVER_URL overrides the server picked by the profile.
 """
 import os
 import base64
 import random
 import time
+from ConfigParser import RawConfigParser
 
 from loads import TestCase
 VERSION = '1.1'
 
 # The collections to operate on.
 # Each operation will randomly select a collection from this list.
-# The "tabs" collection is not included since it uses memcache; we need
-# to figure out a way to test it without overloading the server.
+# The "tabs" collection is not included since it uses memcache; it is
+# exercised separately, when the profile enables tabs traffic.
 collections = ['bookmarks', 'forms', 'passwords', 'history', 'prefs']
 
 # The distribution of GET operations to meta/global per test run.
@@ -66,11 +72,97 @@ post_count_distribution = [67, 18, 9, 4, 2]
 # 99% will do 0 DELETEs, 1% will do 1 DELETE, etc...
 delete_count_distribution = [99, 1, 0, 0, 0]
 
+# The distribution of tabs syncs (a GET then a POST of the client record)
+# per test run.  Empty by default, so the stage memcaches are spared.
+tabs_count_distribution = []
+
 # The probability that we'll try to do a full DELETE of all data.
 # Expressed as a float between 0 and 1.
 deleteall_probability = 1 / 100.
 
 
+class Workload(object):
+    """The knobs of a stress test run.
+
+    The defaults are the module-level settings above; a profile file may
+    override any of them in its [workload] section, and pick the target
+    in its [server] section.
+    """
+
+    _DISTRIBUTIONS = ('metaglobal_count_distribution',
+                      'get_count_distribution',
+                      'post_count_distribution',
+                      'delete_count_distribution',
+                      'tabs_count_distribution')
+
+    def __init__(self):
+        self.server_url = None
+        self.collections = list(collections)
+        for name in self._DISTRIBUTIONS:
+            setattr(self, name, list(globals()[name]))
+        self.deleteall_probability = deleteall_probability
+        self.items_per_batch = 10
+        # The payloads are the username, repeated a random number of
+        # times between these two.
+        self.payload_repeat_min = 50
+        self.payload_repeat_max = 200
+        self.tabs_payload_size = 1000
+        self.users = 1000000
+        # A few "large" users get a share of the sessions and bigger
+        # payloads, like the heavy users of a real cluster.
+        self.large_users = 0
+        self.large_user_probability = 0.
+        self.large_user_payload_factor = 10
+
+    @classmethod
+    def from_file(cls, path):
+        workload = cls()
+        config = RawConfigParser()
+        if not config.read(path):
+            raise ValueError("Cannot read profile %r" % path)
+
+        if config.has_option('server', 'url'):
+            workload.server_url = config.get('server', 'url')
+
+        if not config.has_section('workload'):
+            return workload
+        for name, value in config.items('workload'):
+            if name == 'collections':
+                value = [col.strip() for col in value.split(',')
+                         if col.strip()]
+            elif name in cls._DISTRIBUTIONS:
+                value = [int(weight) for weight in value.split(',')
+                         if weight.strip()]
+            elif name in ('deleteall_probability',
+                          'large_user_probability'):
+                value = float(value)
+            elif hasattr(workload, name) and name != 'server_url':
+                value = int(value)
+            else:
+                raise ValueError("Unknown workload option %r" % name)
+            setattr(workload, name, value)
+        if not workload.payload_repeat_min <= workload.payload_repeat_max:
+            raise ValueError("payload_repeat_min must not exceed "
+                             "payload_repeat_max")
+        return workload
+
+
+def load_workload():
+    """Returns the workload for this run, as set in the environment."""
+    profile = os.environ.get('STRESS_PROFILE')
+    if profile:
+        workload = Workload.from_file(profile)
+    else:
+        workload = Workload()
+    server_url = os.environ.get('STRESS_SERVER_URL')
+    if server_url:
+        workload.server_url = server_url
+    return workload
+
+
+workload = load_workload()
+
+
 class StressTest(TestCase):
 
     def __init__(self, *args, **kwds):
@@ -81,15 +173,17 @@ class StressTest(TestCase):
         self.session.auth = (username, password)
 
     def test_storage_session(self):
-        username = self._pick_user()
+        username, large = self._pick_user()
         self.set_auth(username)
+        payload_factor = large and workload.large_user_payload_factor or 1
 
         # Always GET /username/info/collections
         url = "/%s/%s/info/collections" % (VERSION, username)
         response = self.app.get(url, status=[200, 404])
 
         # GET requests to meta/global.
-        num_requests = self._pick_weighted_count(metaglobal_count_distribution)
+        num_requests = self._pick_weighted_count(
+            workload.metaglobal_count_distribution)
         for x in range(num_requests):
             url = "/%s/%s/storage/meta/global" % (VERSION, username)
             response = self.app.get(url, status=[200, 404])
@@ -101,25 +195,29 @@ class StressTest(TestCase):
                                   {"id": "global", "payload": metapayload})
 
         # GET requests to individual collections.
-        num_requests = self._pick_weighted_count(get_count_distribution)
-        cols = random.sample(collections, num_requests)
+        num_requests = self._pick_weighted_count(
+            workload.get_count_distribution)
+        cols = random.sample(workload.collections, num_requests)
         for x in range(num_requests):
             url = "/%s/%s/storage/%s" % (VERSION, username, cols[x])
             newer = int(time.time() - random.randint(3600, 360000))
             response = self.app.get(url, {"full": "1", "newer": str(newer)},
                                     status=[200, 404])
 
-        # PUT requests with 10 WBOs batched together
-        num_requests = self._pick_weighted_count(post_count_distribution)
-        cols = random.sample(collections, num_requests)
+        # POST requests with several WBOs batched together
+        num_requests = self._pick_weighted_count(
+            workload.post_count_distribution)
+        cols = random.sample(workload.collections, num_requests)
         for x in range(num_requests):
             url = "/%s/%s/storage/%s" % (VERSION, username, cols[x])
-            items_per_batch = 10
+            items_per_batch = workload.items_per_batch
             wbos = []
             for i in range(items_per_batch):
                 id = base64.b64encode(os.urandom(10))
                 id += str(time.time() % 100)
-                payload = username * random.randint(50, 200)
+                repeat = random.randint(workload.payload_repeat_min,
+                                        workload.payload_repeat_max)
+                payload = username * (repeat * payload_factor)
                 wbos.append({'id': id, 'payload': payload})
 
             response = self.app.post_json(url, wbos)
@@ -129,21 +227,39 @@ class StressTest(TestCase):
             self.assertEquals(len(result["success"]), items_per_batch)
             self.assertEquals(len(result["failed"]), 0)
 
+        # Tabs syncs: read the tabs of the other clients, then write ours.
+        # The tabs live in memcached only, with the memcached backend.
+        num_requests = self._pick_weighted_count(
+            workload.tabs_count_distribution)
+        url = "/%s/%s/storage/tabs" % (VERSION, username)
+        for x in range(num_requests):
+            self.app.get(url, {"full": "1"}, status=[200, 404])
+            client_id = "client%i" % random.randint(1, 3)
+            payload = "t" * (workload.tabs_payload_size * payload_factor)
+            response = self.app.post_json(url, [{'id': client_id,
+                                                 'payload': payload}])
+            self.assertEquals(len(response.json["success"]), 1)
+
         # DELETE requests.
         # We might choose to delete some individual collections, or to do
         # a full reset and delete all the data.  Never both in the same run.
-        num_requests = self._pick_weighted_count(delete_count_distribution)
+        num_requests = self._pick_weighted_count(
+            workload.delete_count_distribution)
         if num_requests:
-            cols = random.sample(collections, num_requests)
+            cols = random.sample(workload.collections, num_requests)
             for x in range(num_requests):
                 url = "/%s/%s/storage/%s" % (VERSION, username, cols[x])
                 self.app.delete(url)
         else:
-            if random.random() <= deleteall_probability:
+            if random.random() <= workload.deleteall_probability:
                 url = "/%s/%s/storage" % (VERSION, username)
-                self.app.delete(url, headers={"X-Confirm-Delete", "true"})
+                self.app.delete(url, headers={"X-Confirm-Delete": "true"})
 
     def _pick_node(self):
+        # The profile or the environment may name the server to use.
+        if getattr(self, 'server_url', None) is None:
+            self.server_url = workload.server_url
+
         # If we have not been told a specific server node,
         # randomly pick one of the stage server URLs.
         if getattr(self, 'server_url', None) is None:
@@ -161,10 +277,16 @@ class StressTest(TestCase):
             self.server_url = uri
 
     def _pick_user(self):
-        user = "cuser%i" % random.randint(1, 1000000)
-        return user
+        """Returns a username, and whether it is one of the large users."""
+        large_users = min(workload.large_users, workload.users)
+        if large_users and random.random() < workload.large_user_probability:
+            return "cuser%i" % random.randint(1, large_users), True
+        user = random.randint(1, workload.users)
+        return "cuser%i" % user, user <= large_users
 
     def _pick_weighted_count(self, weights):
+        if not sum(weights):
+            return 0
         i = random.randint(1, sum(weights))
         count = 0
         base = 0
@@ -49,6 +49,9 @@ main = syncstorage.wsgiapp:make_app
 
 [paste.app_install]
 main = paste.script.appinstall:Installer
+
+[paste.filter_app_factory]
+profiler = syncstorage.profiler:make_filter
 """
 
 # extracting the version number from the .spec file
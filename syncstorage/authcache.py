@@ -0,0 +1,156 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Cache of the successful authentications.
+
+Each request is authenticated against the auth backend, which costs a
+users table lookup and a password hash check, even when the same client
+sends many requests in a row.  CachingAuthBackend wraps the backend and
+remembers, for a few seconds, which credentials were accepted for a user
+and the user id they gave.
+
+Only a keyed digest of the credentials is kept, so new credentials always
+go to the backend.  The entry of a user is dropped when the backend
+rejects the user or doesn't know it, and when the user is deleted or
+changes password through the wrapper.  The ttl is capped at MAX_TTL
+seconds.
+"""
+import os
+import hmac
+from hashlib import sha256
+
+from metlog.holder import CLIENT_HOLDER
+
+from syncstorage.storage.localcachedsql import LRUCache
+
+# the methods of the backend that invalidate the entry of their user.
+_INVALIDATING = ('delete_user', 'update_password', 'admin_update_password')
+
+# the methods of the backend that return None for an unknown user.
+_LOOKUPS = ('get_user_id',)
+
+# the longest time an authentication is cached, in seconds.
+MAX_TTL = 60
+
+
+def _username(user):
+    if isinstance(user, basestring):
+        return user
+    return user['username']
+
+
+class CachingAuthBackend(object):
+    """Wraps an auth backend to cache its successful authentications.
+
+    Everything but authenticate_user() and the invalidating methods is
+    passed through to the backend.
+
+    Password changes and account deletions are usually done by another
+    service, and are not seen here.  Until then, the old password of a
+    user keeps working for up to ttl seconds, and so does the account of
+    a deleted user.  The window closes as soon as the new password is
+    used, as it replaces the cached entry, or as soon as the backend
+    rejects one of the user's requests.
+    """
+
+    def __init__(self, backend, ttl=60, max_size=10000):
+        self.backend = backend
+        self._cache = LRUCache(max_size=max_size,
+                               ttl=min(float(ttl), MAX_TTL))
+        self._secret = os.urandom(32)
+
+    @property
+    def logger(self):
+        return CLIENT_HOLDER.default_client
+
+    def __getattr__(self, name):
+        attr = getattr(self.backend, name)
+        if name in _INVALIDATING and callable(attr):
+            def _invalidating(user, *args, **kw):
+                try:
+                    return attr(user, *args, **kw)
+                finally:
+                    self.invalidate(user)
+            return _invalidating
+        if name in _LOOKUPS and callable(attr):
+            def _lookup(user, *args, **kw):
+                res = attr(user, *args, **kw)
+                if res is None:
+                    self.invalidate(user)
+                return res
+            return _lookup
+        return attr
+
+    def _digest(self, credentials):
+        return hmac.new(self._secret, credentials, sha256).digest()
+
+    def invalidate(self, user):
+        """Drops the cached authentication of the user."""
+        self._cache.delete(_username(user))
+
+    def authenticate_user(self, user, credentials, *args, **kw):
+        """Authenticates the user, using the cache if possible.
+
+        Returns the user id, or None if the credentials are wrong.
+        """
+        username = _username(user)
+        if isinstance(credentials, unicode):
+            credentials = credentials.encode('utf8')
+        digest = self._digest(credentials)
+        # the extra arguments, e.g. the attributes to load, must match too.
+        call = repr((args, sorted(kw.items())))
+
+        cached = self._cache.get(username)
+        if cached is not None and cached[:2] == (digest, call):
+            self.logger.incr('syncstorage.authcache.hit')
+            digest, call, user_id, attrs = cached
+            if attrs is not None:
+                user.update(attrs)
+            return user_id
+
+        self.logger.incr('syncstorage.authcache.miss')
+        user_id = self.backend.authenticate_user(user, credentials, *args,
+                                                 **kw)
+        if user_id is None:
+            # the user was deleted, or its password was changed.
+            self.invalidate(username)
+        else:
+            # the backend may fill the user object with attributes.
+            attrs = None
+            if not isinstance(user, basestring):
+                attrs = dict(user)
+            self._cache.set(username, (digest, call, user_id, attrs))
+        return user_id
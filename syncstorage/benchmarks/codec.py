@@ -0,0 +1,155 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Micro-benchmark of the serializers available for memcached values.
+
+Compares the encoding time, decoding time and size of pickle, JSON and the
+compact codec on values shaped like the ones MemcachedSQLStorage caches:
+the tabs of a user, the meta/global WBO and the collection stamps.
+
+Run it with::
+
+  python -m syncstorage.benchmarks.codec
+
+"""
+import os
+import sys
+import base64
+import random
+import cPickle
+import optparse
+from decimal import Decimal
+
+import simplejson as json
+
+from syncstorage.storage import codec
+from syncstorage.benchmarks import measure
+
+
+def _payload(size):
+    """Returns an encrypted-looking WBO payload of about size bytes."""
+    ciphertext = base64.b64encode(os.urandom(size * 3 / 4))
+    return json.dumps({'ciphertext': ciphertext,
+                       'IV': base64.b64encode(os.urandom(16)),
+                       'hmac': os.urandom(32).encode('hex')})
+
+
+def _stamp():
+    return Decimal('%.2f' % (1350000000 + random.random() * 1000000))
+
+
+def get_values():
+    """Returns a dict of realistic values to encode, keyed by name."""
+    random.seed(42)
+
+    tabs = {}
+    for num in range(5):
+        tab_id = base64.b64encode(os.urandom(9))
+        tabs[tab_id] = {'id': tab_id, 'modified': _stamp(),
+                        'payload': _payload(random.randint(1000, 8000))}
+
+    meta_global = {'id': u'global', 'username': 12345, 'collection': 6,
+                   'modified': _stamp(), 'sortindex': None,
+                   'payload': _payload(250), 'payload_size': 340,
+                   'ttl': 2100000000}
+
+    stamps = dict((name, _stamp()) for name in
+                  (u'clients', u'crypto', u'forms', u'history', u'keys',
+                   u'meta', u'bookmarks', u'prefs', u'tabs', u'passwords',
+                   u'addons'))
+
+    return {'tabs': tabs, 'meta/global': meta_global, 'stamps': stamps}
+
+
+def get_serializers(compress_threshold=1024):
+    """Returns a list of (name, dumps, loads) tuples."""
+    def json_dumps(value):
+        return json.dumps(value, use_decimal=True)
+
+    def json_loads(data):
+        return json.loads(data, use_decimal=True)
+
+    def pickle_dumps(value):
+        return cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+
+    def compact_dumps(value):
+        return codec.encode(value)
+
+    def compact_zlib_dumps(value):
+        return codec.encode(value, compress_threshold)
+
+    return [('pickle', pickle_dumps, cPickle.loads),
+            ('json', json_dumps, json_loads),
+            ('compact', compact_dumps, codec.decode),
+            ('compact+zlib', compact_zlib_dumps, codec.decode)]
+
+
+def run(number=1000):
+    """Runs the benchmark and returns a list of result dicts."""
+    results = []
+    values = get_values()
+    for value_name in sorted(values):
+        value = values[value_name]
+        for name, dumps, loads in get_serializers():
+            data = dumps(value)
+            results.append({
+                'value': value_name,
+                'serializer': name,
+                'size': len(data),
+                'encode': measure(lambda: dumps(value), number),
+                'decode': measure(lambda: loads(data), number),
+            })
+    return results
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--number", type="int", default=1000,
+                      help="Number of calls per measure")
+    opts, args = parser.parse_args(args)
+
+    line = '%-12s %-14s %8s %12s %12s'
+    print line % ('value', 'serializer', 'bytes', 'encode (us)',
+                  'decode (us)')
+    for res in run(opts.number):
+        print line % (res['value'], res['serializer'], res['size'],
+                      '%.1f' % (res['encode'] * 1000000),
+                      '%.1f' % (res['decode'] * 1000000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,140 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Benchmark of the fast path for info/collections and meta/global.
+
+This sends the same requests to the app with and without the
+"storage.fast_path" option, and reports the CPU time per request.
+Authentication is stubbed out in both cases.
+
+Run it like so::
+
+  python -m syncstorage.benchmarks.fastpath --requests 2000
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+
+from webob import Request
+
+from syncstorage import wsgiapp
+
+_PATHS = ('/1.0/bench/info/collections', '/1.0/bench/storage/meta/global')
+
+
+class _FakeAuth(object):
+    """Authenticates every request as the same user."""
+
+    def check(self, request, match):
+        request.user = {'userid': 1, 'username': match.get('username')}
+
+
+def make_app(sqluri):
+    """Returns an app with some data for the benchmark user."""
+    config = {
+        'storage.backend': 'syncstorage.storage.sql.SQLStorage',
+        'storage.sqluri': sqluri,
+        'storage.create_tables': True,
+        'auth.backend': 'services.auth.dummy.DummyAuth',
+    }
+    app = wsgiapp.make_app(config).app
+    app.auth = _FakeAuth()
+    storage = app.storages['default']
+    storage.set_item(1, 'meta', 'global', payload='x' * 200)
+    for name in ('bookmarks', 'history', 'tabs', 'clients', 'crypto'):
+        storage.set_item(1, name, 'item', payload='x' * 200)
+    return app
+
+
+def run(app, requests):
+    """Returns the average CPU time per request, in seconds."""
+    environs = [Request.blank(path).environ for path in _PATHS]
+
+    def start_response(status, headers, exc_info=None):
+        if not status.startswith('200'):
+            raise ValueError(status)
+
+    start = time.clock()
+    for i in xrange(requests):
+        for environ in environs:
+            for chunk in app(dict(environ), start_response):
+                pass
+    return (time.clock() - start) / (requests * len(environs))
+
+
+def main(args=None):
+    """Main entry-point for running this script."""
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--requests", type="int", default=2000,
+                      help="How many times to send each request")
+    parser.add_option("", "--sqluri", default=None,
+                      help="Database URI to use")
+
+    opts, args = parser.parse_args(args)
+    if args:
+        parser.print_usage()
+        return 1
+
+    tmpdir = None
+    sqluri = opts.sqluri
+    if sqluri is None:
+        tmpdir = tempfile.mkdtemp()
+        sqluri = 'sqlite:///' + os.path.join(tmpdir, 'bench.db')
+    try:
+        app = make_app(sqluri)
+        app.fast_path = False
+        full_time = run(app, opts.requests)
+        app.fast_path = True
+        fast_time = run(app, opts.requests)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    print 'Full stack:  %.1f us per request' % (full_time * 1e6)
+    print 'Fast path:   %.1f us per request' % (fast_time * 1e6)
+    print 'Speedup:     %.1fx' % (full_time / fast_time)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
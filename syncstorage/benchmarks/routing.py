@@ -0,0 +1,119 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Routing benchmark for the application urls.
+
+This measures the cost of matching a request against the urls, with the
+Routes mapper used by SyncServerApp and with the precompiled Dispatcher.
+Each of the routes is matched in turn.
+
+Run it like so::
+
+  python -m syncstorage.benchmarks.routing --rounds 10000
+
+"""
+
+import sys
+import time
+import optparse
+
+from routes import Mapper
+
+from syncstorage.dispatch import Dispatcher
+from syncstorage.wsgiapp import urls
+
+_VALUES = {'{api:1.0|1|1.1}': '1.1',
+           '{username:[a-zA-Z0-9._-]+}': 'bob',
+           '{collection:[a-zA-Z0-9._-]+}': 'bookmarks',
+           r'{item:[\\a-zA-Z0-9._?#~-]+}': 'abcdef0123'}
+
+
+def make_mapper(urls):
+    """Builds a Routes mapper the way SyncServerApp does."""
+    mapper = Mapper()
+    for method, pattern, controller, action, extras in urls:
+        mapper.connect(None, pattern, controller=controller, action=action,
+                       conditions=dict(method=[method]), **extras)
+    return mapper
+
+
+def make_environs(urls):
+    """Returns one request environ per route."""
+    environs = []
+    for url in urls:
+        path = url[1]
+        for placeholder, value in _VALUES.iteritems():
+            path = path.replace(placeholder, value)
+        environs.append({'PATH_INFO': path, 'REQUEST_METHOD': url[0]})
+    return environs
+
+
+def run(matcher, environs, rounds):
+    """Returns the average time to match a request, in seconds."""
+    start = time.time()
+    for i in xrange(rounds):
+        for environ in environs:
+            if matcher.routematch(environ=environ) is None:
+                raise ValueError('No match for %r' % environ)
+    return (time.time() - start) / (rounds * len(environs))
+
+
+def main(args=None):
+    """Main entry-point for running this script."""
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--rounds", type="int", default=10000,
+                      help="How many times to match each route")
+
+    opts, args = parser.parse_args(args)
+    if args:
+        parser.print_usage()
+        return 1
+
+    environs = make_environs(urls)
+    routes_time = run(make_mapper(urls), environs, opts.rounds)
+    dispatch_time = run(Dispatcher(urls), environs, opts.rounds)
+
+    print 'Urls:               %d' % len(environs)
+    print 'Routes mapper:      %.2f us per request' % (routes_time * 1e6)
+    print 'Dispatcher:         %.2f us per request' % (dispatch_time * 1e6)
+    print 'Speedup:            %.1fx' % (routes_time / dispatch_time)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
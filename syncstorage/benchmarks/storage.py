@@ -0,0 +1,286 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Benchmarks of the storage backends.
+
+This measures the latency of the main storage operations at several
+dataset sizes: set_items() batches, get_items() with and without the full
+WBOs and with filters, get_collection_timestamps(), quota checks and
+deletes.  It runs offline against SQLite by default::
+
+  python -m syncstorage.benchmarks.storage --output results.json
+
+Use --sqluri to run it against a local MySQL, and --backend to benchmark
+the memcached or localcached backends.  The results are written as JSON.
+Given the results of a previous run with --baseline, the operations whose
+median latency went up by more than --threshold are reported as
+regressions, and the script exits with a non-zero status.
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+import simplejson as json
+
+from syncstorage.benchmarks import measure
+from syncstorage.storage.sql import SQLStorage
+from syncstorage.storage.localcachedsql import LocalCachedSQLStorage
+
+BACKENDS = {'sql': SQLStorage, 'localcached': LocalCachedSQLStorage}
+
+try:
+    from syncstorage.storage.memcachedsql import MemcachedSQLStorage
+except ImportError:
+    # pylibmc is not installed: the memcached backend can't be benchmarked.
+    pass
+else:
+    BACKENDS['memcached'] = MemcachedSQLStorage
+
+_USER = 1
+_PAYLOAD = 'x' * 500
+_FULL_FIELDS = ['id', 'parentid', 'predecessorid', 'sortindex', 'modified',
+                'payload']
+
+
+def _items(prefix, count):
+    return [{'id': '%s%d' % (prefix, index), 'payload': _PAYLOAD,
+             'sortindex': index} for index in range(count)]
+
+
+def _percentile(samples, fraction):
+    return samples[int(round(fraction * (len(samples) - 1)))]
+
+
+def latency(func, rounds, setup=None):
+    """Calls func rounds times, and returns statistics on its latency.
+
+    Each call is timed on its own with measure(), so that setup can be
+    called before it, outside of the measure.
+    """
+    samples = []
+    for index in xrange(rounds):
+        if setup is not None:
+            setup(index)
+        samples.append(measure(lambda: func(index), number=1, repeat=1))
+    samples.sort()
+    total = sum(samples)
+    return {'rounds': rounds,
+            'mean': total / rounds,
+            'p50': _percentile(samples, 0.5),
+            'p95': _percentile(samples, 0.95),
+            'ops_per_sec': rounds / total if total else None}
+
+
+def populate(storage, size):
+    """Fills the "history" collection of the benchmark user."""
+    for start in range(0, size, 100):
+        items = _items('h', min(size, start + 100))[start:]
+        storage.set_items(_USER, 'history', items)
+
+
+def run_benchmarks(storage, size, rounds):
+    """Runs all the benchmarks on a storage holding size items."""
+    populate(storage, size)
+    results = {}
+    counter = [0]
+
+    def set_items(count):
+        def _set(index):
+            counter[0] += 1
+            storage.set_items(_USER, 'bookmarks',
+                              _items('b%d-' % counter[0], count))
+        return _set
+
+    for count in (1, 10, 100):
+        results['set_items_%d' % count] = latency(set_items(count), rounds)
+
+    modified = storage.get_collection_timestamps(_USER)['history']
+    benchmarks = {
+        'get_items_ids': lambda index: storage.get_items(
+            _USER, 'history', fields=['id']),
+        'get_items_full': lambda index: storage.get_items(
+            _USER, 'history', fields=_FULL_FIELDS),
+        'get_items_filtered': lambda index: storage.get_items(
+            _USER, 'history', fields=_FULL_FIELDS,
+            filters={'modified': ('<', modified + 1),
+                     'sortindex': ('>', size / 2)},
+            sort='index', limit=10),
+        'get_collection_timestamps': lambda index:
+            storage.get_collection_timestamps(_USER),
+        'get_size_left': lambda index: storage.get_size_left(_USER),
+        'get_size_left_recalculate': lambda index: storage.get_size_left(
+            _USER, recalculate=True),
+    }
+    for name, func in benchmarks.iteritems():
+        results[name] = latency(func, rounds)
+
+    # the deleted items are put back before each round.  The bookmarks
+    # written by set_items are removed first, so that every round deletes
+    # the same rows.
+    storage.delete_items(_USER, 'bookmarks')
+
+    def put_back(count):
+        def _setup(index):
+            storage.set_items(_USER, 'bookmarks', _items('d', count))
+        return _setup
+
+    results['delete_item'] = latency(
+        lambda index: storage.delete_item(_USER, 'bookmarks', 'd0'),
+        rounds, put_back(1))
+    ids = ['d%d' % index for index in range(10)]
+    results['delete_items_10'] = latency(
+        lambda index: storage.delete_items(_USER, 'bookmarks', ids),
+        rounds, put_back(10))
+    results['delete_collection'] = latency(
+        lambda index: storage.delete_items(_USER, 'bookmarks'),
+        rounds, put_back(100))
+    return results
+
+
+def run(backend, sqluri, sizes, rounds, **options):
+    """Runs the benchmarks for each dataset size.
+
+    sqluri may contain "%(size)s", so that each size gets its own
+    database.  Returns a dict mapping each size to its results.
+    """
+    results = {}
+    for size in sizes:
+        storage = BACKENDS[backend](sqluri % {'size': size},
+                                    create_tables=True, use_quota=True,
+                                    quota_size=1024 * 1024, **options)
+        try:
+            storage.delete_user(_USER)
+            results[str(size)] = run_benchmarks(storage, size, rounds)
+        finally:
+            storage.delete_user(_USER)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Compares the median latencies to the ones of a baseline.
+
+    Returns a list of (size, name, baseline median, median, ratio) tuples,
+    and the list of the regressions among them.
+    """
+    comparison = []
+    regressions = []
+    for size, benchmarks in sorted(results.iteritems()):
+        for name, res in sorted(benchmarks.iteritems()):
+            base = baseline.get(size, {}).get(name)
+            if base is None or not base['p50']:
+                continue
+            ratio = res['p50'] / base['p50']
+            line = size, name, base['p50'], res['p50'], ratio
+            comparison.append(line)
+            if ratio > 1 + threshold:
+                regressions.append(line)
+    return comparison, regressions
+
+
+def main(args=None):
+    """Main entry-point for running this script."""
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--backend", default="sql",
+                      choices=sorted(BACKENDS),
+                      help="Storage backend to benchmark")
+    parser.add_option("", "--sqluri", default=None,
+                      help="Database URI, may contain %(size)s")
+    parser.add_option("", "--cache-servers", default="127.0.0.1:11211",
+                      help="Memcached servers, for the memcached backend")
+    parser.add_option("", "--sizes", default="100,1000,5000",
+                      help="Comma-separated dataset sizes")
+    parser.add_option("", "--rounds", type="int", default=50,
+                      help="How many times to run each operation")
+    parser.add_option("", "--output", default=None,
+                      help="File to write the JSON results to")
+    parser.add_option("", "--baseline", default=None,
+                      help="JSON results of a previous run to compare to")
+    parser.add_option("", "--threshold", type="float", default=0.2,
+                      help="Slowdown above which to flag a regression")
+
+    opts, args = parser.parse_args(args)
+    if args:
+        parser.print_usage()
+        return 1
+
+    sizes = [int(size) for size in opts.sizes.split(',')]
+    options = {}
+    if opts.backend == 'memcached':
+        options['cache_servers'] = opts.cache_servers.split(',')
+
+    tmpdir = None
+    sqluri = opts.sqluri
+    if sqluri is None:
+        tmpdir = tempfile.mkdtemp()
+        sqluri = 'sqlite:///' + os.path.join(tmpdir, 'bench-%(size)s.db')
+    try:
+        results = run(opts.backend, sqluri, sizes, opts.rounds, **options)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    output = {'backend': opts.backend, 'rounds': opts.rounds,
+              'time': time.time(), 'results': results}
+    if opts.output is None:
+        print json.dumps(output, indent=2, sort_keys=True)
+    else:
+        with open(opts.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+    if opts.baseline is None:
+        return 0
+
+    with open(opts.baseline) as f:
+        baseline = json.load(f)['results']
+    comparison, regressions = compare(results, baseline, opts.threshold)
+    for size, name, base, median, ratio in comparison:
+        flag = ' REGRESSION' if ratio > 1 + opts.threshold else ''
+        print >> sys.stderr, '%6s %-28s %9.3fms -> %9.3fms (%+.0f%%)%s' % (
+            size, name, base * 1000, median * 1000, (ratio - 1) * 100, flag)
+    if regressions:
+        print >> sys.stderr, '%d regression(s)' % len(regressions)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
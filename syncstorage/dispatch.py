@@ -0,0 +1,139 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Precompiled dispatch table for the application urls.
+
+The urls are given in the format used by SyncServerApp: tuples of
+(method, pattern, controller, action[, extras]) where the pattern holds
+"{name:regex}" placeholders, as expanded by wsgiapp._url().
+
+Routes tries the regex of every route in turn.  The Dispatcher instead
+indexes the routes by method and number of path segments, and checks
+the literal segments of each candidate before running its regex, so that
+at most one regex is run per plausible candidate.
+
+The matches are the same as the ones of a Routes mapper: the captured
+values and the extras are returned as unicode strings.
+"""
+import re
+from collections import defaultdict
+
+_PLACEHOLDER = re.compile(r'\{(\w+):([^}]+)\}')
+
+
+class Route(object):
+    """A compiled url pattern."""
+
+    def __init__(self, method, pattern, controller, action, extras=None):
+        self.method = method
+        self.pattern = pattern
+        self.segments = pattern.split('/')
+
+        # literal segments are compared as strings.
+        self.literals = tuple((index, segment)
+                              for index, segment in enumerate(self.segments)
+                              if '{' not in segment)
+
+        regex = []
+        pos = 0
+        for placeholder in _PLACEHOLDER.finditer(pattern):
+            regex.append(re.escape(pattern[pos:placeholder.start()]))
+            regex.append('(?P<%s>%s)' % placeholder.groups())
+            pos = placeholder.end()
+        regex.append(re.escape(pattern[pos:]))
+        self.regex = re.compile('^%s$' % ''.join(regex))
+
+        self.defaults = dict((key, unicode(value)) for key, value in
+                             (extras or {}).iteritems())
+        self.defaults['controller'] = unicode(controller)
+        self.defaults['action'] = unicode(action)
+
+    def match(self, path, segments):
+        for index, literal in self.literals:
+            if segments[index] != literal:
+                return None
+        match = self.regex.match(path)
+        if match is None:
+            return None
+        res = dict(self.defaults)
+        for key, value in match.groupdict().iteritems():
+            res[key] = value.decode('utf8')
+        return res
+
+
+class Dispatcher(object):
+    """Matches requests against a list of urls.
+
+    This can be used in place of the Routes mapper of SyncServerApp, as it
+    provides the same routematch() method.
+    """
+
+    def __init__(self, urls):
+        self.routes = []
+        self._table = defaultdict(list)
+        for url in urls:
+            method, pattern, controller, action = url[:4]
+            extras = url[4] if len(url) > 4 else None
+            if isinstance(method, basestring):
+                methods = [method]
+            else:
+                methods = method
+            for method in methods:
+                route = Route(method, pattern, controller, action, extras)
+                self.routes.append(route)
+                key = method, len(route.segments)
+                self._table[key].append(route)
+
+    def match(self, method, path):
+        """Returns the match of the request, or None."""
+        segments = path.split('/')
+        for route in self._table.get((method, len(segments)), ()):
+            res = route.match(path, segments)
+            if res is not None:
+                return res, route
+        return None
+
+    def routematch(self, url=None, environ=None):
+        """Returns a (match, route) tuple like Mapper.routematch().
+
+        The method is taken from the environ.  None is returned if there is
+        no match.
+        """
+        if environ is None:
+            environ = {}
+        if url is None:
+            url = environ['PATH_INFO']
+        return self.match(environ.get('REQUEST_METHOD'), url)
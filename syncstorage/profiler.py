@@ -0,0 +1,282 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Sampling profiler middleware.
+
+The profile switch of the paste config profiles every request, which is
+far too slow for production.  This middleware only profiles the requests
+it samples: one in sample_rate, plus the ones going to the given
+endpoints or users.  While such requests are running, a background thread
+takes a snapshot of their stacks every interval seconds; the other
+requests are not slowed down at all.
+
+The stacks are aggregated per endpoint and written every flush_interval
+seconds to collapsed-stack files (one "frame;frame;frame count" line per
+distinct stack), which flamegraph.pl and most flame graph viewers read.
+The stacks of the last sampled requests are written once flush_interval
+is over, even if no other request is sampled.  Only the max_files most
+recent files are kept in output_dir.
+
+The sampling options can be changed without a restart through an
+optional control_file, holding a [profiler] section with sample_rate,
+endpoints and users options (the last two being comma-separated lists).
+It is read again when it changes.
+
+The endpoints are named after the method and action of the url, like
+"GET get_collection".
+"""
+import os
+import re
+import sys
+import time
+import itertools
+import threading
+from ConfigParser import RawConfigParser
+from collections import defaultdict
+
+from syncstorage.dispatch import Dispatcher
+from syncstorage.wsgiapp import urls
+
+_UNSAFE_CHARS = re.compile(r'[^a-zA-Z0-9_.-]+')
+
+
+def _split(value):
+    if not value:
+        return set()
+    if isinstance(value, basestring):
+        value = value.split(',')
+    return set(item.strip() for item in value if item.strip())
+
+
+class SamplingProfiler(object):
+    """WSGI middleware sampling the stacks of some requests."""
+
+    def __init__(self, app, output_dir, sample_rate=0, endpoints=None,
+                 users=None, interval=0.005, flush_interval=60,
+                 max_files=100, control_file=None):
+        if max_files < 1:
+            raise ValueError('max_files must be at least 1')
+        self.app = app
+        self.output_dir = output_dir
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.max_files = max_files
+        self.control_file = control_file
+        self._control_mtime = None
+        self._next_control_check = 0
+        self.configure(sample_rate, endpoints, users)
+        self.dispatcher = Dispatcher(urls)
+        # maps the thread id of the sampled requests to their endpoint.
+        self._active = {}
+        # maps each endpoint to the count of each of its stacks.
+        self._stacks = defaultdict(lambda: defaultdict(int))
+        self._labels = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        # wakes the sampling thread up when it waits for the next flush.
+        self._wakeup = threading.Event()
+        self._next_flush = time.time() + flush_interval
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+    def configure(self, sample_rate=0, endpoints=None, users=None):
+        """Changes what gets sampled."""
+        self.sample_rate = int(sample_rate)
+        self.endpoints = _split(endpoints)
+        self.users = _split(users)
+        self._counter = itertools.count(1)
+
+    def _check_control_file(self):
+        now = time.time()
+        if now < self._next_control_check:
+            return
+        self._next_control_check = now + 1
+        try:
+            mtime = os.stat(self.control_file).st_mtime
+        except OSError:
+            return
+        if mtime == self._control_mtime:
+            return
+        self._control_mtime = mtime
+        config = RawConfigParser()
+        config.read(self.control_file)
+        options = {}
+        if config.has_section('profiler'):
+            options = dict(config.items('profiler'))
+        self.configure(options.get('sample_rate', 0),
+                       options.get('endpoints'), options.get('users'))
+
+    def _endpoint(self, environ):
+        match = self.dispatcher.match(environ.get('REQUEST_METHOD'),
+                                      environ.get('PATH_INFO', ''))
+        if match is None:
+            return 'other', None
+        match = match[0]
+        return ('%s %s' % (environ['REQUEST_METHOD'], match['action']),
+                match.get('username'))
+
+    def _sample(self, environ):
+        """Returns the endpoint of the request if it is sampled, or None."""
+        if self.control_file is not None:
+            self._check_control_file()
+        sampled = (self.sample_rate > 0 and
+                   self._counter.next() % self.sample_rate == 0)
+        if not sampled and not self.endpoints and not self.users:
+            return None
+        endpoint, username = self._endpoint(environ)
+        if (sampled or endpoint in self.endpoints or
+            (username is not None and username in self.users)):
+            return endpoint
+        return None
+
+    def __call__(self, environ, start_response):
+        endpoint = self._sample(environ)
+        if endpoint is None:
+            return self.app(environ, start_response)
+        return self._profile(endpoint, environ, start_response)
+
+    def _profile(self, endpoint, environ, start_response):
+        thread_id = threading.current_thread().ident
+        with self._lock:
+            self._active[thread_id] = endpoint
+            self._wakeup.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        try:
+            # the body is built by the app, not while it is sent.
+            app_iter = self.app(environ, start_response)
+            try:
+                return list(app_iter)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+        finally:
+            with self._lock:
+                del self._active[thread_id]
+
+    def _run(self):
+        """Samples the stacks of the active requests, while there are.
+
+        Once there are none, waits for the next flush to write what was
+        collected, unless another request is sampled in the meantime.
+        """
+        while True:
+            self._wakeup.clear()
+            with self._lock:
+                active = self._active.items()
+                if not active and not self._stacks:
+                    self._thread = None
+                    break
+            if not active:
+                delay = self._next_flush - time.time()
+                if delay > 0:
+                    self._wakeup.wait(delay)
+                    continue
+                self.flush()
+                continue
+            frames = sys._current_frames()
+            for thread_id, endpoint in active:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    self._record(endpoint, frame)
+            del frames
+            if time.time() >= self._next_flush:
+                self.flush()
+            time.sleep(self.interval)
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            filename = code.co_filename
+            for path in sys.path:
+                if path and filename.startswith(path + os.sep):
+                    filename = filename[len(path) + 1:]
+                    break
+            label = '%s (%s:%d)' % (code.co_name, filename,
+                                    code.co_firstlineno)
+            self._labels[code] = label
+        return label
+
+    def _record(self, endpoint, frame):
+        stack = []
+        while frame is not None:
+            if frame.f_code is _PROFILE_CODE:
+                break
+            stack.append(self._label(frame.f_code))
+            frame = frame.f_back
+        else:
+            # the request was over by the time we got its frame.
+            return
+        if stack:
+            stack.reverse()
+            with self._lock:
+                self._stacks[endpoint][';'.join(stack)] += 1
+
+    def flush(self):
+        """Writes the stacks collected so far, and rotates the files."""
+        with self._lock:
+            stacks, self._stacks = self._stacks, defaultdict(
+                lambda: defaultdict(int))
+            now = time.time()
+            self._next_flush = now + self.flush_interval
+        stamp = '%s.%03d' % (time.strftime('%Y%m%d-%H%M%S',
+                                           time.localtime(now)),
+                             now % 1 * 1000)
+        for endpoint, counts in stacks.iteritems():
+            name = '%s-%s.folded' % (stamp, _UNSAFE_CHARS.sub('_', endpoint))
+            path = os.path.join(self.output_dir, name)
+            with open(path, 'w') as f:
+                for stack, count in counts.iteritems():
+                    f.write('%s %d\n' % (stack, count))
+
+        files = sorted(name for name in os.listdir(self.output_dir)
+                       if name.endswith('.folded'))
+        for name in files[:-self.max_files]:
+            os.remove(os.path.join(self.output_dir, name))
+
+
+_PROFILE_CODE = SamplingProfiler._profile.im_func.func_code
+
+
+def make_filter(app, global_conf, output_dir, sample_rate=0, endpoints=None,
+                users=None, interval=0.005, flush_interval=60,
+                max_files=100, control_file=None):
+    """Paste filter factory for the SamplingProfiler."""
+    return SamplingProfiler(app, output_dir, int(sample_rate), endpoints,
+                            users, float(interval), float(flush_interval),
+                            int(max_files), control_file)
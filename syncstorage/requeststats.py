@@ -0,0 +1,172 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Accounting of the storage calls made by each request.
+
+The metlog timers give the time of each SQL statement or memcached call,
+but not which request made them.  The app starts a RequestStats for each
+request; the SQL storage and the cache manager add their calls to the
+stats of the current thread, if any:
+
+- sql_statements / sql_time: statements sent to the database, and the
+  time spent in them (in seconds)
+- rows: rows returned by the queries
+- cache_calls / cache_time: round trips to memcached, and their time
+
+The stats can be sent back to trusted clients as X-Debug-* headers, see
+the storage.debug_token option of the app.
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+import sqlalchemy.event
+
+# maps the fields of the stats to their header.
+_HEADERS = (('sql_statements', 'X-Debug-SQL-Statements'),
+            ('sql_time', 'X-Debug-SQL-Time'),
+            ('rows', 'X-Debug-Rows'),
+            ('cache_calls', 'X-Debug-Cache-Calls'),
+            ('cache_time', 'X-Debug-Cache-Time'))
+
+_TIMES = ('sql_time', 'cache_time')
+
+_local = threading.local()
+
+
+class RequestStats(object):
+    """The counters of a request."""
+
+    def __init__(self):
+        self.sql_statements = 0
+        self.sql_time = 0.
+        self.rows = 0
+        self.cache_calls = 0
+        self.cache_time = 0.
+
+    def headers(self):
+        """Returns the stats as a list of headers.
+
+        The times are given in milliseconds.
+        """
+        res = []
+        for field, header in _HEADERS:
+            value = getattr(self, field)
+            if field in _TIMES:
+                value = '%.3f' % (value * 1000)
+            res.append((header, str(value)))
+        return res
+
+    @classmethod
+    def from_headers(cls, headers):
+        """Builds the stats from the headers returned by headers()."""
+        stats = cls()
+        for field, header in _HEADERS:
+            if field in _TIMES:
+                setattr(stats, field, float(headers[header]) / 1000)
+            else:
+                setattr(stats, field, int(headers[header]))
+        return stats
+
+
+def start():
+    """Starts the stats of the request handled by the current thread."""
+    stats = _local.stats = RequestStats()
+    return stats
+
+
+def stop():
+    """Stops the stats of the current thread, and returns them."""
+    return _local.__dict__.pop('stats', None)
+
+
+def current():
+    """Returns the stats of the current thread, or None."""
+    return getattr(_local, 'stats', None)
+
+
+@contextmanager
+def collect():
+    """Yields the stats of the calls made in the block."""
+    stats = start()
+    try:
+        yield stats
+    finally:
+        stop()
+
+
+def record_sql(duration):
+    """Counts an SQL statement that took duration seconds."""
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.sql_statements += 1
+        stats.sql_time += duration
+
+
+def record_rows(count):
+    """Counts rows returned by a query."""
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.rows += count
+
+
+def record_cache(duration):
+    """Counts a memcached round trip that took duration seconds."""
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.cache_calls += 1
+        stats.cache_time += duration
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if getattr(_local, 'stats', None) is not None:
+        conn.info['syncstorage.query_start'] = time.time()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = conn.info.pop('syncstorage.query_start', None)
+    if start is not None:
+        record_sql(time.time() - start)
+
+
+def watch_engine(engine):
+    """Adds the statements run by the engine to the stats."""
+    sqlalchemy.event.listen(engine, 'before_cursor_execute',
+                            _before_cursor_execute)
+    sqlalchemy.event.listen(engine, 'after_cursor_execute',
+                            _after_cursor_execute)
@@ -42,6 +42,10 @@ each storage backend to check whether it is still up.  If a backend is
 found to be down then this fact is recorded in memcache so that the webapp
 can avoid sending traffic to it.
 
+The latency of the pings is also recorded.  If a backend becomes slow then
+it is marked for backoff, with a backoff time that grows with its latency,
+so that it gets some relief before it fails outright.
+
 Run it by specifing the path to the configuration file, like so::
 
   python dbcheck.py /etc/mozilla-services/sync.conf
@@ -51,10 +55,12 @@ Run it by specifing the path to the configuration file, like so::
 import os
 import sys
 import time
-import signal
 import logging
 import optparse
-import contextlib
+import threading
+import bisect
+import Queue
+from collections import deque
 
 from pylibmc import Client
 
@@ -62,8 +68,16 @@ import syncstorage.wsgiapp
 
 logger = logging.getLogger("syncstorage.scripts.dbcheck")
 
+# The last status written by this script for each host is kept in memcache
+# under this prefix, so that it is not mistaken for one set by hand.
+WRITTEN_PREFIX = "dbcheck-status:"
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
 
-def monitor_backends(config_file, check_interval=60, backend_timeout=30):
+
+def monitor_backends(config_file, check_interval=60, backend_timeout=30,
+                     max_workers=20, grader=None):
     """Monitor the health of all storage backends in the given config file.
 
     This function runs an endless loop that periodically pings each storage
@@ -71,15 +85,13 @@ def monitor_backends(config_file, check_interval=60, backend_timeout=30):
     fails to respond within a certain time, then it is considered to be
     unhealthy and is marked as such in memcache.
 
-    The actual checking logic is implemented in the check_backends() function.
+    The actual checking logic is implemented in the BackendChecker class.
     This function just adds a simple control loop.
     """
     logger.info("Entering storage backend monitor")
-
-    # Sanity-check the app config file.
     logger.debug("Using config file %r", config_file)
-    app = load_app_from_config(config_file)
-    logger.debug("Using memcache servers %r", app.cache_servers)
+    checker = BackendChecker(config_file, backend_timeout, max_workers,
+                             grader)
 
     # Loop forever, periodically pinging the storage backends.
     try:
@@ -87,9 +99,9 @@ def monitor_backends(config_file, check_interval=60, backend_timeout=30):
             start_time = time.time()
             logger.debug("Beginning monitor loop at %s", start_time)
 
-            # The app is reloaded from config file on each iteration.
+            # The config file is reloaded if it changed.
             # This makes it easier to account for added/removed nodes.
-            check_backends(config_file, backend_timeout)
+            checker.check()
 
             end_time = time.time()
             logger.debug("Finishing monitor loop at %s", end_time)
@@ -99,121 +111,317 @@ def monitor_backends(config_file, check_interval=60, backend_timeout=30):
                 time.sleep(sleep_time)
 
     finally:
+        checker.close()
         logger.info("Exiting storage backend monitor")
 
 
-def check_backends(config_file, backend_timeout=30):
+def check_backends(config_file, backend_timeout=30, max_workers=20,
+                   grader=None):
     """Check the health of all storage backends in the given config file.
 
     This pings each storage backend found in the given config file.  If the
     backend errors out or fails to respond within a certain time, then it is
     considered to be unhealthy and is marked as such in memcache.
+    """
+    checker = BackendChecker(config_file, backend_timeout, max_workers,
+                             grader)
+    try:
+        checker.check()
+    finally:
+        checker.close()
+
+
+class LatencyHistogram(object):
+    """Histogram of the latencies of the last `window` pings of a backend."""
+
+    def __init__(self, window=10, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.samples = deque()
+        self.window = window
+
+    def _bucket(self, latency):
+        return bisect.bisect_left(self.buckets, latency)
+
+    def add(self, latency):
+        self.samples.append(latency)
+        self.counts[self._bucket(latency)] += 1
+        if len(self.samples) > self.window:
+            self.counts[self._bucket(self.samples.popleft())] -= 1
+
+    def percentile(self, fraction):
+        """Returns the latency below which `fraction` of the pings fall."""
+        if not self.samples:
+            return None
+        samples = sorted(self.samples)
+        index = int(round(fraction * (len(samples) - 1)))
+        return samples[index]
+
+    def __str__(self):
+        bounds = ['<=%s' % bound for bound in self.buckets] + ['inf']
+        return ' '.join('%s:%d' % (bound, count)
+                        for bound, count in zip(bounds, self.counts)
+                        if count)
 
-    To prevent uncooperative backends from locking up the monitoring loop,
-    this function forks a new child process to ping each individual backend.
-    Any that do not exit within the specified timeout are unceremoniously
-    killed.
+
+class HealthGrader(object):
+    """Computes the status of a backend from its latency histogram.
+
+    A backend whose latency percentile stays under `threshold` seconds is
+    "ok".  Above it, the backend is given a "backoff:NN" status, where NN
+    grows linearly from `min_backoff` to `max_backoff` seconds as the
+    latency goes from `threshold` to `limit`.
     """
-    app = load_app_from_config(config_file)
 
-    # These dicts will hold the pids of any child processes that we fork.
-    # A try-finally is used to ensure they're cleaned up at function exit.
-    running_procs = {}
-    hung_procs = {}
+    def __init__(self, threshold=1.0, limit=10.0, min_backoff=60,
+                 max_backoff=1800, percentile=0.9, window=10):
+        if limit <= threshold:
+            raise ValueError('The latency limit must be above the threshold')
+        self.threshold = float(threshold)
+        self.limit = float(limit)
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.percentile = percentile
+        self.window = window
+
+    def histogram(self):
+        return LatencyHistogram(self.window)
+
+    def grade(self, histogram):
+        latency = histogram.percentile(self.percentile)
+        if latency is None or latency <= self.threshold:
+            return "ok"
+        degradation = min((latency - self.threshold) /
+                          (self.limit - self.threshold), 1.0)
+        backoff = self.min_backoff + degradation * (self.max_backoff -
+                                                    self.min_backoff)
+        return "backoff:%d" % backoff
+
+
+def is_managed_status(status, written=None):
+    """Tells if the status can be changed by this script.
+
+    This is the case of "ok", "unhealthy", and of the status we last wrote
+    ourselves, given in `written`.  Anything else will have been set by
+    hand, e.g. to "down" or to a longer "backoff:NN" by the ops team, and
+    is left alone.
+    """
+    if status in ("ok", "unhealthy"):
+        return True
+    return written is not None and status == written
+
+
+class BackendChecker(object):
+    """Pings the storage backends of a config file.
+
+    The storage backends, and their connection pools, are kept from one
+    check to the next.  They are only rebuilt when the config file changes.
+
+    The pings are done by a pool of max_workers threads.  A ping that does
+    not complete within backend_timeout seconds marks the backend as
+    unhealthy, and its thread is replaced by a new one.  The backend is not
+    pinged again until the hung ping completes.
+
+    The latencies of the successful pings are kept in a histogram for each
+    backend, which the grader turns into an "ok" or "backoff:NN" status.
+    """
+
+    def __init__(self, config_file, backend_timeout=30, max_workers=20,
+                 grader=None):
+        self.config_file = config_file
+        self.backend_timeout = backend_timeout
+        self.max_workers = max_workers
+        if grader is None:
+            grader = HealthGrader()
+        self.grader = grader
+        self.latencies = {}
+        self.storages = {}
+        self.cache = None
+        self.cache_servers = None
+        self._mtime = None
+        self._tasks = Queue.Queue()
+        self._workers = 0
+        self._hung = set()
+        self._replaced = set()
+        self._lock = threading.Lock()
+        for i in range(max_workers):
+            self._start_worker()
+
+    def _start_worker(self):
+        with self._lock:
+            self._workers += 1
+        worker = threading.Thread(target=self._run_worker)
+        worker.daemon = True
+        worker.start()
+
+    def _run_worker(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            host, storage, results = task
+            start_time = time.time()
+            try:
+                healthy = storage.is_healthy()
+            except Exception:
+                logger.debug("Check failed for %r", host, exc_info=True)
+                healthy = False
+            elapsed = time.time() - start_time
+            results.put((host, healthy, elapsed))
+
+            with self._lock:
+                self._hung.discard(host)
+                # a replacement was started while we were hung.
+                if host in self._replaced:
+                    self._replaced.discard(host)
+                    break
+        with self._lock:
+            self._workers -= 1
+
+    def close(self):
+        """Stops the worker threads and closes the connections."""
+        for i in range(self._workers):
+            self._tasks.put(None)
+        self._dispose(self.storages)
+        self.storages = {}
+        if self.cache is not None:
+            self.cache.disconnect_all()
+            self.cache = None
+
+    def _dispose(self, storages):
+        for storage in storages.itervalues():
+            close = getattr(storage, 'close', None)
+            if close is not None:
+                close()
+
+    def reload(self):
+        """Reloads the config file if it changed since the last call.
+
+        Returns True if it was reloaded.
+        """
+        mtime = os.stat(self.config_file).st_mtime
+        if mtime == self._mtime:
+            return False
+
+        logger.info("Loading config file %r", self.config_file)
+        app = load_app_from_config(self.config_file)
+        self._mtime = mtime
+        self._dispose(self.storages)
+        self.storages = dict(app.storages.iteritems())
+        for host in self.latencies.keys():
+            if host not in self.storages:
+                del self.latencies[host]
+        if app.cache_servers != self.cache_servers:
+            logger.debug("Using memcache servers %r", app.cache_servers)
+            if self.cache is not None:
+                self.cache.disconnect_all()
+            self.cache = Client(app.cache_servers, behaviors={"cas": 1})
+            self.cache_servers = app.cache_servers
+        return True
+
+    def ping(self, hosts):
+        """Pings the given hosts concurrently.
+
+        Returns a dict mapping each host to the latency of its ping if it
+        is healthy, and None if it is not or did not answer in time.
+        """
+        results = Queue.Queue()
+        pending = set()
+        for host in hosts:
+            with self._lock:
+                if host in self._hung:
+                    logger.info("Previous check still hung for %r", host)
+                    continue
+                self._hung.add(host)
+            pending.add(host)
+            self._tasks.put((host, self.storages[host], results))
+
+        statuses = dict((host, None) for host in hosts)
+        deadline = time.time() + self.backend_timeout
+        while pending:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                host, healthy, elapsed = results.get(timeout=timeout)
+            except Queue.Empty:
+                break
+            logger.debug("Check completed for %r in %.3fs, healthy=%s",
+                         host, elapsed, healthy)
+            pending.discard(host)
+            if healthy:
+                statuses[host] = elapsed
+
+        # The threads stuck on the remaining hosts are replaced, so that
+        # the next checks are not slowed down.
+        for host in pending:
+            logger.info("Check timed out for %r", host)
+            with self._lock:
+                if host not in self._hung:
+                    # it completed in the meantime.
+                    continue
+                self._replaced.add(host)
+            self._start_worker()
+
+        return statuses
+
+    def check(self):
+        """Checks the health of all the storage backends.
+
+        Their statuses are updated in memcache.
+        """
+        self.reload()
 
-    try:
         # Dicts to hold the old and new statuses of each backend.
         # New statuses are written into memcache using an atomic
         # compare-and-swap against the old status, to prevent race
         # conditions with other admin tools.
         old_statuses = {}
-        new_statuses = {}
 
         # For each backend host, read its current status from memcache.
-        # If it's either "ok" or "unhealthy" then we can send it a ping.
+        # If it's one of the statuses we manage then we can send it a ping.
         # If it's any other state then we shouldn't mess with it, as it
         # will have been manually set to e.g. "down" by the ops team.
-        with memcache_client(app.cache_servers) as cache:
-            for host in app.storages:
-                status, casid = cache.gets("status:" + host)
-                if status is None:
-                    status = "ok"
-                logger.debug("Current status of %r: %s", host, status)
-                if status in ("ok", "unhealthy"):
-                    # Remember the casid so we can do atomic replace later.
-                    old_statuses[host] = status, casid
-
-        # For each backend host that we want to monitor, fork a child
-        # process to do the actual ping.  This makes it easy for us to
-        # recover if it times out, goes haywire etc.
-        for host, backend in app.storages.iteritems():
-            if host in old_statuses:
-                pid = os.fork()
-                if pid:
-                    # We're in the parent process.
-                    # Just record the pid for monitoring.
-                    running_procs[pid] = host
-                else:
-                    # We're in the child process.
-                    # Ping the backend to see if it's active.
-                    # Note that os._exit is the recommended way to
-                    # exit a child process after a fork().
-                    try:
-                        if backend.is_healthy():
-                            os._exit(0)
-                        else:
-                            os._exit(1)
-                    except Exception:
-                        os._exit(2)
-
-        # Set a SIGALRM to interrupt us after the timeout has passed.
-        # Any child processes that haven't completed by this time
-        # are considered hung and the host will be marked as down.
-        def on_alarm(signum, frame):
-            hung_procs.update(running_procs)
-            running_procs.clear()
-        signal.signal(signal.SIGALRM, on_alarm)
-        signal.alarm(backend_timeout)
-
-        # Wait for all child processes to complete, or for the SIGALRM.
-        # If the alarm triggers, it will interrupt os.wait() with an OSError.
-        while running_procs:
-            try:
-                pid, code = os.wait()
-                host = running_procs.pop(pid)
-                logger.debug("Check completed for %r, code=%s", host, code)
-                new_statuses[host] = "unhealthy" if code else "ok"
-            except OSError:
-                pass
-        signal.alarm(0)
-
-        # Reap any child processes that have hung.
-        for pid, host in hung_procs.iteritems():
-            logger.info("Check timed out for %r", host)
-            reap_child_proc(pid)
-            new_statuses[host] = "unhealthy"
-        hung_procs.clear()
+        for host in self.storages:
+            status, casid = self.cache.gets("status:" + host)
+            if status is None:
+                status = "ok"
+            logger.debug("Current status of %r: %s", host, status)
+            written = self.cache.get(WRITTEN_PREFIX + host)
+            if is_managed_status(status, written):
+                # Remember the casid so we can do atomic replace later.
+                old_statuses[host] = status, casid
+
+        results = self.ping(old_statuses.keys())
+        new_statuses = {}
+        for host, latency in results.iteritems():
+            if latency is None:
+                new_statuses[host] = "unhealthy"
+                continue
+            histogram = self.latencies.get(host)
+            if histogram is None:
+                histogram = self.latencies[host] = self.grader.histogram()
+            histogram.add(latency)
+            logger.debug("Latencies of %r: %s", host, histogram)
+            new_statuses[host] = self.grader.grade(histogram)
 
         # Update the status of each host in memcache.
         # Using CAS prevents us overwriting updates made by other scripts.
-        with memcache_client(app.cache_servers) as cache:
-            for host, new_status in new_statuses.iteritems():
-                old_status, casid = old_statuses[host]
-                logger.debug("New status for %r is %s", host, new_status)
-                if old_status != new_status:
-                    logger.info("Status change for %r: %s => %s",
-                                host, old_status, new_status)
-                    if casid is None:
-                        cache.add("status:" + host, new_status)
-                    else:
-                        cache.cas("status:" + host, new_status, casid)
-
-    finally:
-        # Ensure that all child procs are cleaned up on exit.
-        for pid in running_procs:
-            reap_child_proc(pid)
-        for pid in hung_procs:
-            reap_child_proc(pid)
+        for host, new_status in new_statuses.iteritems():
+            old_status, casid = old_statuses[host]
+            logger.debug("New status for %r is %s", host, new_status)
+            if old_status != new_status:
+                logger.info("Status change for %r: %s => %s",
+                            host, old_status, new_status)
+                if casid is None:
+                    stored = self.cache.add("status:" + host, new_status)
+                else:
+                    stored = self.cache.cas("status:" + host, new_status,
+                                            casid)
+                # remember it, so we can tell it from the manual ones.
+                if stored:
+                    self.cache.set(WRITTEN_PREFIX + host, new_status)
+        return new_statuses
 
 
 def load_app_from_config(config_file):
@@ -234,34 +442,6 @@ def load_app_from_config(config_file):
     return app
 
 
-@contextlib.contextmanager
-def memcache_client(servers):
-    """Context-manager for creating connections to memcache.
-
-    Unfortunately pylibmc doesn't seem to play nicely with os.fork(),
-    so we can't create a single connection and use it for all queries.
-    Instead we must create one when needed and tear it down when done.
-    """
-    client = Client(servers, behaviors={"cas": 1})
-    try:
-        yield client
-    finally:
-        client.disconnect_all()
-
-
-def reap_child_proc(pid):
-    """Helper function that reaps hung child processes.
-
-    This can be used to cleanup a rogue child process without erroring
-    out if it does something funny.
-    """
-    try:
-        os.kill(pid, signal.SIGKILL)
-        os.waitpid(pid, 0)
-    except OSError:
-        pass
-
-
 def main(args=None):
     """Main entry-point for running this script.
 
@@ -274,6 +454,18 @@ def main(args=None):
                       help="The interval between checks, in seconds")
     parser.add_option("", "--backend-timeout", type="int", default=30,
                       help="How long to wait for a response, in seconds")
+    parser.add_option("", "--max-workers", type="int", default=20,
+                      help="How many backends to check concurrently")
+    parser.add_option("", "--latency-threshold", type="float", default=1.0,
+                      help="Latency above which to back off, in seconds")
+    parser.add_option("", "--latency-limit", type="float", default=10.0,
+                      help="Latency for the maximum backoff, in seconds")
+    parser.add_option("", "--min-backoff", type="int", default=60,
+                      help="Shortest backoff time, in seconds")
+    parser.add_option("", "--max-backoff", type="int", default=1800,
+                      help="Longest backoff time, in seconds")
+    parser.add_option("", "--latency-window", type="int", default=10,
+                      help="How many pings to grade the latency over")
     parser.add_option("", "--oneshot", action="store_true",
                       help="Run a single check and then exit")
     parser.add_option("-v", "--verbose", action="count", dest="verbosity",
@@ -294,13 +486,25 @@ def main(args=None):
 
     config_file = os.path.abspath(args[0])
 
+    if opts.latency_limit <= opts.latency_threshold:
+        parser.error("--latency-limit must be above --latency-threshold")
+    grader = HealthGrader(threshold=opts.latency_threshold,
+                          limit=opts.latency_limit,
+                          min_backoff=opts.min_backoff,
+                          max_backoff=opts.max_backoff,
+                          window=opts.latency_window)
+
     if opts.oneshot:
         check_backends(config_file,
-                       backend_timeout=opts.backend_timeout)
+                       backend_timeout=opts.backend_timeout,
+                       max_workers=opts.max_workers,
+                       grader=grader)
     else:
         monitor_backends(config_file,
                          check_interval=opts.check_interval,
-                         backend_timeout=opts.backend_timeout)
+                         backend_timeout=opts.backend_timeout,
+                         max_workers=opts.max_workers,
+                         grader=grader)
     return 0
 
 
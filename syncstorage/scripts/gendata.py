@@ -0,0 +1,453 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Synthetic dataset generator for SyncStorage.
+
+This script bulk-loads the data of many users in an SQL storage, to
+benchmark index or sharding changes against realistic volumes.  Each user
+gets the records every client has (meta/global, crypto/keys, clients and
+prefs), plus a number of items drawn from a Zipf-like distribution, spread
+over the collections according to their weights (mostly history, then
+bookmarks).  Payload sizes follow a log-normal distribution around a
+median that depends on the collection.
+
+The users are split in partitions, one per shard of the WBO table (or
+--workers partitions if the storage is not sharded), which are loaded by
+parallel writers using multi-row inserts.  The progress of each partition
+is committed in the same transaction as its data, so an interrupted run
+can be resumed by running the same command again.  The data of a user
+only depends on --seed, on its id and on the time the run started, which
+is saved along with the progress (or given with --now), so a resumed run
+loads the same data as an uninterrupted one.
+
+Run it like so::
+
+  python gendata.py --users 1000000 --workers 8 \\
+                    --config /etc/mozilla-services/sync.conf --host sync1
+
+or, to load a database directly::
+
+  python gendata.py --users 1000 --shardsize 10 sqlite:////tmp/data.db
+
+The rows are written straight to the database: the caches of a memcached
+storage are not updated.
+"""
+
+import os
+import sys
+import time
+import math
+import base64
+import random
+import logging
+import optparse
+import threading
+import Queue
+
+from sqlalchemy import Table, Column, Integer, MetaData
+from sqlalchemy.sql import text as sqltext, select
+
+from services.util import round_time, time2bigint
+
+from syncstorage.storage.sql import SQLStorage
+from syncstorage.wsgiapp import make_app
+
+logger = logging.getLogger("syncstorage.scripts.gendata")
+
+# The relative number of items of the collections.
+DEFAULT_WEIGHTS = 'history=55,bookmarks=25,forms=12,passwords=4,addons=4'
+
+# The median payload size of the items of each collection, in bytes.
+PAYLOAD_MEDIANS = {'history': 350, 'bookmarks': 450, 'forms': 200,
+                   'passwords': 650, 'addons': 300, 'prefs': 3500,
+                   'clients': 400, 'meta': 250, 'crypto': 500}
+DEFAULT_PAYLOAD_MEDIAN = 400
+PAYLOAD_SIGMA = 0.6
+
+# The ids of the records every client has.
+SINGLETONS = (('meta', 'global'), ('crypto', 'keys'), ('prefs', None))
+
+# The items are modified over the last year.
+MODIFIED_SPAN = 365 * 24 * 3600
+
+# The columns filled by the inserts.
+FIELDS = ('id', 'username', 'collection', 'sortindex', 'modified',
+          'payload', 'payload_size', 'ttl')
+
+MAX_TTL = 2100000000
+
+_metadata = MetaData()
+
+progress = Table('gendata_progress', _metadata,
+                 Column('partition', Integer, primary_key=True,
+                        autoincrement=False),
+                 Column('last_user', Integer, nullable=False))
+
+# The time the items are modified before, kept for the resumed runs.
+start = Table('gendata_start', _metadata,
+              Column('now', Integer, nullable=False))
+
+# Payloads are slices of this, which looks as random as encrypted data.
+# It is the same in every run.
+_rand = random.Random(0)
+_NOISE = base64.b64encode(''.join([chr(_rand.getrandbits(8))
+                                   for i in xrange(3 * 64 * 1024)]))
+del _rand
+
+_ID_CHARS = ('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+             '0123456789-_')
+
+
+def parse_weights(value):
+    """Parses a "name=weight,..." string into a list of (name, weight)."""
+    weights = []
+    for part in value.split(','):
+        name, weight = part.split('=')
+        weights.append((name.strip(), float(weight)))
+    return weights
+
+
+class UserGenerator(object):
+    """Generates the items of the users.
+
+    The number of items of a user beyond the singletons follows a Pareto
+    distribution of shape alpha starting at min_items, capped at
+    max_items: most users have a few items, and a few have a lot.  Their
+    modification times are spread over the year before now.
+    """
+
+    def __init__(self, weights, min_items=10, max_items=50000, alpha=1.2,
+                 seed=0, now=None):
+        self.collections = [name for name, weight in weights]
+        total = sum(weight for name, weight in weights)
+        self.cumulative = []
+        running = 0
+        for name, weight in weights:
+            running += weight / total
+            self.cumulative.append(running)
+        self.min_items = min_items
+        self.max_items = max_items
+        self.alpha = alpha
+        self.seed = seed
+        if now is None:
+            now = time.time()
+        self.now = now
+
+    def _random(self, user_id):
+        return random.Random(self.seed * 1000003 + user_id)
+
+    def _pick_collection(self, rand):
+        value = rand.random()
+        for name, bound in zip(self.collections, self.cumulative):
+            if value < bound:
+                return name
+        return self.collections[-1]
+
+    def _payload_size(self, rand, collection):
+        median = PAYLOAD_MEDIANS.get(collection, DEFAULT_PAYLOAD_MEDIAN)
+        size = int(rand.lognormvariate(math.log(median), PAYLOAD_SIGMA))
+        return max(min(size, len(_NOISE)), 1)
+
+    def _item(self, rand, collection, item_id=None):
+        if item_id is None:
+            item_id = ''.join(rand.choice(_ID_CHARS) for i in range(12))
+        size = self._payload_size(rand, collection)
+        offset = rand.randint(0, len(_NOISE) - size)
+        modified = self.now - rand.random() * MODIFIED_SPAN
+        return {'id': item_id, 'sortindex': rand.randint(0, 1000),
+                'modified': time2bigint(round_time(modified)),
+                'payload': _NOISE[offset:offset + size],
+                'payload_size': size, 'ttl': MAX_TTL}
+
+    def items(self, user_id):
+        """Yields the (collection, item) pairs of the given user."""
+        rand = self._random(user_id)
+        count = int(self.min_items * rand.paretovariate(self.alpha))
+        count = min(count, self.max_items)
+
+        for collection, item_id in SINGLETONS:
+            yield collection, self._item(rand, collection, item_id)
+        for i in range(rand.randint(1, 3)):
+            yield 'clients', self._item(rand, 'clients')
+        for i in xrange(count):
+            collection = self._pick_collection(rand)
+            yield collection, self._item(rand, collection)
+
+
+class Loader(object):
+    """Loads the generated users in a storage, in parallel.
+
+    The time the items are modified before is given by now if it is not
+    None, and by the run being resumed otherwise.  It is set on the
+    generator.
+    """
+
+    def __init__(self, storage, generator, first_user, users, workers=4,
+                 batch_size=100, now=None):
+        if not isinstance(storage, SQLStorage):
+            raise ValueError("Can only load data in an SQL storage")
+        self.storage = storage
+        self.generator = generator
+        self.first_user = first_user
+        self.last_user = first_user + users - 1
+        self.workers = workers
+        # sqlite does not accept more than 999 parameters per query.
+        if storage.engine_name == 'sqlite':
+            batch_size = min(batch_size, 999 // len(FIELDS))
+        self.batch_size = batch_size
+        if storage.shard:
+            self.partitions = int(storage.shardsize)
+        else:
+            self.partitions = workers
+        self.rows = 0
+        self.users = 0
+        self.errors = []
+        self._lock = threading.Lock()
+
+        progress.create(storage._engine, checkfirst=True)
+        start.create(storage._engine, checkfirst=True)
+        generator.now = self._load_now(now)
+
+    def _load_now(self, now):
+        saved = self.storage._do_query_fetchone(select([start.c.now]))
+        if saved is None:
+            if now is None:
+                now = int(time.time())
+            self.storage._do_query(start.insert().values(now=int(now)))
+        elif now is None:
+            now = saved[0]
+        return now
+
+    def _load_progress(self):
+        query = select([progress.c.partition, progress.c.last_user])
+        return dict(self.storage._do_query_fetchall(query))
+
+    def _users(self, partition, last_done):
+        """Yields the ids of the users of the partition left to load."""
+        start = max(self.first_user, last_done + 1)
+        start += (partition - start) % self.partitions
+        return xrange(start, self.last_user + 1, self.partitions)
+
+    def _insert(self, connection, table, rows):
+        binds = ','.join(':%s%%(num)d' % field for field in FIELDS)
+        lines = []
+        params = {}
+        for num, row in enumerate(rows):
+            lines.append('(%s)' % (binds % {'num': num}))
+            for field in FIELDS:
+                params['%s%d' % (field, num)] = row[field]
+        query = 'insert into %s (%s) values %s' % (table, ','.join(FIELDS),
+                                                   ','.join(lines))
+        connection.execute(sqltext(query), **params)
+
+    def _commit(self, partition, rows, user_id, known):
+        """Writes the rows and the progress of the partition atomically."""
+        storage = self.storage
+        with storage._transaction() as connection:
+            for table, table_rows in rows.iteritems():
+                for i in xrange(0, len(table_rows), self.batch_size):
+                    self._insert(connection, table,
+                                 table_rows[i:i + self.batch_size])
+            if known:
+                connection.execute(progress.update().where(
+                    progress.c.partition == partition).values(
+                    last_user=user_id))
+            else:
+                connection.execute(progress.insert().values(
+                    partition=partition, last_user=user_id))
+        count = sum(len(table_rows) for table_rows in rows.itervalues())
+        with self._lock:
+            self.rows += count
+
+    def load_partition(self, partition, last_done=None):
+        """Loads the users of the partition, resuming after last_done."""
+        storage = self.storage
+        known = last_done is not None
+        if last_done is None:
+            last_done = self.first_user - 1
+
+        rows = {}
+        pending = 0
+        user_id = None
+        for user_id in self._users(partition, last_done):
+            table = storage._get_wbo_table(user_id).name
+            for collection, item in self.generator.items(user_id):
+                item['username'] = user_id
+                item['collection'] = storage._get_collection_id(user_id,
+                                                                collection)
+                rows.setdefault(table, []).append(item)
+                pending += 1
+            # forget the collection ids of the user, we're done with it.
+            storage._purge_cache(user_id)
+            with self._lock:
+                self.users += 1
+
+            # users are never split across transactions.
+            if pending >= self.batch_size * 10:
+                self._commit(partition, rows, user_id, known)
+                known = True
+                rows = {}
+                pending = 0
+
+        if pending:
+            self._commit(partition, rows, user_id, known)
+
+    def _worker(self, partitions, done):
+        while True:
+            try:
+                partition = partitions.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                self.load_partition(partition, done.get(partition))
+            except Exception, e:
+                logger.exception("Failed to load partition %d", partition)
+                with self._lock:
+                    self.errors.append((partition, e))
+
+    def run(self, report_interval=10):
+        """Loads all the users, reporting the progress as it goes.
+
+        Returns the number of rows written.
+        """
+        done = self._load_progress()
+        partitions = Queue.Queue()
+        for partition in range(self.partitions):
+            last_done = done.get(partition, self.first_user - 1)
+            if self._users(partition, last_done):
+                partitions.put(partition)
+        if done:
+            logger.info("Resuming: %d partitions left to load",
+                        partitions.qsize())
+
+        threads = []
+        for i in range(min(self.workers, partitions.qsize())):
+            thread = threading.Thread(target=self._worker,
+                                      args=(partitions, done))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        start = time.time()
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(report_interval)
+                if thread.is_alive():
+                    break
+            elapsed = time.time() - start
+            logger.info("%d users, %d rows in %ds (%d rows/s)", self.users,
+                        self.rows, elapsed, self.rows / max(elapsed, 0.001))
+        return self.rows
+
+
+def load_storage(opts, sqluri):
+    """Returns the storage to load, from the command-line options."""
+    if opts.config is not None:
+        # loaded like paster would, to get the same storages as the app.
+        global_conf = {'here': os.path.dirname(os.path.abspath(opts.config))}
+        app = make_app(global_conf, configuration='file:' + opts.config).app
+        if opts.host is None:
+            return app.storages['default']
+        return app.storages[opts.host]
+    return SQLStorage(sqluri, create_tables=True,
+                      fixed_collections=True,
+                      shard=bool(opts.shardsize),
+                      shardsize=opts.shardsize or 100)
+
+
+def main(args=None):
+    """Main entry-point for running this script."""
+    usage = "usage: %prog [options] [sqluri]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--config", default=None,
+                      help="Config file of the app whose storage to load")
+    parser.add_option("", "--host", default=None,
+                      help="Host whose storage to load, with --config")
+    parser.add_option("", "--shardsize", type="int", default=0,
+                      help="Number of WBO shards, for an sqluri (0: none)")
+    parser.add_option("", "--users", type="int", default=1000,
+                      help="Number of users to load")
+    parser.add_option("", "--first-user", type="int", default=1,
+                      help="Id of the first user to load")
+    parser.add_option("", "--min-items", type="int", default=10,
+                      help="Minimum number of items per user")
+    parser.add_option("", "--max-items", type="int", default=50000,
+                      help="Maximum number of items per user")
+    parser.add_option("", "--alpha", type="float", default=1.2,
+                      help="Shape of the distribution of the user sizes")
+    parser.add_option("", "--weights", default=DEFAULT_WEIGHTS,
+                      help="Relative sizes of the collections")
+    parser.add_option("", "--seed", type="int", default=0,
+                      help="Seed of the generated data")
+    parser.add_option("", "--now", type="int", default=None,
+                      help="Time the items are modified before (default: "
+                           "the start of the run being resumed)")
+    parser.add_option("", "--workers", type="int", default=4,
+                      help="Number of parallel writers")
+    parser.add_option("", "--batch-size", type="int", default=100,
+                      help="Number of rows per insert")
+    parser.add_option("-v", "--verbose", action="count", dest="verbosity",
+                      help="Control verbosity of log messages")
+
+    opts, args = parser.parse_args(args)
+    if (len(args) == 1) == (opts.config is not None) or len(args) > 1:
+        parser.print_usage()
+        return 1
+    if opts.alpha <= 1:
+        parser.error("--alpha must be greater than 1")
+
+    if opts.verbosity is None:
+        opts.verbosity = 1
+    loglevel = (logging.WARNING, logging.INFO)[min(opts.verbosity, 1)]
+    logging.basicConfig(level=loglevel,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+    storage = load_storage(opts, args and args[0] or None)
+    generator = UserGenerator(parse_weights(opts.weights), opts.min_items,
+                              opts.max_items, opts.alpha, opts.seed)
+    loader = Loader(storage, generator, opts.first_user, opts.users,
+                    opts.workers, opts.batch_size, opts.now)
+    loader.run()
+    if loader.errors:
+        logger.error("%d partitions failed, run again to resume",
+                     len(loader.errors))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,401 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+
+Replays a trace of requests against the storage app.
+
+The trace is a file of JSON lines, one per request::
+
+  {"time": 0.25, "method": "POST", "user": "cuser12",
+   "path": "/1.1/cuser12/storage/history", "body": {"items": 10,
+   "payload": 200}}
+
+"time" is the offset of the request from the start of the trace, in
+seconds.  "body" is the shape of the body to send: a batch of "items" WBOs
+for POST, or a single WBO for PUT, with payloads of "payload" bytes.
+
+The app is either loaded in-process from its config file, or reached over
+HTTP with --url.  Requests are sent at the times of the trace, scaled by
+--speed, or at a fixed --rate per second, whether or not the previous ones
+have completed.  Their latency is measured from the time they were due to
+be sent, so that the delays caused by a saturated server are not hidden
+(the "coordinated omission" problem).  The time spent by the server alone
+is reported as the service time.
+
+Run it like so::
+
+  python replay.py --synthesize 1000 --users 50 > trace.json
+  python replay.py --config /etc/mozilla-services/sync.conf \\
+                   --create-users --workers 10 trace.json
+
+"""
+
+import os
+import sys
+import time
+import base64
+import random
+import httplib
+import urlparse
+import optparse
+import threading
+import Queue
+from collections import defaultdict
+
+import simplejson as json
+from webob import Request
+
+from syncstorage.dispatch import Dispatcher
+from syncstorage.wsgiapp import make_app, urls
+
+VERSION = '1.1'
+
+COLLECTIONS = ['bookmarks', 'forms', 'passwords', 'history', 'prefs']
+
+# The distributions of the number of requests of each kind per session,
+# as in loadtest/stress.py.
+METAGLOBAL_COUNT_DISTRIBUTION = [40, 60, 0, 0, 0]
+GET_COUNT_DISTRIBUTION = [71, 15, 7, 4, 3]
+POST_COUNT_DISTRIBUTION = [67, 18, 9, 4, 2]
+DELETE_COUNT_DISTRIBUTION = [99, 1, 0, 0, 0]
+DELETEALL_PROBABILITY = 1 / 100.
+
+
+def _pick_weighted_count(weights):
+    i = random.randint(1, sum(weights))
+    count = 0
+    base = 0
+    for weight in weights:
+        base += weight
+        if i <= base:
+            break
+        count += 1
+    return count
+
+
+def synthesize_session(username):
+    """Returns the requests of a sync session, like the ones of stress.py."""
+    prefix = '/%s/%s' % (VERSION, username)
+    requests = [('GET', prefix + '/info/collections', None)]
+    for i in range(_pick_weighted_count(METAGLOBAL_COUNT_DISTRIBUTION)):
+        requests.append(('GET', prefix + '/storage/meta/global', None))
+    count = _pick_weighted_count(GET_COUNT_DISTRIBUTION)
+    for collection in random.sample(COLLECTIONS, count):
+        newer = int(time.time() - random.randint(3600, 360000))
+        requests.append(('GET', '%s/storage/%s?full=1&newer=%d'
+                         % (prefix, collection, newer), None))
+    count = _pick_weighted_count(POST_COUNT_DISTRIBUTION)
+    for collection in random.sample(COLLECTIONS, count):
+        body = {'items': 10, 'payload': len(username) *
+                                        random.randint(50, 200)}
+        requests.append(('POST', '%s/storage/%s' % (prefix, collection),
+                         body))
+    count = _pick_weighted_count(DELETE_COUNT_DISTRIBUTION)
+    if count:
+        for collection in random.sample(COLLECTIONS, count):
+            requests.append(('DELETE', '%s/storage/%s' % (prefix, collection),
+                             None))
+    elif random.random() <= DELETEALL_PROBABILITY:
+        requests.append(('DELETE', prefix + '/storage', None))
+    return requests
+
+
+def synthesize(count, users, rate):
+    """Yields a trace of count requests from sessions of random users."""
+    sent = 0
+    while sent < count:
+        username = 'cuser%d' % random.randint(1, users)
+        for method, path, body in synthesize_session(username):
+            yield {'time': sent / float(rate), 'method': method,
+                   'path': path, 'user': username, 'body': body}
+            sent += 1
+            if sent == count:
+                break
+
+
+def load_trace(path):
+    """Reads a trace file."""
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def make_body(shape):
+    """Builds a body of the given shape."""
+    if shape is None:
+        return ''
+
+    def _wbo():
+        return {'id': base64.urlsafe_b64encode(os.urandom(9)),
+                'payload': 'x' * shape.get('payload', 100)}
+
+    if 'items' in shape:
+        return json.dumps([_wbo() for i in range(shape['items'])])
+    return json.dumps(_wbo())
+
+
+class WSGITarget(object):
+    """Sends the requests to an in-process app."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def send(self, method, path, headers, body):
+        request = Request.blank(path, method=method, headers=headers)
+        if body:
+            request.body = body
+        return request.get_response(self.app).status_int
+
+
+class HTTPTarget(object):
+    """Sends the requests to a server, with one connection per thread."""
+
+    def __init__(self, url):
+        self.url = urlparse.urlparse(url)
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self.url.scheme == 'https':
+                conn = httplib.HTTPSConnection(self.url.netloc)
+            else:
+                conn = httplib.HTTPConnection(self.url.netloc)
+            self._local.conn = conn
+        return conn
+
+    def send(self, method, path, headers, body):
+        conn = self._connection()
+        try:
+            conn.request(method, self.url.path.rstrip('/') + path, body,
+                         headers)
+            response = conn.getresponse()
+            response.read()
+            return response.status
+        except Exception:
+            conn.close()
+            self._local.conn = None
+            raise
+
+
+class Replayer(object):
+    """Sends the requests of a trace at their due time.
+
+    The requests are sent by a pool of worker threads.  The latency of each
+    request is measured from its due time, and its service time from the
+    time it was actually sent.
+    """
+
+    def __init__(self, target, workers=10, password='password'):
+        self.target = target
+        self.workers = workers
+        self.password = password
+        self.dispatcher = Dispatcher(urls)
+        self.latencies = defaultdict(list)
+        self.service_times = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def endpoint(self, method, path):
+        """Returns the name of the endpoint of a request."""
+        match = self.dispatcher.match(method, path.split('?')[0].rstrip('/'))
+        if match is None:
+            return '%s unknown' % method
+        return '%s %s' % (method, match[0]['action'])
+
+    def _send(self, request, due):
+        headers = {'Authorization': 'Basic ' + base64.b64encode(
+                        '%s:%s' % (request['user'], self.password))}
+        method = request['method']
+        if method in ('PUT', 'POST'):
+            headers['Content-Type'] = 'application/json'
+        if method == 'DELETE':
+            headers['X-Confirm-Delete'] = 'true'
+        body = make_body(request.get('body'))
+        endpoint = self.endpoint(method, request['path'])
+
+        start = time.time()
+        try:
+            status = self.target.send(method, request['path'], headers, body)
+        except Exception:
+            status = None
+        end = time.time()
+
+        with self._lock:
+            self.latencies[endpoint].append(end - due)
+            self.service_times[endpoint].append(end - start)
+            if status is None or status >= 500:
+                self.errors[endpoint] += 1
+
+    def _work(self, tasks):
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            self._send(*task)
+
+    def run(self, trace, speed=1.0, rate=None):
+        """Replays the trace, and returns its duration."""
+        tasks = Queue.Queue()
+        threads = [threading.Thread(target=self._work, args=(tasks,))
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        start = time.time()
+        try:
+            for index, request in enumerate(trace):
+                if rate is not None:
+                    offset = index / float(rate)
+                else:
+                    offset = request.get('time', 0) / speed
+                due = start + offset
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                tasks.put((request, due))
+        finally:
+            for thread in threads:
+                tasks.put(None)
+            for thread in threads:
+                thread.join()
+        return time.time() - start
+
+    def report(self):
+        """Returns the statistics of each endpoint."""
+        res = {}
+        for endpoint, latencies in self.latencies.iteritems():
+            latencies = sorted(latencies)
+            service_times = sorted(self.service_times[endpoint])
+            res[endpoint] = {
+                'count': len(latencies),
+                'errors': self.errors[endpoint],
+                'p50': _percentile(latencies, 0.5),
+                'p95': _percentile(latencies, 0.95),
+                'p99': _percentile(latencies, 0.99),
+                'service_p50': _percentile(service_times, 0.5),
+                'service_p99': _percentile(service_times, 0.99),
+            }
+        return res
+
+
+def _percentile(samples, fraction):
+    return samples[int(round(fraction * (len(samples) - 1)))]
+
+
+def load_app(config_file):
+    """Loads the app from its config file, like paster would."""
+    global_conf = {'here': os.path.dirname(os.path.abspath(config_file))}
+    return make_app(global_conf, configuration='file:' + config_file)
+
+
+def create_users(app, trace, password):
+    """Creates the users of the trace in the auth backend of the app."""
+    backend = app.app.auth.backend
+    for username in set(request['user'] for request in trace):
+        if not backend.get_user_id(username):
+            backend.create_user(username, password,
+                                '%s@example.com' % username)
+
+
+def main(args=None):
+    """Main entry-point for running this script."""
+    usage = "usage: %prog [options] [trace_file]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("", "--config", default=None,
+                      help="Config file of the app to load in-process")
+    parser.add_option("", "--url", default=None,
+                      help="URL of a server to send the requests to")
+    parser.add_option("", "--workers", type="int", default=10,
+                      help="How many requests can be sent concurrently")
+    parser.add_option("", "--speed", type="float", default=1.0,
+                      help="Speed factor applied to the times of the trace")
+    parser.add_option("", "--rate", type="float", default=None,
+                      help="Send requests at this fixed rate per second")
+    parser.add_option("", "--password", default="password",
+                      help="Password of the users")
+    parser.add_option("", "--create-users", action="store_true",
+                      help="Create the users of the trace in-process")
+    parser.add_option("", "--synthesize", type="int", default=None,
+                      help="Print a synthetic trace of that many requests")
+    parser.add_option("", "--users", type="int", default=1000,
+                      help="Number of users in the synthetic trace")
+    parser.add_option("", "--output", default=None,
+                      help="File to write the JSON results to")
+
+    opts, args = parser.parse_args(args)
+
+    if opts.synthesize is not None:
+        for request in synthesize(opts.synthesize, opts.users,
+                                  opts.rate or 10):
+            print json.dumps(request)
+        return 0
+
+    if len(args) != 1 or (opts.config is None) == (opts.url is None):
+        parser.print_usage()
+        return 1
+
+    trace = load_trace(args[0])
+    if opts.config is not None:
+        app = load_app(opts.config)
+        if opts.create_users:
+            create_users(app, trace, opts.password)
+        target = WSGITarget(app)
+    else:
+        target = HTTPTarget(opts.url)
+
+    replayer = Replayer(target, opts.workers, opts.password)
+    duration = replayer.run(trace, opts.speed, opts.rate)
+    report = replayer.report()
+
+    print '%d requests in %.1fs' % (len(trace), duration)
+    print '%-28s %7s %6s %9s %9s %9s %11s' % ('endpoint', 'count', 'errors',
+                                               'p50', 'p95', 'p99',
+                                               'service p99')
+    for endpoint, stats in sorted(report.iteritems()):
+        print '%-28s %7d %6d %8.1fms %8.1fms %8.1fms %10.1fms' % (
+            endpoint, stats['count'], stats['errors'], stats['p50'] * 1000,
+            stats['p95'] * 1000, stats['p99'] * 1000,
+            stats['service_p99'] * 1000)
+
+    if opts.output is not None:
+        with open(opts.output, 'w') as f:
+            json.dump({'duration': duration, 'endpoints': report}, f,
+                      indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
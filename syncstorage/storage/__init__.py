@@ -391,7 +391,7 @@ def get_storage(config):
 
     - "storage.backend" must be present and contain a fully qualified name of a
       backend class to be used, or the name of any backend synccore provides.
-      "sql" or "memcachedsql".
+      "sql", "memcachedsql" or "localcachedsql".
 
     - other keys that starts with "storage." are passed to the backend
       constructor -- with the prefix stripped.
@@ -0,0 +1,189 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Circuit breaker for the backends.
+
+When a backend is down, every call to it waits for a timeout before
+failing.  A CircuitBreaker counts the consecutive failures of the calls
+made through it, and once there are max_failures of them it "opens": the
+calls fail immediately with a CircuitOpenError for reset_timeout seconds.
+
+After that the breaker is "half-open": a single thread is let through to
+probe the backend.  If its call succeeds the breaker closes again,
+otherwise it stays open for another reset_timeout seconds.
+"""
+import time
+import thread
+import threading
+from contextlib import contextmanager
+
+from metlog.holder import CLIENT_HOLDER
+
+from services.util import BackendError
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(BackendError):
+    """Raised when a call is not attempted because the breaker is open."""
+
+    def __init__(self, name, retry_after=None):
+        BackendError.__init__(self, '%s is unavailable' % name)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker(object):
+    """Stops calling a backend that keeps failing.
+
+    Only the exceptions listed in errors count as failures.  on_close is
+    called without arguments when the breaker closes after being open.
+    """
+
+    def __init__(self, name, max_failures=5, reset_timeout=30,
+                 errors=(BackendError,), on_close=None):
+        self.name = name
+        self.max_failures = int(max_failures)
+        self.reset_timeout = float(reset_timeout)
+        self.errors = errors
+        self.on_close = on_close
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probe = None
+        self._lock = threading.Lock()
+
+    @property
+    def logger(self):
+        return CLIENT_HOLDER.default_client
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and self._cooled_down():
+                return HALF_OPEN
+            return self._state
+
+    def _cooled_down(self):
+        return time.time() - self._opened_at >= self.reset_timeout
+
+    def retry_after(self):
+        """Returns the number of seconds before the next probe."""
+        with self._lock:
+            if self._state == CLOSED:
+                return 0
+            return max(0, self._opened_at + self.reset_timeout - time.time())
+
+    def _set_state(self, state):
+        # must be called with the lock held
+        self._state = state
+        self.logger.incr('syncstorage.storage.breaker.%s.%s' % (self.name,
+                                                                state))
+        self.logger.metlog('breaker', payload=state,
+                           fields={'name': self.name, 'state': state})
+
+    def allow(self):
+        """Returns True if a call can be attempted by the current thread."""
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                if not self._cooled_down():
+                    return False
+                self._set_state(HALF_OPEN)
+                self._probe = None
+
+            # half-open: only the thread that probes the backend gets
+            # through.  A probe that takes too long is replaced.
+            now = time.time()
+            if self._probe is None or now - self._probe[1] > \
+                    self.reset_timeout:
+                self._probe = thread.get_ident(), now
+                return True
+            return self._probe[0] == thread.get_ident()
+
+    def available(self):
+        """Returns True if allow() would let the current thread through.
+
+        Unlike allow(), this doesn't claim the probe of a half-open breaker.
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                return self._cooled_down()
+            return (self._probe is None or
+                    time.time() - self._probe[1] > self.reset_timeout or
+                    self._probe[0] == thread.get_ident())
+
+    def success(self):
+        """Records a successful call."""
+        with self._lock:
+            self._failures = 0
+            if self._state == CLOSED:
+                return
+            self._set_state(CLOSED)
+            self._probe = None
+        if self.on_close is not None:
+            self.on_close()
+
+    def failure(self):
+        """Records a failed call."""
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or (self._state == CLOSED and
+                    self._failures >= self.max_failures):
+                self._set_state(OPEN)
+                self._opened_at = time.time()
+                self._probe = None
+
+    @contextmanager
+    def call(self):
+        """Runs the block if the breaker allows it.
+
+        Raises a CircuitOpenError otherwise.
+        """
+        if not self.allow():
+            self.logger.incr('syncstorage.storage.breaker.%s.rejected'
+                             % self.name)
+            raise CircuitOpenError(self.name, self.retry_after())
+        try:
+            yield
+        except self.errors:
+            self.failure()
+            raise
+        self.success()
@@ -0,0 +1,193 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Process-wide budget of database connections.
+
+Each SQLStorage has its own connection pool, so a process serving many
+nodes can open many times pool_size + pool_max_overflow connections.  A
+ConnectionBudget caps the number of connections opened by all the pools
+that share it.
+
+Each host is guaranteed min_per_host connections.  Above that, hosts
+borrow from the capacity nobody uses.  When the budget is exhausted, a host
+gets its connection by closing an idle connection of another host: of a
+host above its minimum if it is below its own, and otherwise of a host
+above its fair share of the budget, so that the idle connections a host
+keeps after a burst don't hold the budget forever.
+"""
+import threading
+import weakref
+from collections import defaultdict
+
+from metlog.holder import CLIENT_HOLDER
+
+_BUDGET = None
+_BUDGET_LOCK = threading.Lock()
+
+
+def get_connection_budget(max_connections, min_per_host=0):
+    """Returns the process-wide budget, creating it if needed.
+
+    The budget is created by the first call.  The arguments of the later
+    calls are ignored.
+    """
+    global _BUDGET
+    with _BUDGET_LOCK:
+        if _BUDGET is None:
+            _BUDGET = ConnectionBudget(max_connections, min_per_host)
+        return _BUDGET
+
+
+class ConnectionBudget(object):
+    """Limits the number of connections opened by a set of pools.
+
+    The pools call acquire() before opening a connection, and release()
+    after closing it.  A pool can also be asked to give one of its idle
+    connections back through its close_idle() method.
+    """
+
+    def __init__(self, max_connections, min_per_host=0):
+        self.max_connections = int(max_connections)
+        self.min_per_host = int(min_per_host)
+        self.total = 0
+        self._used = defaultdict(int)
+        self._pools = defaultdict(weakref.WeakKeyDictionary)
+        self._refs = set()
+        # re-entrant, as a pool may be garbage collected while it is held.
+        self._lock = threading.RLock()
+
+    @property
+    def logger(self):
+        return CLIENT_HOLDER.default_client
+
+    def utilization(self):
+        """Returns a dict mapping each host to its number of connections."""
+        with self._lock:
+            return dict((key, used) for key, used in self._used.iteritems()
+                        if used)
+
+    def acquire(self, pool, key):
+        """Reserves a connection for the given pool.
+
+        Returns False if the budget is exhausted.
+        """
+        with self._lock:
+            if self.total < self.max_connections:
+                return self._grant(pool, key)
+            victims = self._victims(key)
+
+        # Take an idle connection from the others.  This is done without
+        # the lock, as closing the connection needs the lock of the
+        # victim's pool.
+        for victim in victims:
+            if victim.close_idle():
+                self.logger.incr('syncstorage.storage.budget.reclaimed')
+                with self._lock:
+                    if self.total < self.max_connections:
+                        return self._grant(pool, key)
+        return False
+
+    def _grant(self, pool, key):
+        # must be called with the lock held
+        self._count(pool, key)[0] += 1
+        self._used[key] += 1
+        self.total += 1
+        self._report(key, self._used[key])
+        return True
+
+    def release(self, pool, key, count=1):
+        """Gives back count connections of the given pool."""
+        with self._lock:
+            held = self._count(pool, key)
+            count = min(count, held[0])
+            held[0] -= count
+            used = self._release(key, count)
+        self._report(key, used)
+
+    def _count(self, pool, key):
+        # The number of connections held by a pool is kept in a list, which
+        # outlives the pool so that its connections can be given back when
+        # the pool is garbage collected.
+        pools = self._pools[key]
+        held = pools.get(pool)
+        if held is None:
+            held = pools[pool] = [0]
+
+            def forget(ref):
+                with self._lock:
+                    self._refs.discard(ref)
+                    used = self._release(key, held[0])
+                    held[0] = 0
+                self._report(key, used)
+
+            self._refs.add(weakref.ref(pool, forget))
+        return held
+
+    def _release(self, key, count):
+        # must be called with the lock held
+        self._used[key] -= count
+        self.total -= count
+        return self._used[key]
+
+    def _victims(self, key):
+        # must be called with the lock held.  Returns the pools of the hosts
+        # above their minimum if the host is below its own, and otherwise
+        # the pools of the hosts above their fair share, starting with the
+        # one that exceeds it most.  Hosts at their fair share are left
+        # alone, so that busy hosts don't take connections from each other
+        # back and forth.
+        if self._used[key] < self.min_per_host:
+            floor = self.min_per_host
+        else:
+            hosts = set([other for other, used in self._used.iteritems()
+                         if used])
+            hosts.add(key)
+            floor = max(self.min_per_host,
+                        self.max_connections // len(hosts))
+        excess = [(used - floor, other)
+                  for other, used in self._used.iteritems()
+                  if other != key and used > floor]
+        victims = []
+        for _, other in sorted(excess, reverse=True):
+            victims.extend(self._pools[other].keys())
+        return victims
+
+    def _report(self, key, used):
+        self.logger.metlog('gauge', payload=str(used),
+                           fields={'name': 'syncstorage.storage.budget',
+                                   'host': key,
+                                   'utilization': float(used) /
+                                                  self.max_connections})
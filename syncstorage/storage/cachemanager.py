@@ -41,8 +41,11 @@ Memcached + SQL backend
 - The meta/global wbo is stored in "user_id"
 - The info/collections timestamp mapping is stored in "user_id:stamps"
 """
+import time
 import thread
 import threading
+import Queue
+from contextlib import contextmanager
 
 from pylibmc import Client, NotFound, ThreadMappedPool
 from pylibmc import Error as MemcachedError
@@ -51,27 +54,67 @@ from metlog.decorators.stats import timeit as metlog_timeit
 from metlog.holder import CLIENT_HOLDER
 
 from services.util import BackendError
-from services.events import REQUEST_ENDS, subscribe
+from services.events import REQUEST_ENDS, subscribe, unsubscribe
 
+from syncstorage import requeststats
 from syncstorage.storage.sql import _KB
+from syncstorage.storage.breaker import CircuitBreaker, OPEN
 
-USER_KEYS = ('size', 'size:ts', 'meta:global', 'tabs', 'stamps')
+# Read-modify-write operations are done with gets/cas and retried this
+# many times before giving up.
+MAX_CAS_RETRIES = 10
+
+# Number of in-process locks used to serialize read-modify-write operations.
+# Keys are spread over the stripes so that unrelated users don't contend.
+LOCK_STRIPES = 64
+
+# When a key is missing, only one client refills it.  It holds a lease for
+# at most LEASE_TTL seconds, and the others wait for at most LEASE_WAIT
+# seconds, polling every LEASE_POLL seconds.  A copy of the refilled value
+# is kept for STALE_GRACE seconds and served to them in the meantime.
+LEASE_TTL = 10
+LEASE_WAIT = 2.
+LEASE_POLL = 0.05
+STALE_GRACE = 30
 
 
 def _key(*args):
     return ':'.join([str(arg) for arg in args])
 
 
+def _new_generation():
+    # Generations start at the current time in milliseconds, so a user
+    # whose generation key was evicted can't get back an older one, and
+    # see the data cached under it.
+    return int(time.time() * 1000)
+
+
 class CacheManager(object):
     """ Helpers on the top of pylibmc
     """
     def __init__(self, *args, **kw):
+        self.breaker = CircuitBreaker(kw.pop('breaker_name', 'memcached'),
+                                      kw.pop('breaker_max_failures', 5),
+                                      kw.pop('breaker_reset_timeout', 30),
+                                      on_close=self._recovered)
+        # gets/cas support must be switched on explicitly.
+        behaviors = kw.setdefault('behaviors', {})
+        behaviors['cas'] = True
         self._client = Client(*args, **kw)
         self.pool = ThreadMappedPool(self._client)
-        # using a locker to avoid race conditions
-        # when several clients for the same user
-        # get/set the cached data
-        self._locker = threading.RLock()
+        # Consistency across processes is ensured by gets/cas, but we also
+        # use striped locks to avoid useless cas retries when several
+        # threads of this process update the same key.
+        self._locks = [threading.RLock() for i in range(LOCK_STRIPES)]
+        # keys being refilled by a thread of this process
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        # user generations read during the current request
+        self._generations = threading.local()
+        # users whose cached data could not be dropped while memcached
+        # was unreachable.  It is dropped once memcached is back.
+        self._pending_flushes = set()
+        self._pending_lock = threading.Lock()
         subscribe(REQUEST_ENDS, self._cleanup_pool)
 
     @property
@@ -82,59 +125,275 @@ class CacheManager(object):
         self.__dict__['logger'] = client
         return client
 
+    def close(self):
+        """Stops using the memcached servers."""
+        unsubscribe(REQUEST_ENDS, self._cleanup_pool)
+        self.pool.clear()
+        self._client.disconnect_all()
+
     def _cleanup_pool(self, response):
         self.pool.pop(thread.get_ident(), None)
+        self._generations.__dict__.clear()
+
+    @contextmanager
+    def _reserve(self):
+        """Yields a client, through the circuit breaker.
+
+        Memcached errors are raised as BackendErrors.
+        """
+        with self.breaker.call():
+            with self.pool.reserve() as mc:
+                start = time.time()
+                try:
+                    yield mc
+                except MemcachedError, err:
+                    # memcache seems down
+                    raise BackendError(str(err))
+                finally:
+                    requeststats.record_cache(time.time() - start)
+
+    def _recovered(self):
+        # Writes were only done in SQL while we were not using the cache,
+        # so what it holds for the users written meanwhile is outdated.
+        with self._pending_lock:
+            user_ids, self._pending_flushes = self._pending_flushes, set()
+        self.logger.error('memcached is back, flushing the cache of %d '
+                          'users' % len(user_ids))
+        for user_id in user_ids:
+            self.flush_user_cache(user_id)
 
     def flush_all(self):
-        with self.pool.reserve() as mc:
+        self._generations.__dict__.clear()
+        with self._reserve() as mc:
             mc.flush_all()
 
     @metlog_timeit
     def get(self, key):
-        with self.pool.reserve() as mc:
-            try:
-                return mc.get(key)
-            except MemcachedError, err:
-                # memcache seems down
-                raise BackendError(str(err))
+        with self._reserve() as mc:
+            return mc.get(key)
+
+    @metlog_timeit
+    def get_multi(self, keys):
+        """Returns a mapping of the keys that are set to their values."""
+        with self._reserve() as mc:
+            return mc.get_multi(keys)
 
     @metlog_timeit
     def delete(self, key):
-        with self.pool.reserve() as mc:
+        with self._reserve() as mc:
             try:
                 return mc.delete(key)
             except NotFound:
                 return False
-            except MemcachedError, err:
-                # memcache seems down
-                raise BackendError(str(err))
 
     @metlog_timeit
     def incr(self, key, size=1):
         size = int(size)
-        with self.pool.reserve() as mc:
+        with self._reserve() as mc:
             try:
                 return mc.incr(key, size)
             except NotFound:
                 return mc.set(key, size)
-            except MemcachedError, err:
-                raise BackendError(str(err))
 
     @metlog_timeit
-    def set(self, key, value):
-        with self.pool.reserve() as mc:
+    def decr(self, key, size=1):
+        """Decrements the value of key, if it is set.
+
+        memcached doesn't let the value go below zero.
+        """
+        size = int(size)
+        with self._reserve() as mc:
+            try:
+                return mc.decr(key, size)
+            except NotFound:
+                return None
+
+    @metlog_timeit
+    def set(self, key, value, time=0):
+        with self._reserve() as mc:
+            stored = mc.set(key, value, time)
+        if not stored:
+            raise BackendError()
+
+    @metlog_timeit
+    def gets(self, key):
+        """Returns a (value, cas id) tuple."""
+        with self._reserve() as mc:
+            return mc.gets(key)
+
+    @metlog_timeit
+    def cas(self, key, value, casid):
+        """Sets the value if it was not modified since the gets() call."""
+        with self._reserve() as mc:
             try:
-                if not mc.set(key, value):
-                    raise BackendError()
-            except MemcachedError, err:
-                raise BackendError(str(err))
+                return mc.cas(key, value, casid)
+            except NotFound:
+                return False
+
+    @metlog_timeit
+    def add(self, key, value, time=0):
+        """Sets the value only if the key does not exist yet."""
+        with self._reserve() as mc:
+            return mc.add(key, value, time)
 
-    def get_set(self, key, func):
+    @metlog_timeit
+    def add_multi(self, mapping, time=0):
+        """Sets the values of the keys that do not exist yet.
+
+        Returns the list of the keys that were already set.
+        """
+        with self._reserve() as mc:
+            return mc.add_multi(mapping, time)
+
+    @metlog_timeit
+    def set_multi(self, mapping, time=0):
+        with self._reserve() as mc:
+            failed = mc.set_multi(mapping, time)
+        if failed:
+            raise BackendError()
+
+    def _get_lock(self, key):
+        return self._locks[hash(key) % LOCK_STRIPES]
+
+    def update(self, key, func):
+        """Atomically applies func to the value stored in key.
+
+        func receives the current value (None if the key is not set) and
+        returns the new value, or None to leave the key untouched.  The
+        update is done with gets/cas and is retried if another client
+        modified the key in the meantime.
+
+        Returns the new value.
+        """
+        with self._get_lock(key):
+            for attempt in range(MAX_CAS_RETRIES):
+                value, casid = self.gets(key)
+                value = func(value)
+                if value is None:
+                    return None
+                if casid is None:
+                    stored = self.add(key, value)
+                else:
+                    stored = self.cas(key, value, casid)
+                if stored:
+                    return value
+                self.logger.incr('syncstorage.storage.cachemanager.'
+                                 'cas_retry')
+        raise BackendError('Too much contention on %r' % key)
+
+    def get_set(self, key, func, stale_grace=STALE_GRACE):
+        """Returns the value of key, calling func to fill it if needed.
+
+        When several clients miss the same key at once, only one of them
+        calls func.  Inside this process the other threads wait for it,
+        and across processes a lease is taken in memcache: clients that
+        don't get it serve the stale copy of the value if there's one,
+        or wait for the refill to finish.
+
+        This makes each miss cost about four more memcache round trips
+        than a plain get and set: adding the lease, adding the value,
+        setting its stale copy and deleting the lease.
+        """
         res = self.get(key)
-        if res is None:
-            res = func()
-            self.set(key, res)
-        return res
+        if res is not None:
+            return res
+
+        with self._inflight_lock:
+            event = self._inflight.get(key)
+            leader = event is None
+            if leader:
+                event = self._inflight[key] = threading.Event()
+
+        if not leader:
+            event.wait(LEASE_WAIT)
+            res = self.get(key)
+            if res is not None:
+                return res
+            return self._refill(key, func, stale_grace)
+
+        try:
+            return self._refill(key, func, stale_grace)
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+            event.set()
+
+    def _refill(self, key, func, stale_grace):
+        lease_key = _key(key, 'lease')
+        if self.add(lease_key, 1, LEASE_TTL):
+            try:
+                res = func()
+                # a concurrent write may have set a fresher value already.
+                self.add(key, res)
+                if res is not None and stale_grace:
+                    self.set(_key(key, 'stale'), res, stale_grace)
+                return res
+            finally:
+                self.delete(lease_key)
+
+        # somebody else is refilling the key.
+        res = self.get(_key(key, 'stale'))
+        if res is not None:
+            self.logger.incr('syncstorage.storage.cachemanager.stale_hit')
+            return res
+
+        self.logger.incr('syncstorage.storage.cachemanager.lease_wait')
+        deadline = time.time() + LEASE_WAIT
+        while time.time() < deadline:
+            time.sleep(LEASE_POLL)
+            res = self.get_multi([key, lease_key])
+            if key in res:
+                return res[key]
+            if lease_key not in res:
+                # the refill is over, but gave nothing we can reuse,
+                # e.g. because func() returned None.
+                break
+
+        # the refill is taking too long or failed, let's not wait.
+        return func()
+
+    #
+    # per-user keys
+    #
+    def get_generation(self, user_id):
+        """Returns the current cache generation of the user.
+
+        The value is read once per request and kept in a thread local.
+        """
+        generation = self._generations.__dict__.get(user_id)
+        if generation is not None:
+            return generation
+
+        key = _key(user_id, 'gen')
+        # if this read closes the breaker, the pending flushes are done
+        # right after it, and the generation of the user may change.
+        pending = user_id in self._pending_flushes
+        generation = self.get(key)
+        if pending and user_id not in self._pending_flushes:
+            generation = self.get(key)
+        if generation is None:
+            generation = _new_generation()
+            if not self.add(key, generation):
+                # another client initialized it first.
+                generation = self.get(key)
+                if generation is None:
+                    raise BackendError('Could not read %r' % key)
+
+        self._generations.__dict__[user_id] = generation
+        return generation
+
+    def user_key(self, user_id, *parts):
+        """Returns the key of some user data.
+
+        Keys are prefixed by the generation of the user, so that all of
+        them can be dropped at once by flush_user_cache().
+        """
+        return _key(user_id, self.get_generation(user_id), *parts)
+
+    def invalidate(self, key):
+        """Deletes key along with its stale copy."""
+        self.delete(_key(key, 'stale'))
+        return self.delete(key)
 
     #
     # Tab managment
@@ -176,39 +435,40 @@ class CacheManager(object):
                     del tabs[tab_id]
 
     def get_tabs(self, user_id, filters=None):
-        with self._locker:
-            key = _key(user_id, 'tabs')
-            tabs = self.get(key)
-            if tabs is None:
-                # memcached down ?
-                tabs = {}
-            if filters is not None:
-                self._filter_tabs(tabs, filters)
+        key = self.user_key(user_id, 'tabs')
+        tabs = self.get(key)
+        if tabs is None:
+            # memcached down ?
+            tabs = {}
+        if filters is not None:
+            self._filter_tabs(tabs, filters)
 
         return tabs
 
     def set_tabs(self, user_id, tabs, merge=True):
-        with self._locker:
-            key = _key(user_id, 'tabs')
-            if merge:
-                existing_tabs = self.get(key)
-                if existing_tabs is None:
-                    existing_tabs = {}
-            else:
+        def _set_tabs(existing_tabs):
+            if existing_tabs is None or not merge:
                 existing_tabs = {}
             for tab_id, tab in tabs.items():
                 existing_tabs[tab_id] = tab
-            self.set(key, existing_tabs)
+            return existing_tabs
+
+        self.update(self.user_key(user_id, 'tabs'), _set_tabs)
 
     def delete_tab(self, user_id, tab_id):
-        with self._locker:
-            key = _key(user_id, 'tabs')
-            tabs = self.get_tabs(user_id)
+        deleted = []
+
+        def _delete_tab(tabs):
+            del deleted[:]
+            if tabs is None:
+                tabs = {}
             if tab_id in tabs:
                 del tabs[tab_id]
-                self.set(key, tabs)
-                return True
-            return False
+                deleted.append(tab_id)
+            return tabs
+
+        self.update(self.user_key(user_id, 'tabs'), _delete_tab)
+        return len(deleted) > 0
 
     def delete_tabs(self, user_id, filters=None):
         def _filter(tabs, filters, field, to_keep):
@@ -216,16 +476,16 @@ class CacheManager(object):
             if operator == '>':
                 for tab_id, tab in list(tabs.items()):
                     if tab[field] <= stamp:
-                        kept[tab_id] = tabs[tab_id]
+                        to_keep[tab_id] = tabs[tab_id]
             elif operator == '<':
                 for tab_id, tab in list(tabs.items()):
                     if tab[field] >= stamp:
-                        kept[tab_id] = tabs[tab_id]
+                        to_keep[tab_id] = tabs[tab_id]
+
+        counts = {}
 
-        with self._locker:
-            key = _key(user_id, 'tabs')
+        def _delete_tabs(tabs):
             kept = {}
-            tabs = self.get(key)
             if tabs is None:
                 # memcached down ?
                 tabs = {}
@@ -242,8 +502,11 @@ class CacheManager(object):
                 if 'sortindex' in filters:
                     _filter(tabs, filters, 'sortindex', kept)
 
-            self.set(key, kept)
-            return len(kept) < len(tabs)
+            counts['before'] = len(tabs)
+            return kept
+
+        kept = self.update(self.user_key(user_id, 'tabs'), _delete_tabs)
+        return len(kept) < counts['before']
 
     def tab_exists(self, user_id, tab_id):
         tabs = self.get_tabs(user_id)
@@ -258,12 +521,34 @@ class CacheManager(object):
     # misc APIs
     #
     def flush_user_cache(self, user_id):
-        """Removes all cached data."""
-        for key in USER_KEYS:
+        """Removes all cached data.
+
+        Bumping the generation of the user orphans all of its keys, which
+        are then evicted by memcached.  If memcached can't be reached, the
+        generation is bumped when it is back.
+
+        The users waiting for that are only known to this process, and are
+        lost if it restarts before memcached is back: their cached data is
+        then served until it expires.  The other processes have their own
+        list, for the writes they handled.
+        """
+        self._generations.__dict__.pop(user_id, None)
+        key = _key(user_id, 'gen')
+        # while memcached is unreachable, this is done once it's back.
+        if self.breaker.state != OPEN:
             try:
-                self.delete(_key(user_id, key))
+                with self._reserve() as mc:
+                    try:
+                        mc.incr(key)
+                    except NotFound:
+                        # nothing was cached, or the generation key was
+                        # evicted and the next one will be a new one anyway.
+                        pass
+                return
             except BackendError:
                 self.logger.error('Could not delete user cache (%s)' % key)
+        with self._pending_lock:
+            self._pending_flushes.add(user_id)
 
     #
     # total managment
@@ -271,16 +556,15 @@ class CacheManager(object):
     def set_total(self, user_id, total):
         # we store the size in bytes in memcached
         total = int(total * _KB)
-        key = _key(user_id, 'size')
         # if this fail it's not a big deal
         try:
-            self.set(key, total)
+            self.set(self.user_key(user_id, 'size'), total)
         except BackendError:
             self.logger.error('Could not write to memcached')
 
     def get_total(self, user_id):
         try:
-            total = self.get(_key(user_id, 'size'))
+            total = self.get(self.user_key(user_id, 'size'))
             if total != 0 and total is not None:
                 total = total / _KB
         except BackendError:
@@ -288,20 +572,138 @@ class CacheManager(object):
         return total
 
 
+class AsyncWriter(object):
+    """Runs write operations in a background thread.
+
+    Operations are queued in a bounded queue and run one at a time, in
+    order.  When the queue is full, or when an operation waited more than
+    "timeout" seconds, it is dropped and counted in "dropped".
+    """
+    def __init__(self, name, queue_size=1000, timeout=1.):
+        self.name = name
+        self.timeout = timeout
+        self.dropped = 0
+        self._queue = Queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._run,
+                                        name='%s-writer' % name)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    @property
+    def logger(self):
+        return CLIENT_HOLDER.default_client
+
+    def stop(self):
+        """Stops the thread once the queued operations are done."""
+        self._queue.put((time.time(), None, None))
+        self._thread.join(self.timeout)
+
+    def submit(self, func, *args):
+        try:
+            self._queue.put_nowait((time.time(), func, args))
+        except Queue.Full:
+            self._drop()
+
+    def join(self):
+        """Waits until all the queued operations are done."""
+        self._queue.join()
+
+    def _drop(self):
+        self.dropped += 1
+        self.logger.incr('syncstorage.storage.cachemanager.%s.dropped'
+                         % self.name)
+
+    def _run(self):
+        while True:
+            queued, func, args = self._queue.get()
+            if func is None:
+                self._queue.task_done()
+                return
+            try:
+                if time.time() - queued > self.timeout:
+                    self._drop()
+                else:
+                    func(*args)
+            except Exception, err:
+                self.logger.error('%s write failed: %s' % (self.name, err))
+            finally:
+                self._queue.task_done()
+
+
 class MirroredCacheManager(CacheManager):
+    """Writes everything to a second memcache cluster as well.
 
+    Unless mirror_async is False, the writes to the mirror are done in a
+    background thread, so they don't add any latency to the primary, and a
+    slow or dead mirror doesn't make the primary writes fail.
+    """
     def __init__(self, servers, mirror_servers, *args, **kwds):
+        mirror_async = kwds.pop('mirror_async', True)
+        mirror_queue_size = int(kwds.pop('mirror_queue_size', 1000))
+        mirror_timeout = float(kwds.pop('mirror_timeout', 1.))
         super(MirroredCacheManager, self).__init__(servers, *args, **kwds)
+        kwds['breaker_name'] = 'mirror'
         self._mirror = CacheManager(mirror_servers, *args, **kwds)
+        if mirror_async:
+            self._writer = AsyncWriter('mirror', mirror_queue_size,
+                                       mirror_timeout)
+        else:
+            self._writer = None
+
+    def close(self):
+        super(MirroredCacheManager, self).close()
+        if self._writer is not None:
+            self._writer.stop()
+        self._mirror.close()
+
+    def _mirror_call(self, name, *args):
+        if self._writer is None:
+            getattr(self._mirror, name)(*args)
+        else:
+            self._writer.submit(getattr(self._mirror, name), *args)
 
     def delete(self, key):
-        self._mirror.delete(key)
+        self._mirror_call('delete', key)
         return super(MirroredCacheManager, self).delete(key)
 
     def incr(self, key, size=1):
-        self._mirror.incr(key, size)
+        self._mirror_call('incr', key, size)
         return super(MirroredCacheManager, self).incr(key, size)
 
-    def set(self, key, value):
-        self._mirror.set(key, value)
-        return super(MirroredCacheManager, self).set(key, value)
+    def decr(self, key, size=1):
+        self._mirror_call('decr', key, size)
+        return super(MirroredCacheManager, self).decr(key, size)
+
+    def set(self, key, value, time=0):
+        self._mirror_call('set', key, value, time)
+        return super(MirroredCacheManager, self).set(key, value, time)
+
+    def flush_user_cache(self, user_id):
+        self._mirror_call('flush_user_cache', user_id)
+        return super(MirroredCacheManager, self).flush_user_cache(user_id)
+
+    def cas(self, key, value, casid):
+        # cas ids are not shared between the two clusters, so the mirror
+        # just gets the value that won on the primary.
+        res = super(MirroredCacheManager, self).cas(key, value, casid)
+        if res:
+            self._mirror_call('set', key, value)
+        return res
+
+    def add(self, key, value, time=0):
+        res = super(MirroredCacheManager, self).add(key, value, time)
+        if res:
+            self._mirror_call('set', key, value, time)
+        return res
+
+    def add_multi(self, mapping, time=0):
+        res = super(MirroredCacheManager, self).add_multi(mapping, time)
+        added = dict([(key, value) for key, value in mapping.items()
+                      if key not in res])
+        if added:
+            self._mirror_call('set_multi', added, time)
+        return res
+
+    def set_multi(self, mapping, time=0):
+        self._mirror_call('set_multi', mapping, time)
+        return super(MirroredCacheManager, self).set_multi(mapping, time)
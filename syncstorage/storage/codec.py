@@ -0,0 +1,275 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+Compact binary codec for the values stored in memcached.
+
+The values we cache are small trees of dicts, lists and scalars: WBOs,
+tabs mappings and collection stamps.  This module encodes them using a
+msgpack-style binary format, which is much smaller than a pickle and
+doesn't lose the Decimal timestamps like JSON does.
+
+Every encoded value starts with a two-bytes header:
+
+- the format version (currently 1)
+- a flags byte.  FLAG_ZLIB means the body is zlib-compressed.
+
+Bodies larger than the compression threshold are compressed, as long
+as it actually makes them smaller.
+"""
+import struct
+import zlib
+from decimal import Decimal
+
+VERSION = 1
+
+FLAG_ZLIB = 0x01
+
+# extension types
+_EXT_DECIMAL = 1
+_EXT_BIGINT = 2
+
+_HEADER = struct.Struct('>BB')
+_UINT8 = struct.Struct('>B')
+_UINT16 = struct.Struct('>H')
+_UINT32 = struct.Struct('>I')
+_INT64 = struct.Struct('>q')
+_FLOAT64 = struct.Struct('>d')
+_INT64_MIN = -2 ** 63
+_INT64_MAX = 2 ** 63 - 1
+
+
+class CodecError(ValueError):
+    """Raised when a value can't be encoded or decoded."""
+    pass
+
+
+def _pack_length(write, length, fixbase, fixmax, codes):
+    if fixbase is not None and length <= fixmax:
+        write(chr(fixbase | length))
+    elif codes[0] is not None and length <= 0xff:
+        write(chr(codes[0]) + _UINT8.pack(length))
+    elif length <= 0xffff:
+        write(chr(codes[1]) + _UINT16.pack(length))
+    else:
+        write(chr(codes[2]) + _UINT32.pack(length))
+
+
+def _pack(value, write):
+    if value is None:
+        write('\xc0')
+    elif value is True:
+        write('\xc3')
+    elif value is False:
+        write('\xc2')
+    elif isinstance(value, (int, long)):
+        if 0 <= value <= 0x7f:
+            write(chr(value))
+        elif -32 <= value < 0:
+            write(chr(value & 0xff))
+        elif _INT64_MIN <= value <= _INT64_MAX:
+            write('\xd3' + _INT64.pack(value))
+        else:
+            _pack_ext(_EXT_BIGINT, str(value), write)
+    elif isinstance(value, float):
+        write('\xcb' + _FLOAT64.pack(value))
+    elif isinstance(value, unicode):
+        value = value.encode('utf8')
+        _pack_length(write, len(value), 0xa0, 31, (0xd9, 0xda, 0xdb))
+        write(value)
+    elif isinstance(value, str):
+        # byte strings are kept apart from unicode, so they round-trip
+        # with the same type.
+        _pack_length(write, len(value), None, 0, (0xc4, 0xc5, 0xc6))
+        write(value)
+    elif isinstance(value, dict):
+        _pack_length(write, len(value), 0x80, 15, (None, 0xde, 0xdf))
+        for key, item in value.iteritems():
+            _pack(key, write)
+            _pack(item, write)
+    elif isinstance(value, (list, tuple)):
+        _pack_length(write, len(value), 0x90, 15, (None, 0xdc, 0xdd))
+        for item in value:
+            _pack(item, write)
+    elif isinstance(value, Decimal):
+        _pack_ext(_EXT_DECIMAL, str(value), write)
+    else:
+        raise CodecError('Cannot encode %s' % type(value))
+
+
+def _pack_ext(code, data, write):
+    _pack_length(write, len(data), None, 0, (0xc7, 0xc8, 0xc9))
+    write(chr(code))
+    write(data)
+
+
+class _Unpacker(object):
+    """Decodes a body produced by _pack()."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def _read(self, size):
+        start = self.pos
+        self.pos += size
+        if self.pos > len(self.data):
+            raise CodecError('Truncated data')
+        return self.data[start:self.pos]
+
+    def _read_struct(self, struct_):
+        return struct_.unpack(self._read(struct_.size))[0]
+
+    def unpack(self):
+        code = ord(self._read(1))
+
+        # fixed-size types first, as they are the most common ones.
+        if code <= 0x7f:
+            return code
+        if code >= 0xe0:
+            return code - 0x100
+        if 0xa0 <= code <= 0xbf:
+            return self._read(code & 0x1f).decode('utf8')
+        if 0x80 <= code <= 0x8f:
+            return self._unpack_map(code & 0x0f)
+        if 0x90 <= code <= 0x9f:
+            return self._unpack_array(code & 0x0f)
+
+        if code == 0xc0:
+            return None
+        if code == 0xc2:
+            return False
+        if code == 0xc3:
+            return True
+        if code == 0xd3:
+            return self._read_struct(_INT64)
+        if code == 0xcb:
+            return self._read_struct(_FLOAT64)
+
+        sized = _SIZED.get(code)
+        if sized is None:
+            raise CodecError('Unknown type code 0x%x' % code)
+        kind, length_struct = sized
+        length = self._read_struct(length_struct)
+        if kind == 'str':
+            return self._read(length).decode('utf8')
+        if kind == 'bin':
+            return self._read(length)
+        if kind == 'map':
+            return self._unpack_map(length)
+        if kind == 'array':
+            return self._unpack_array(length)
+        return self._unpack_ext(length)
+
+    def _unpack_map(self, length):
+        unpack = self.unpack
+        res = {}
+        for i in xrange(length):
+            key = unpack()
+            res[key] = unpack()
+        return res
+
+    def _unpack_array(self, length):
+        unpack = self.unpack
+        return [unpack() for i in xrange(length)]
+
+    def _unpack_ext(self, length):
+        ext_code = ord(self._read(1))
+        data = self._read(length)
+        if ext_code == _EXT_DECIMAL:
+            return Decimal(data)
+        if ext_code == _EXT_BIGINT:
+            return long(data)
+        raise CodecError('Unknown extension type %d' % ext_code)
+
+
+_SIZED = {0xd9: ('str', _UINT8), 0xda: ('str', _UINT16),
+          0xdb: ('str', _UINT32), 0xc4: ('bin', _UINT8),
+          0xc5: ('bin', _UINT16), 0xc6: ('bin', _UINT32),
+          0xde: ('map', _UINT16), 0xdf: ('map', _UINT32),
+          0xdc: ('array', _UINT16), 0xdd: ('array', _UINT32),
+          0xc7: ('ext', _UINT8), 0xc8: ('ext', _UINT16),
+          0xc9: ('ext', _UINT32)}
+
+
+def encode(value, compress_threshold=None):
+    """Encodes value, compressing it if larger than compress_threshold."""
+    body = []
+    _pack(value, body.append)
+    body = ''.join(body)
+    flags = 0
+    if compress_threshold is not None and len(body) > compress_threshold:
+        compressed = zlib.compress(body)
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= FLAG_ZLIB
+    return _HEADER.pack(VERSION, flags) + body
+
+
+def decode(data):
+    """Decodes a value produced by encode()."""
+    if len(data) < _HEADER.size:
+        raise CodecError('Truncated data')
+    version, flags = _HEADER.unpack(data[:_HEADER.size])
+    if version != VERSION:
+        raise CodecError('Unsupported codec version %d' % version)
+    body = data[_HEADER.size:]
+    if flags & FLAG_ZLIB:
+        body = zlib.decompress(body)
+    unpacker = _Unpacker(body)
+    value = unpacker.unpack()
+    if unpacker.pos != len(body):
+        raise CodecError('Trailing data')
+    return value
+
+
+def get_dumper(compress_threshold=None):
+    """Returns a pickler/unpickler class using the compact codec.
+
+    The class follows the same file-based API as the pickle module, so it
+    can be plugged in the memcache client like the JSON dumper.
+    """
+    class _CompactDumper(object):
+        """Dumps and loads compact binary data in a file-like object"""
+        def __init__(self, file, protocol=0):
+            self.file = file
+
+        def dump(self, val):
+            self.file.write(encode(val, compress_threshold))
+
+        def load(self):
+            return decode(self.file.read())
+
+    return _CompactDumper
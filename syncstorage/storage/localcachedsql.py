@@ -0,0 +1,256 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+"""
+SQL backend with an in-process cache
+
+This is a lighter alternative to the Memcached + SQL backend for
+single-box deployments.  The data read on every sync is kept in a bounded
+LRU cache, in the memory of the process:
+
+- the info/collections timestamps and the collection counts
+- the meta/global wbo
+- the collection names catalog
+
+Writes done through the storage invalidate the cached data of the user.
+Entries also expire after cache_ttl seconds, so that processes sharing
+the same database eventually see each other's writes.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from metlog.holder import CLIENT_HOLDER
+
+from syncstorage.storage.sql import SQLStorage
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    """A thread-safe mapping holding at most max_size entries.
+
+    The least recently used entries are evicted first, and entries older
+    than ttl seconds are ignored.
+    """
+    def __init__(self, max_size=10000, ttl=10):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires < time.time():
+                return default
+            # re-inserting the entry makes it the most recent one.
+            self._data[key] = entry
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value, time.time() + self.ttl
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class LocalCachedSQLStorage(SQLStorage):
+    """Uses an in-process cache when possible/useful, SQL otherwise.
+
+    The cache holds at most cache_size users, for cache_ttl seconds.
+    """
+
+    def __init__(self, sqluri, cache_size=10000, cache_ttl=10, **kw):
+        self.sqlstorage = super(LocalCachedSQLStorage, self)
+        self.sqlstorage.__init__(sqluri, **kw)
+        self.cache = LRUCache(int(cache_size), float(cache_ttl))
+
+    @classmethod
+    def get_name(self):
+        return 'localcached'
+
+    @property
+    def logger(self):
+        return CLIENT_HOLDER.default_client
+
+    #
+    # Cache management
+    #
+    def _cached(self, user_id, name, func):
+        """Returns the name entry of the user, calling func on a miss.
+
+        All the entries of a user are stored together, so that they are
+        evicted and invalidated at once.  A reader racing with a write
+        fills a dict that is no longer in the cache, so it can't store
+        stale data.
+        """
+        entries = self.cache.get(user_id)
+        if entries is None:
+            entries = {}
+            self.cache.set(user_id, entries)
+        res = entries.get(name, _MISSING)
+        if res is _MISSING:
+            self.logger.incr('syncstorage.storage.localcachedsql.miss')
+            res = entries[name] = func()
+        else:
+            self.logger.incr('syncstorage.storage.localcachedsql.hit')
+        return res
+
+    def _invalidate(self, user_id):
+        self.cache.delete(user_id)
+
+    #
+    # Users APIs
+    #
+    def delete_storage(self, user_id):
+        self._invalidate(user_id)
+        return self.sqlstorage.delete_storage(user_id)
+
+    def delete_user(self, user_id):
+        self._invalidate(user_id)
+        return self.sqlstorage.delete_user(user_id)
+
+    #
+    # Collections APIs
+    #
+    def _get_collection_id(self, user_id, collection_name, create=True):
+        if self._collections_by_name is not None:
+            if collection_name in self._collections_by_name:
+                return self._collections_by_name[collection_name]
+
+        names = self._cached(user_id, 'collection_ids',
+                             lambda: dict([(name, collid) for collid, name
+                                in self.get_collection_names(user_id)]))
+        if collection_name in names:
+            return names[collection_name]
+        res = self.sqlstorage._get_collection_id(user_id, collection_name,
+                                                 create)
+        if res is not None:
+            self._invalidate(user_id)
+        return res
+
+    def get_collection_names(self, user_id):
+        return self._cached(user_id, 'collection_names',
+                lambda: self.sqlstorage.get_collection_names(user_id))
+
+    def set_collection(self, user_id, collection_name, **values):
+        res = self.sqlstorage.set_collection(user_id, collection_name,
+                                             **values)
+        self._invalidate(user_id)
+        return res
+
+    def delete_collection(self, user_id, collection_name):
+        res = self.sqlstorage.delete_collection(user_id, collection_name)
+        self._invalidate(user_id)
+        return res
+
+    def get_collection_timestamps(self, user_id):
+        stamps = self._cached(user_id, 'stamps',
+                lambda: self.sqlstorage.get_collection_timestamps(user_id))
+        return dict(stamps)
+
+    def get_collection_max_timestamp(self, user_id, collection_name):
+        return self.get_collection_timestamps(user_id).get(collection_name)
+
+    def get_collection_counts(self, user_id):
+        counts = self._cached(user_id, 'counts',
+                lambda: self.sqlstorage.get_collection_counts(user_id))
+        return dict(counts)
+
+    #
+    # Items APIs
+    #
+    def get_item(self, user_id, collection_name, item_id, fields=None):
+        if collection_name != 'meta' or item_id != 'global':
+            return self.sqlstorage.get_item(user_id, collection_name,
+                                            item_id, fields)
+
+        item = self._cached(user_id, 'meta:global',
+                lambda: self.sqlstorage.get_item(user_id, 'meta', 'global'))
+        if item is None:
+            return None
+        res = item.__class__()
+        res.update([(field, value) for field, value in item.items()
+                    if fields is None or field in fields])
+        return res
+
+    def set_item(self, user_id, collection_name, item_id, storage_time=None,
+                 **values):
+        try:
+            return self.sqlstorage.set_item(user_id, collection_name,
+                                            item_id, storage_time, **values)
+        finally:
+            self._invalidate(user_id)
+
+    def set_items(self, user_id, collection_name, items, storage_time=None):
+        try:
+            return self.sqlstorage.set_items(user_id, collection_name, items,
+                                             storage_time)
+        finally:
+            self._invalidate(user_id)
+
+    def delete_item(self, user_id, collection_name, item_id,
+                    storage_time=None):
+        try:
+            return self.sqlstorage.delete_item(user_id, collection_name,
+                                               item_id, storage_time)
+        finally:
+            self._invalidate(user_id)
+
+    def delete_items(self, user_id, collection_name, item_ids=None,
+                     filters=None, limit=None, offset=None, sort=None,
+                     storage_time=None):
+        try:
+            return self.sqlstorage.delete_items(user_id, collection_name,
+                                                item_ids, filters, limit,
+                                                offset, sort, storage_time)
+        finally:
+            self._invalidate(user_id)
@@ -36,26 +36,48 @@
 """
 Memcached + SQL backend
 
+All the keys of a user are prefixed by its generation, stored in
+"user_id:gen", so "user_id" below actually stands for "user_id:generation".
+Removing all the cached data of a user is done by incrementing it.
+
 - User tabs are stored in one single "user_id:tabs" key
 - The total storage size is stored in "user_id:size"
 - The meta/global wbo is stored in "user_id"
-- The info/collections timestamp mapping is stored in "user_id:stamps"
+- The timestamp of each collection is stored in "user_id:stamp:name",
+  and the list of the collections that have one in "user_id:stamps"
+- The small collections listed in "cached_collections" are stored whole
+  in "user_id:collection:name", along with the collection timestamp they
+  were read at.
 """
 import time
 import simplejson as json
 
 from sqlalchemy.sql import select, bindparam, func
 
-from services.util import round_time
+from services.util import round_time, BackendError
+
+from syncstorage.wbo import WBO
 
 from syncstorage.storage.sql import SQLStorage
+from syncstorage.storage import codec
+from syncstorage.storage.breaker import CircuitOpenError
 from syncstorage.storage.sqlmappers import wbo
 from syncstorage.storage.cachemanager import (CacheManager,
                                               MirroredCacheManager,
                                               _key)
 
-# Recalculate quota at most once per hour.
-QUOTA_RECALCULATION_PERIOD = 60 * 60
+# Recalculate quota at most once per day.  Deletes keep the cached size
+# accurate, so this is only a safety net.
+QUOTA_RECALCULATION_PERIOD = 24 * 60 * 60
+
+# Small collections that are worth caching whole, like crypto and clients
+# which are read by every client on every sync.  None by default: this has
+# to be switched on with the "cached_collections" option.
+CACHED_COLLECTIONS = ()
+
+# Fields kept for the items of the cached collections.
+_CACHED_FIELDS = ['id', 'parentid', 'predecessorid', 'sortindex', 'modified',
+                  'payload', 'ttl']
 
 _COLLECTION_LIST = select([wbo.c.collection, func.max(wbo.c.modified),
                            func.count(wbo)],
@@ -79,8 +101,73 @@ class _JSONDumper(object):
         return json.loads(self.file.read())
 
 
+def _select_items(items, fields=None, filters=None, limit=None, offset=None,
+                  sort=None):
+    """Applies the get_items() arguments to a list of cached items.
+
+    This mimics the query built by SQLStorage.get_items().
+    """
+    if filters is None or 'ttl' not in filters:
+        now = time.time()
+        items = [item for item in items if item.get('ttl', 0) > now]
+
+    if filters is not None:
+        for field, (operator, value) in filters.items():
+            if field == 'ttl':
+                continue
+            if isinstance(value, (list, tuple)):
+                items = [item for item in items if item.get(field) in value]
+            elif operator == '=':
+                items = [item for item in items if item.get(field) == value]
+            elif operator == '<':
+                items = [item for item in items
+                         if item.get(field) is not None and
+                            item[field] < value]
+            elif operator == '>':
+                items = [item for item in items
+                         if item.get(field) is not None and
+                            item[field] > value]
+
+    if sort is not None:
+        if sort == 'oldest':
+            items.sort(key=lambda item: item.get('modified'))
+        elif sort == 'newest':
+            items.sort(key=lambda item: item.get('modified'), reverse=True)
+        else:
+            items.sort(key=lambda item: item.get('sortindex'), reverse=True)
+
+    if offset is not None and int(offset) > 0:
+        items = items[int(offset):]
+
+    if limit is not None and int(limit) > 0:
+        items = items[:int(limit)]
+
+    if fields is None:
+        fields = [field for field in _CACHED_FIELDS if field != 'ttl']
+    res = []
+    for item in items:
+        # the values were already converted when read from SQL
+        wbo = WBO()
+        wbo.update([(field, item[field]) for field in fields
+                    if field in item])
+        res.append(wbo)
+    return res
+
+
 class MemcachedSQLStorage(SQLStorage):
     """Uses Memcached when possible/useful, SQL otherwise.
+
+    Cached values are pickled by default.  memcached_codec can be set to
+    "json", or to "compact" for the binary codec from the codec module,
+    in which case values larger than memcached_compress_threshold bytes
+    are also compressed.
+
+    After cache_max_failures consecutive memcached errors, the cache is
+    bypassed for cache_reset_timeout seconds and everything goes to SQL.
+    The cached data of the users written meanwhile is dropped once
+    memcached is back.
+    Tabs only live in memcached: depending on tabs_when_cache_down they
+    are then seen as "empty" (and writes are dropped) or raise an "error".
     """
 
     def __init__(self, sqluri,
@@ -89,40 +176,113 @@ class MemcachedSQLStorage(SQLStorage):
                  pool_recycle=3600, cache_servers=None,
                  mirrored_cache_servers=None,
                  create_tables=False, shard=False, shardsize=100,
-                 memcached_json=False, **kw):
+                 memcached_json=False, memcached_codec=None,
+                 memcached_compress_threshold=None, mirror_async=True,
+                 mirror_queue_size=1000, mirror_timeout=1.,
+                 cached_collections=CACHED_COLLECTIONS,
+                 cache_max_failures=5, cache_reset_timeout=30,
+                 tabs_when_cache_down='empty', **kw):
         self.sqlstorage = super(MemcachedSQLStorage, self)
         self.sqlstorage.__init__(sqluri,
                                  standard_collections, fixed_collections,
                                  use_quota, quota_size, pool_size,
                                  pool_recycle, create_tables=create_tables,
                                  shard=shard, shardsize=shardsize, **kw)
+        if isinstance(cached_collections, basestring):
+            cached_collections = [name.strip() for name in
+                                  cached_collections.split(',')]
+        self.cached_collections = set(filter(None, cached_collections))
+        if tabs_when_cache_down not in ('empty', 'error'):
+            raise ValueError('Unknown tabs_when_cache_down policy %r'
+                             % tabs_when_cache_down)
+        self.tabs_when_cache_down = tabs_when_cache_down
+        extra_kw = {'breaker_max_failures': int(cache_max_failures),
+                    'breaker_reset_timeout': float(cache_reset_timeout)}
         if isinstance(cache_servers, str):
             cache_servers = [cache_servers]
         elif cache_servers is None:
             cache_servers = ['127.0.0.1:11211']
         if isinstance(mirrored_cache_servers, str):
             mirrored_cache_servers = [mirrored_cache_servers]
-        extra_kw = {}
-        if memcached_json:
+        if memcached_codec is None:
+            memcached_codec = memcached_json and 'json' or 'pickle'
+        if memcached_codec == 'json':
             extra_kw['pickler'] = _JSONDumper
             extra_kw['unpickler'] = _JSONDumper
+        elif memcached_codec == 'compact':
+            if memcached_compress_threshold is not None:
+                memcached_compress_threshold = \
+                        int(memcached_compress_threshold)
+            dumper = codec.get_dumper(memcached_compress_threshold)
+            extra_kw['pickler'] = dumper
+            extra_kw['unpickler'] = dumper
+        elif memcached_codec != 'pickle':
+            raise ValueError('Unknown memcached codec %r' % memcached_codec)
         if mirrored_cache_servers is None:
             self.cache = CacheManager(cache_servers, **extra_kw)
         else:
-            self.cache = MirroredCacheManager(cache_servers,
-                                              mirrored_cache_servers,
-                                              **extra_kw)
+            self.cache = MirroredCacheManager(
+                    cache_servers, mirrored_cache_servers,
+                    mirror_async=mirror_async,
+                    mirror_queue_size=mirror_queue_size,
+                    mirror_timeout=mirror_timeout, **extra_kw)
 
     @classmethod
     def get_name(self):
         return 'memcached'
 
+    def close(self):
+        self.cache.close()
+        self.sqlstorage.close()
+
     #
     # Cache management
     #
     def _is_meta_global(self, collection_name, item_id):
         return collection_name == 'meta' and item_id == 'global'
 
+    def _cache_is_down(self, collection_name=None):
+        """Returns True if the cache should be bypassed.
+
+        This is the case while the breaker of the cache is open, or while
+        another thread checks whether memcached is back.  Once the breaker
+        is half-open, the first call made to memcached is that check.
+        """
+        if self.cache.breaker.available():
+            return False
+        if collection_name == 'tabs' and self.tabs_when_cache_down == 'error':
+            raise CircuitOpenError('memcached',
+                                   self.cache.breaker.retry_after())
+        return True
+
+    def _get_cached_collection(self, user_id, collection_name):
+        """Returns the items of a cached collection, keyed by id.
+
+        The cached copy is only used if it was read at the current
+        timestamp of the collection, so it does not need to be updated
+        by every write.
+        """
+        stamp = self.get_collection_max_timestamp(user_id, collection_name)
+        key = self.cache.user_key(user_id, 'collection', collection_name)
+        cached = self.cache.get(key)
+        if cached is not None and cached['stamp'] == stamp:
+            return cached['items']
+
+        items = self.sqlstorage.get_items(user_id, collection_name,
+                                          fields=_CACHED_FIELDS,
+                                          filters={'ttl': ('>', 0)})
+        items = dict([(item['id'], item) for item in items])
+        try:
+            self.cache.set(key, {'stamp': stamp, 'items': items})
+        except BackendError:
+            self.logger.error('Could not write to memcached')
+        return items
+
+    def _invalidate_collection(self, user_id, collection_name):
+        if collection_name in self.cached_collections:
+            key = self.cache.user_key(user_id, 'collection', collection_name)
+            self.cache.delete(key)
+
     #
     # Cached APIs
     #
@@ -140,9 +300,14 @@ class MemcachedSQLStorage(SQLStorage):
             return self.sqlstorage.item_exists(user_id, collection_name,
                                                item_id)
 
+        if self._cache_is_down(collection_name):
+            if collection_name == 'tabs':
+                return None
+            return _item_exists()
+
         # returning cached values when possible
         if self._is_meta_global(collection_name, item_id):
-            key = _key(user_id, 'meta', 'global')
+            key = self.cache.user_key(user_id, 'meta', 'global')
             wbo = self.cache.get(key)
             if wbo is not None:
                 return wbo['modified']
@@ -163,10 +328,21 @@ class MemcachedSQLStorage(SQLStorage):
         It can be a single value, or a list. For the latter the in()
         operator is used. For single values, the operator has to be provided.
         """
+        if self._cache_is_down(collection_name):
+            if collection_name == 'tabs':
+                return []
+            return self.sqlstorage.get_items(user_id, collection_name,
+                                             fields, filters, limit, offset,
+                                             sort)
+
         # returning cached values when possible
         if collection_name == 'tabs':
             # tabs are not stored at all in SQL
             return self.cache.get_tabs(user_id, filters).values()
+        elif collection_name in self.cached_collections:
+            items = self._get_cached_collection(user_id, collection_name)
+            return _select_items(items.values(), fields, filters, limit,
+                                 offset, sort)
 
         return self.sqlstorage.get_items(user_id, collection_name,
                                          fields, filters, limit, offset, sort)
@@ -180,13 +356,27 @@ class MemcachedSQLStorage(SQLStorage):
             return self.sqlstorage.get_item(user_id, collection_name,
                                             item_id, fields)
 
+        if self._cache_is_down(collection_name):
+            if collection_name == 'tabs':
+                return None
+            return _get_item()
+
         # returning cached values when possible
         if self._is_meta_global(collection_name, item_id):
-            key = _key(user_id, 'meta', 'global')
+            key = self.cache.user_key(user_id, 'meta', 'global')
             return self.cache.get_set(key, _get_item)
         elif collection_name == 'tabs':
             # tabs are not stored at all in SQL
             return self.cache.get_tab(user_id, item_id)
+        elif collection_name in self.cached_collections:
+            items = self._get_cached_collection(user_id, collection_name)
+            item = items.get(item_id)
+            if item is None:
+                return None
+            items = _select_items([item], fields)
+            if not items:   # expired
+                return None
+            return items[0]
 
         return _get_item()
 
@@ -194,14 +384,22 @@ class MemcachedSQLStorage(SQLStorage):
         # update the stamps cache
         if storage_time is None:
             storage_time = round_time()
-        stamps = self.get_collection_timestamps(user_id)
-        stamps[collection_name] = storage_time
-        self.cache.set(_key(user_id, 'stamps'), stamps)
+
+        key = self.cache.user_key(user_id, 'stamp', collection_name)
+        self.cache.set(key, storage_time)
+
+        # a new collection bumps the version of the list of names, so that
+        # no reader gets a list without it, even one that was computed
+        # before this write and is cached after it.  The list is rebuilt
+        # from the database by the next read.
+        names = self.cache.get(self._stamps_key(user_id))
+        if names is None or collection_name not in names:
+            self.cache.incr(self.cache.user_key(user_id, 'stamps', 'version'))
 
     def _update_cache(self, user_id, collection_name, items, storage_time):
         # update the total size cache (bytes)
         total_size = sum([len(item.get('payload', '')) for item in items])
-        self.cache.incr(_key(user_id, 'size'), total_size)
+        self.cache.incr(self.cache.user_key(user_id, 'size'), total_size)
 
         # update the stamps cache
         self._update_stamp(user_id, collection_name, storage_time)
@@ -210,12 +408,21 @@ class MemcachedSQLStorage(SQLStorage):
         if self._is_meta_global(collection_name, items[0]['id']):
             item = items[0]
             item['username'] = user_id
-            key = _key(user_id, 'meta', 'global')
+            key = self.cache.user_key(user_id, 'meta', 'global')
             self.cache.set(key, item)
+            self.cache.delete(_key(key, 'stale'))
         elif collection_name == 'tabs':
             tabs = dict([(item['id'], item) for item in items])
             self.cache.set_tabs(user_id, tabs)
 
+    def _decr_size(self, user_id, freed):
+        # update the total size cache (bytes)
+        if freed:
+            try:
+                self.cache.decr(self.cache.user_key(user_id, 'size'), freed)
+            except BackendError:
+                self.logger.error('Could not write to memcached')
+
     def _update_item(self, item, when):
         if 'payload' in item and 'modified' not in item:
             item['modified'] = when
@@ -228,14 +435,29 @@ class MemcachedSQLStorage(SQLStorage):
             storage_time = round_time()
 
         self._update_item(values, storage_time)
-        self._update_cache(user_id, collection_name, [values], storage_time)
+
+        if self._cache_is_down(collection_name):
+            if collection_name == 'tabs':
+                return storage_time
+            res = self.sqlstorage.set_item(user_id, collection_name,
+                                           item_id, storage_time=storage_time,
+                                           **values)
+            self.cache.flush_user_cache(user_id)
+            return res
 
         if collection_name == 'tabs':
             # return now : we don't store tabs in sql
+            self._update_cache(user_id, collection_name, [values],
+                               storage_time)
             return storage_time
 
-        return self.sqlstorage.set_item(user_id, collection_name, item_id,
-                                        storage_time=storage_time, **values)
+        # the cache is updated once the write is done, so that
+        # readers seeing the new timestamp also see the new data.
+        res = self.sqlstorage.set_item(user_id, collection_name, item_id,
+                                       storage_time=storage_time, **values)
+        self._update_cache(user_id, collection_name, [values], storage_time)
+        self._invalidate_collection(user_id, collection_name)
+        return res
 
     def set_items(self, user_id, collection_name, items, storage_time=None):
         """Adds or update a batch of items.
@@ -248,25 +470,40 @@ class MemcachedSQLStorage(SQLStorage):
         for item in items:
             self._update_item(item, storage_time)
 
-        self._update_cache(user_id, collection_name, items, storage_time)
+        if self._cache_is_down(collection_name):
+            if collection_name == 'tabs':
+                return len(items)
+            res = self.sqlstorage.set_items(user_id, collection_name, items,
+                                            storage_time=storage_time)
+            self.cache.flush_user_cache(user_id)
+            return res
+
         if collection_name == 'tabs':
             # return now : we don't store tabs in sql
+            self._update_cache(user_id, collection_name, items, storage_time)
             return len(items)
 
-        return self.sqlstorage.set_items(user_id, collection_name, items,
-                                         storage_time=storage_time)
+        res = self.sqlstorage.set_items(user_id, collection_name, items,
+                                        storage_time=storage_time)
+        self._update_cache(user_id, collection_name, items, storage_time)
+        self._invalidate_collection(user_id, collection_name)
+        return res
 
     def delete_item(self, user_id, collection_name, item_id,
                     storage_time=None):
         """Deletes an item"""
-        # Since we don't know how large the item is, we can't make any
-        # useful adjustment to the cached size.  Just leave it alone and
-        # rely on automatic recalculation to keep it semi-accurate.
+        if self._cache_is_down(collection_name):
+            if collection_name == 'tabs':
+                return False
+            res = self.sqlstorage.delete_item(user_id, collection_name,
+                                              item_id)
+            self.cache.flush_user_cache(user_id)
+            return res
 
         # update the meta/global cache or the tabs cache
         if self._is_meta_global(collection_name, item_id):
-            key = _key(user_id, 'meta', 'global')
-            self.cache.delete(key)
+            key = self.cache.user_key(user_id, 'meta', 'global')
+            self.cache.invalidate(key)
         elif collection_name == 'tabs':
             # tabs are not stored at all in SQL
             if self.cache.delete_tab(user_id, item_id):
@@ -274,24 +511,32 @@ class MemcachedSQLStorage(SQLStorage):
                 return True
             return False
 
-        res = self.sqlstorage.delete_item(user_id, collection_name, item_id)
+        res, freed = self._delete_item(user_id, collection_name, item_id,
+                                       with_size=True)
         if res:
             self._update_stamp(user_id, collection_name, storage_time)
+            self._invalidate_collection(user_id, collection_name)
+            self._decr_size(user_id, freed)
         return res
 
     def delete_items(self, user_id, collection_name, item_ids=None,
                      filters=None, limit=None, offset=None, sort=None,
                      storage_time=None):
         """Deletes items. All items are removed unless item_ids is provided"""
-        # Since we don't know how large the items are, we can't make any
-        # useful adjustment to the cached size.  Just leave it alone and
-        # rely on automatic recalculation to keep it semi-accurate.
+        if self._cache_is_down(collection_name):
+            if collection_name == 'tabs':
+                return False
+            res = self.sqlstorage.delete_items(user_id, collection_name,
+                                               item_ids, filters, limit,
+                                               offset, sort)
+            self.cache.flush_user_cache(user_id)
+            return res
 
         # remove the cached values
         if (collection_name == 'meta' and (item_ids is None
             or 'global' in item_ids)):
-            key = _key(user_id, 'meta', 'global')
-            self.cache.delete(key)
+            key = self.cache.user_key(user_id, 'meta', 'global')
+            self.cache.invalidate(key)
         elif collection_name == 'tabs':
             # tabs are not stored at all in SQL
             if self.cache.delete_tabs(user_id, filters):
@@ -299,11 +544,14 @@ class MemcachedSQLStorage(SQLStorage):
                 return True
             return False
 
-        res = self.sqlstorage.delete_items(user_id, collection_name,
-                                           item_ids, filters,
-                                           limit, offset, sort)
+        res, freed = self._delete_items(user_id, collection_name,
+                                        item_ids, filters,
+                                        limit, offset, sort,
+                                        with_size=True)
         if res:
             self._update_stamp(user_id, collection_name, storage_time)
+            self._invalidate_collection(user_id, collection_name)
+            self._decr_size(user_id, freed)
         return res
 
     def get_total_size(self, user_id, recalculate=False):
@@ -317,13 +565,18 @@ class MemcachedSQLStorage(SQLStorage):
 
             # update the cache and timestamp
             self.cache.set_total(user_id, size)
-            self.cache.set(_key(user_id, "size", "ts"), int(time.time()))
+            key = self.cache.user_key(user_id, "size", "ts")
+            self.cache.set(key, int(time.time()))
             return size
 
+        if self._cache_is_down():
+            return self.sqlstorage.get_total_size(user_id)
+
         # Recalculate from the DB if requested, and if we haven't
         # already done so recently.
         if recalculate:
-            last_recalc = self.cache.get(_key(user_id, "size", "ts"))
+            key = self.cache.user_key(user_id, "size", "ts")
+            last_recalc = self.cache.get(key)
             if last_recalc is None:
                 return _get_set_size()
             if time.time() - last_recalc > QUOTA_RECALCULATION_PERIOD:
@@ -341,6 +594,9 @@ class MemcachedSQLStorage(SQLStorage):
         # so don't recalculate from the database unless explicitly asked.
         if recalculate:
             size = self.get_total_size(user_id, recalculate)
+        elif self._cache_is_down():
+            # like when the size is not cached: no quota check.
+            size = 0
         else:
             size = self.cache.get_total(user_id)
             if not size:
@@ -352,29 +608,95 @@ class MemcachedSQLStorage(SQLStorage):
         """
         # these sizes are not cached
         sizes = self.sqlstorage.get_collection_sizes(user_id)
+        if self._cache_is_down():
+            return sizes
         sizes['tabs'] = self.cache.get_tabs_size(user_id)
 
         # we can update the size while we're there, in case it's empty
         self.cache.set_total(user_id, sum(sizes.values()))
         return sizes
 
+    def _get_collection_timestamps(self, user_id):
+        """Computes the stamps from the database and the cached tabs."""
+        stamps = super(MemcachedSQLStorage,
+                       self).get_collection_timestamps(user_id)
+
+        # adding the tabs stamp
+        tabs_stamps = self.cache.get_tabs_timestamp(user_id)
+        if tabs_stamps is not None:
+            stamps['tabs'] = tabs_stamps
+        return stamps
+
+    def _stamps_key(self, user_id):
+        """Returns the key of the list of collection names of the user.
+
+        The key holds a version of the list, which costs one more read.
+        Like the generations, versions start at the current time in
+        milliseconds, so that an evicted version can't come back.
+        """
+        key = self.cache.user_key(user_id, 'stamps', 'version')
+        version = self.cache.get(key)
+        if version is None:
+            version = int(time.time() * 1000)
+            if not self.cache.add(key, version):
+                # another client initialized it first.
+                version = self.cache.get(key)
+                if version is None:
+                    raise BackendError('Could not read %r' % key)
+        return self.cache.user_key(user_id, 'stamps', version)
+
+    def _fill_stamps(self, user_id, computed):
+        """Caches the stamps from the database.
+
+        The stamps are only added, so that the ones written in the
+        meantime are not overwritten by older values.
+
+        Returns the list of collection names.
+        """
+        stamps = self._get_collection_timestamps(user_id)
+        computed.update(stamps)
+        self.cache.add_multi(dict([
+            (self.cache.user_key(user_id, 'stamp', name), stamp)
+            for name, stamp in stamps.items()]))
+        return stamps.keys()
+
+    def _get_stamps(self, user_id, names, computed):
+        """Reads the stamps of the given collections with a single call.
+
+        Returns None if some of them were evicted.
+        """
+        keys = dict([(self.cache.user_key(user_id, 'stamp', name), name)
+                     for name in names])
+        cached = self.cache.get_multi(keys.keys())
+        stamps = {}
+        for key, name in keys.items():
+            if key in cached:
+                stamps[name] = cached[key]
+            elif name in computed:
+                stamps[name] = computed[name]
+            else:
+                return None
+        return stamps
+
     def get_collection_timestamps(self, user_id):
         """Returns a cached version of the stamps when possible"""
-        stamps = self.cache.get(_key(user_id, 'stamps'))
+        if self._cache_is_down():
+            return self.sqlstorage.get_collection_timestamps(user_id)
 
-        # not cached yet or memcached is down
-        if stamps is None:
-            stamps = super(MemcachedSQLStorage,
-                           self).get_collection_timestamps(user_id)
-
-            # adding the tabs stamp
-            tabs_stamps = self.cache.get_tabs_timestamp(user_id)
-            if tabs_stamps is not None:
-                stamps['tabs'] = tabs_stamps
+        key = self._stamps_key(user_id)
+        computed = {}
 
-            # caching it
-            self.cache.set(_key(user_id, 'stamps'), stamps)
+        def _fill_stamps():
+            return self._fill_stamps(user_id, computed)
 
+        names = self.cache.get_set(key, _fill_stamps)
+        stamps = self._get_stamps(user_id, names, computed)
+        if stamps is None:
+            # some stamps were evicted, let's get them all again.
+            self.cache.invalidate(key)
+            names = self._fill_stamps(user_id, computed)
+            self.cache.add(key, names)
+            stamps = self._get_stamps(user_id, names, computed)
         return stamps
 
     def get_collection_max_timestamp(self, user_id, collection_name):
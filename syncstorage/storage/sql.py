@@ -55,11 +55,12 @@ For details of the prepared queries, see the file "queries.py".
 import urlparse
 from time import time
 from collections import defaultdict
+from contextlib import contextmanager
 
 import sqlalchemy.event
 from sqlalchemy.sql import (text as sqltext, select, bindparam, insert, update,
                             and_)
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, OperationalError, TimeoutError
 from sqlalchemy.sql.expression import _generative, Delete, _clone, ClauseList
 from sqlalchemy import util
 from sqlalchemy.sql.compiler import SQLCompiler
@@ -69,7 +70,10 @@ from sqlalchemy.pool import NullPool, QueuePool
 from metlog.decorators.stats import timeit as metlog_timeit
 from metlog.holder import CLIENT_HOLDER
 
+from syncstorage import requeststats
 from syncstorage.storage import StorageConflictError
+from syncstorage.storage.breaker import CircuitBreaker
+from syncstorage.storage.budget import get_connection_budget
 from syncstorage.storage.queries import get_query
 from syncstorage.storage.sqlmappers import (tables, users, collections,
                                             get_wbo_table_name, MAX_TTL,
@@ -77,7 +81,7 @@ from syncstorage.storage.sqlmappers import (tables, users, collections,
                                             get_wbo_table_byindex)
 from syncstorage.storage.sqlmappers import wbo as _wbo
 from services.util import (time2bigint, bigint2time, round_time,
-                           safe_execute, create_engine)
+                           safe_execute, create_engine, BackendError)
 from syncstorage.wbo import WBO
 
 
@@ -260,9 +264,14 @@ class QueuePoolWithMaxBacklog(QueuePool):
     of threads that can be in the queue waiting for a connection.  Once this
     limit has been reached, any further attempts to acquire a connection will
     be rejected immediately.
+
+    It can also be given a ConnectionBudget shared with the pools of other
+    hosts, and will only open a new connection if the budget allows it.
+    Otherwise it waits for one of its own connections to be returned.
     """
 
-    def __init__(self, creator, max_backlog=-1, **kwds):
+    def __init__(self, creator, max_backlog=-1, budget=None,
+                 budget_key=None, **kwds):
         # Wrap the creator callback with some metrics logging, unless it
         # has already been wrapped.
         if getattr(creator, "has_metlog_wrapper", False):
@@ -275,24 +284,112 @@ class QueuePoolWithMaxBacklog(QueuePool):
             logging_creator.has_metlog_wrapper = True
         QueuePool.__init__(self, logging_creator, **kwds)
         self._pool = _QueueWithMaxBacklog(self._pool.maxsize, max_backlog)
+        self._budget = budget
+        self._budget_key = budget_key
 
     def recreate(self):
         CLIENT_HOLDER.default_client.incr(METLOG_PREFIX + 'pool.recreate')
         new_self = QueuePool.recreate(self)
         new_self._pool = _QueueWithMaxBacklog(self._pool.maxsize,
                                               self._pool.max_backlog)
+        new_self._budget = self._budget
+        new_self._budget_key = self._budget_key
         return new_self
 
     def dispose(self):
         CLIENT_HOLDER.default_client.incr(METLOG_PREFIX + 'pool.dispose')
-        return QueuePool.dispose(self)
+        # Same as QueuePool.dispose(), but gives the closed connections
+        # back to the budget.
+        closed = 0
+        while True:
+            try:
+                conn = sqla_queue.Queue.get(self._pool, False)
+            except sqla_queue.Empty:
+                break
+            conn.close()
+            closed += 1
+        self._overflow = 0 - self.size()
+        self._release_budget(closed)
+        self.logger.info("Pool disposed. %s", self.status())
+
+    def _release_budget(self, count):
+        if self._budget is not None and count:
+            self._budget.release(self, self._budget_key, count)
+
+    def _create_connection(self):
+        if self._budget is not None:
+            if not self._budget.acquire(self, self._budget_key):
+                raise _BudgetExhausted()
+        try:
+            return QueuePool._create_connection(self)
+        except Exception:
+            self._release_budget(1)
+            raise
+
+    def _do_return_conn(self, conn):
+        # Same as QueuePool._do_return_conn(), but gives the connection
+        # back to the budget if it gets closed.
+        try:
+            self._pool.put(conn, False)
+        except sqla_queue.Full:
+            conn.close()
+            self._overflow_lock.acquire()
+            try:
+                self._overflow -= 1
+            finally:
+                self._overflow_lock.release()
+            self._release_budget(1)
+
+    def close_idle(self):
+        """Closes one of the idle connections of the pool.
+
+        This is used by the budget to give connections to other pools.
+        Returns False if there is no idle connection, or if the pool is
+        busy opening one.
+        """
+        # Don't wait for the lock: its holder may be waiting on the budget.
+        if not self._overflow_lock.acquire(False):
+            return False
+        try:
+            try:
+                conn = sqla_queue.Queue.get(self._pool, False)
+            except sqla_queue.Empty:
+                return False
+            self._overflow -= 1
+        finally:
+            self._overflow_lock.release()
+        conn.close()
+        self._release_budget(1)
+        return True
 
     @metlog_timeit(METLOG_PREFIX + 'pool.get')
     def _do_get(self):
-        c = QueuePool._do_get(self)
+        try:
+            c = QueuePool._do_get(self)
+        except _BudgetExhausted:
+            c = self._wait_for_connection()
         self.logger.debug("QueuePoolWithMaxBacklog status: %s", self.status())
         return c
 
+    def _wait_for_connection(self):
+        # The budget doesn't let us open a new connection, so wait for
+        # one of ours to be returned, if any is in use.
+        CLIENT_HOLDER.default_client.incr(METLOG_PREFIX +
+                                          'pool.budget_exceeded')
+        if self.checkedout() > 0:
+            try:
+                return self._pool.get(True, self._timeout)
+            except sqla_queue.Empty:
+                pass
+        raise TimeoutError("Connection budget of %d connections reached, "
+                           "connection timed out, timeout %d" %
+                           (self._budget.max_connections, self._timeout))
+
+
+class _BudgetExhausted(Exception):
+    """Raised by the pool when the budget doesn't allow a new connection."""
+    pass
+
 
 SHARED_POOLS = {}
 
@@ -312,6 +409,12 @@ class SQLStorage(object):
                                  exist at startup
         * use_quota/quota_size:  limit per-user storage to a specific quota
         * shard/shardsize:       enable sharding of the WBO table
+        * breaker_max_failures/breaker_reset_timeout:  stop sending queries
+                                 for some seconds after some consecutive
+                                 connection or timeout errors
+        * pool_budget/pool_budget_min:  limit the number of connections
+                                 opened by all the storages of the process,
+                                 guaranteeing a minimum to each host
 
     """
 
@@ -322,7 +425,9 @@ class SQLStorage(object):
                  shard=False, shardsize=100,
                  pool_max_overflow=10, pool_max_backlog=-1, no_pool=False,
                  pool_timeout=30, use_shared_pool=False,
-                 echo_pool=False, **kw):
+                 echo_pool=False, breaker_max_failures=5,
+                 breaker_reset_timeout=10, pool_budget=0, pool_budget_min=5,
+                 **kw):
 
         parsed_sqluri = urlparse.urlparse(sqluri)
         self.sqluri = sqluri
@@ -352,20 +457,43 @@ class SQLStorage(object):
                 'echo_pool': bool(echo_pool),
             }
 
+            # The pools of all the hosts can share a connection budget.
+            if int(pool_budget) > 0:
+                sqlkw['budget'] = get_connection_budget(pool_budget,
+                                                        pool_budget_min)
+                if use_shared_pool:
+                    sqlkw['budget_key'] = parsed_sqluri.hostname
+                else:
+                    sqlkw['budget_key'] = '%s%s' % (parsed_sqluri.hostname,
+                                                    parsed_sqluri.path)
+
             if self.driver in ('mysql', 'pymysql',
                                'mysql+mysqlconnector'):
                 sqlkw['pool_reset_on_return'] = reset_on_return
 
             self._engine = create_engine(sqluri, **sqlkw)
 
+        # The statements are counted in the stats of their request.
+        requeststats.watch_engine(self._engine)
+
         # If a shared pool is in use, set up an event listener to switch to
-        # the proper database each time a query is executed.
+        # the proper database when a query is executed.  The current database
+        # of each connection is remembered in its info dict, so the switch
+        # is only done when it changes.  The dict is cleared when the
+        # connection gets recycled or invalidated.
+        self.use_shared_pool = bool(use_shared_pool)
         if use_shared_pool:
             if parsed_sqluri.hostname not in SHARED_POOLS:
                 SHARED_POOLS[parsed_sqluri.hostname] = self._engine.pool
 
+            database = self._engine.url.database
+
             def switch_db(conn, cursor, query, *junk):
-                cursor.execute("use %s" % (self._engine.url.database,))
+                info = conn.info
+                if info.get('syncstorage.database') != database:
+                    info.pop('syncstorage.database', None)
+                    cursor.execute("use %s" % (database,))
+                    info['syncstorage.database'] = database
 
             sqlalchemy.event.listen(self._engine, 'before_cursor_execute',
                                     switch_db)
@@ -409,6 +537,14 @@ class SQLStorage(object):
             self._collections_by_id = None
             self._collections_by_name = None
 
+        # safe_execute() raises a BackendError on connection or timeout
+        # errors.  After a few of them the database is considered down,
+        # and queries fail right away instead of waiting for a timeout.
+        breaker_name = (parsed_sqluri.hostname or self.driver)
+        self.breaker = CircuitBreaker('sql.' + breaker_name.replace('.', '_'),
+                                      breaker_max_failures,
+                                      breaker_reset_timeout)
+
         # A per-user cache for collection metadata.
         # This is to avoid looking up the collection name <=> id mapping
         # in the database on every request.
@@ -423,6 +559,14 @@ class SQLStorage(object):
         """Return the name of the storage plugin"""
         return 'sql'
 
+    def close(self):
+        """Closes the connections of the storage.
+
+        A pool shared with the storages of other hosts is left open.
+        """
+        if not self.use_shared_pool:
+            self._engine.dispose()
+
     def is_healthy(self):
         """Check whether the backend is healthy and active."""
         # This executes a real query but, since there's no user with id zero,
@@ -430,9 +574,14 @@ class SQLStorage(object):
         self.collection_exists(0, "test_collection")
         return True
 
+    def _execute(self, engine, *args, **kwds):
+        """Execute a database query through the circuit breaker."""
+        with self.breaker.call():
+            return timed_safe_execute(engine, *args, **kwds)
+
     def _do_query(self, *args, **kwds):
         """Execute a database query, returning the rowcount."""
-        res = timed_safe_execute(self._engine, *args, **kwds)
+        res = self._execute(self._engine, *args, **kwds)
         try:
             return res.rowcount
         finally:
@@ -440,21 +589,45 @@ class SQLStorage(object):
 
     def _do_query_fetchone(self, *args, **kwds):
         """Execute a database query, returning the first result."""
-        res = timed_safe_execute(self._engine, *args, **kwds)
+        res = self._execute(self._engine, *args, **kwds)
         try:
-            return res.fetchone()
+            row = res.fetchone()
+            if row is not None:
+                requeststats.record_rows(1)
+            return row
         finally:
             res.close()
 
     def _do_query_fetchall(self, *args, **kwds):
         """Execute a database query, returning iterator over the results."""
-        res = timed_safe_execute(self._engine, *args, **kwds)
+        res = self._execute(self._engine, *args, **kwds)
         try:
             for row in res:
+                requeststats.record_rows(1)
                 yield row
         finally:
             res.close()
 
+    @contextmanager
+    def _transaction(self):
+        """Runs the queries done with the yielded connection atomically."""
+        with self.breaker.call():
+            try:
+                connection = self._engine.connect()
+            except (OperationalError, TimeoutError), exc:
+                raise BackendError(str(exc))
+        try:
+            trans = connection.begin()
+            try:
+                yield connection
+            except Exception:
+                trans.rollback()
+                raise
+            else:
+                trans.commit()
+        finally:
+            connection.close()
+
     #
     # Users APIs
     #
@@ -935,24 +1108,71 @@ class SQLStorage(object):
     def delete_item(self, user_id, collection_name, item_id,
                     storage_time=None):
         """Deletes an item"""
+        return self._delete_item(user_id, collection_name, item_id)[0]
+
+    def _delete_item(self, user_id, collection_name, item_id,
+                     with_size=False):
+        """Deletes an item.
+
+        Returns a (deleted, freed) tuple, where freed is the size in bytes
+        of the deleted payload.  It is only computed when `with_size` is
+        True, and is 0 otherwise.
+        """
         collection_id = self._get_collection_id(user_id, collection_name,
                                                 create=False)
         if collection_id is None:
-            return False
+            return False, 0
 
         query = self._get_query('DELETE_SOME_USER_WBO', user_id)
-        rowcount = self._do_query(query, user_id=user_id, item_id=item_id,
-                                  collection_id=collection_id)
-        return rowcount == 1
+        if not with_size:
+            rowcount = self._do_query(query, user_id=user_id,
+                                      item_id=item_id,
+                                      collection_id=collection_id)
+            return rowcount == 1, 0
+
+        wbo = self._get_wbo_table(user_id)
+        size_query = select([wbo.c.payload_size],
+                            and_(wbo.c.username == user_id,
+                                 wbo.c.collection == collection_id,
+                                 wbo.c.id == item_id), for_update=True)
+
+        # the size is read in the same transaction, and the row locked,
+        # so it's the size of the row we delete.
+        with self._transaction() as connection:
+            res = self._execute(connection, size_query)
+            try:
+                row = res.fetchone()
+            finally:
+                res.close()
+            res = self._execute(connection, query, user_id=user_id,
+                                item_id=item_id, collection_id=collection_id)
+            rowcount = res.rowcount
+            res.close()
+
+        if rowcount != 1:
+            return False, 0
+        return True, row is not None and row[0] or 0
 
     def delete_items(self, user_id, collection_name, item_ids=None,
                      filters=None, limit=None, offset=None, sort=None,
                      storage_time=None):
         """Deletes items. All items are removed unless item_ids is provided"""
+        return self._delete_items(user_id, collection_name, item_ids,
+                                  filters, limit, offset, sort)[0]
+
+    def _delete_items(self, user_id, collection_name, item_ids=None,
+                      filters=None, limit=None, offset=None, sort=None,
+                      with_size=False):
+        """Deletes items.
+
+        Returns a (deleted, freed) tuple, where freed is the size in bytes
+        of the deleted payloads.  It is only computed when `with_size` is
+        True, and is 0 otherwise.
+        """
         collection_id = self._get_collection_id(user_id, collection_name,
                                                 create=False)
         if collection_id is None:
-            return False
+            return False, 0
 
         wbo = self._get_wbo_table(user_id)
         query = _delete(wbo)
@@ -981,27 +1201,51 @@ class SQLStorage(object):
 
         where = and_(*where)
         query = query.where(where)
+        size_query = select([wbo.c.payload_size], where, for_update=True)
 
         if self.engine_name != 'sqlite':
             if sort is not None:
                 if sort == 'oldest':
-                    query = query.order_by(wbo.c.modified.asc())
+                    order_by = wbo.c.modified.asc()
                 elif sort == 'newest':
-                    query = query.order_by(wbo.c.modified.desc())
+                    order_by = wbo.c.modified.desc()
                 else:
-                    query = query.order_by(wbo.c.sortindex.desc())
+                    order_by = wbo.c.sortindex.desc()
+                query = query.order_by(order_by)
+                size_query = size_query.order_by(order_by)
 
             if limit is not None and int(limit) > 0:
                 query = query.limit(int(limit))
+                size_query = size_query.limit(int(limit))
 
             if offset is not None and int(offset) > 0:
                 query = query.offset(int(offset))
+                size_query = size_query.offset(int(offset))
+
+        if not with_size:
+            # XXX see if we want to send back more details
+            # e.g. by checking the rowcount
+            rowcount = self._do_query(query, user_id=user_id,
+                                      collection_id=collection_id)
+            return rowcount > 0, 0
+
+        # the sizes are read in the same transaction, and the rows locked,
+        # so they are the sizes of the rows we delete.
+        with self._transaction() as connection:
+            res = self._execute(connection, size_query, user_id=user_id,
+                                collection_id=collection_id)
+            try:
+                freed = sum([row[0] or 0 for row in res])
+            finally:
+                res.close()
+            res = self._execute(connection, query, user_id=user_id,
+                                collection_id=collection_id)
+            rowcount = res.rowcount
+            res.close()
 
-        # XXX see if we want to send back more details
-        # e.g. by checking the rowcount
-        rowcount = self._do_query(query, user_id=user_id,
-                                  collection_id=collection_id)
-        return rowcount > 0
+        if rowcount <= 0:
+            return False, 0
+        return True, freed
 
     def get_total_size(self, user_id, recalculate=False):
         """Returns the total size in KB of a user storage.
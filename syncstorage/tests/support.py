@@ -36,6 +36,7 @@
 # ***** END LICENSE BLOCK *****
 import os
 
+from syncstorage.requeststats import RequestStats
 from syncstorage.storage import SyncStorage
 from services.auth import ServicesAuth
 
@@ -48,6 +49,8 @@ def initenv(config=None, **env_args):
     # pre-registering plugins
     from syncstorage.storage.sql import SQLStorage
     SyncStorage.register(SQLStorage)
+    from syncstorage.storage.localcachedsql import LocalCachedSQLStorage
+    SyncStorage.register(LocalCachedSQLStorage)
     try:
         from syncstorage.storage.memcachedsql import MemcachedSQLStorage
         SyncStorage.register(MemcachedSQLStorage)
@@ -74,3 +77,22 @@ def initenv(config=None, **env_args):
 def cleanupenv(config=None, **env_args):
     env_args.setdefault('ini_dir', os.path.dirname(__file__))
     return services.tests.support.cleanupenv(config, **env_args)
+
+
+def assert_query_budget(stats, **budget):
+    """Checks that the storage calls of a request fit in a budget.
+
+    stats is a RequestStats, or the response to a request sent with the
+    X-Debug-Token of the app.  The budget gives the maximum value of some
+    of the counters of the stats, e.g.::
+
+        res = app.get(url, headers={"X-Debug-Token": token})
+        assert_query_budget(res, sql_statements=1, cache_calls=2)
+    """
+    if not isinstance(stats, RequestStats):
+        stats = RequestStats.from_headers(stats.headers)
+    over = ['%s is %s (budget: %s)' % (name, getattr(stats, name), limit)
+            for name, limit in sorted(budget.items())
+            if getattr(stats, name) > limit]
+    if over:
+        raise AssertionError('Over budget: %s' % ', '.join(over))
@@ -0,0 +1,147 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+
+from syncstorage.authcache import CachingAuthBackend, MAX_TTL
+
+
+class FakeAuthBackend(object):
+
+    def __init__(self):
+        self.passwords = {'bob': 'secret'}
+        self.calls = 0
+
+    def authenticate_user(self, user, credentials, attrs=None):
+        self.calls += 1
+        if self.passwords.get(user['username']) != credentials:
+            return None
+        user['userid'] = 42
+        for attr in attrs or ():
+            user[attr] = 'value of %s' % attr
+        return 42
+
+    def update_password(self, user, credentials, new_password):
+        self.passwords[user['username']] = new_password
+        return True
+
+    def delete_user(self, user, credentials=None):
+        del self.passwords[user['username']]
+        return True
+
+    def get_user_id(self, user):
+        if user['username'] not in self.passwords:
+            return None
+        return 42
+
+
+class TestCachingAuthBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = FakeAuthBackend()
+        self.auth = CachingAuthBackend(self.backend, ttl=60)
+
+    def _authenticate(self, password, attrs=None):
+        user = {'username': 'bob'}
+        return self.auth.authenticate_user(user, password, attrs), user
+
+    def test_successes_are_cached(self):
+        self.assertEquals(self._authenticate('secret')[0], 42)
+        self.assertEquals(self._authenticate('secret')[0], 42)
+        self.assertEquals(self.backend.calls, 1)
+
+        # the attributes loaded by the backend are restored.
+        user_id, user = self._authenticate('secret', ['syncNode'])
+        self.assertEquals(self.backend.calls, 2)
+        user_id, user = self._authenticate('secret', ['syncNode'])
+        self.assertEquals(self.backend.calls, 2)
+        self.assertEquals(user['syncNode'], 'value of syncNode')
+        self.assertEquals(user['userid'], 42)
+
+        # other methods are passed through.
+        self.assertEquals(self.auth.get_user_id({'username': 'bob'}), 42)
+
+    def test_failures_are_not_cached(self):
+        self.assertEquals(self._authenticate('wrong')[0], None)
+        self.assertEquals(self._authenticate('wrong')[0], None)
+        self.assertEquals(self.backend.calls, 2)
+
+        # a wrong password doesn't match the cached one.
+        self._authenticate('secret')
+        self.assertEquals(self._authenticate('wrong')[0], None)
+        self.assertEquals(self.backend.calls, 4)
+
+    def test_invalidation(self):
+        user = {'username': 'bob'}
+        self._authenticate('secret')
+        self.auth.update_password(user, 'secret', 'new')
+        self.assertEquals(self._authenticate('secret')[0], None)
+        self.assertEquals(self._authenticate('new')[0], 42)
+
+        self.auth.delete_user(user)
+        self.assertEquals(self._authenticate('new')[0], None)
+        self.assertEquals(self.backend.calls, 4)
+
+    def test_changes_made_elsewhere(self):
+        # the new password misses the cache, and replaces the old one.
+        self._authenticate('secret')
+        self.backend.passwords['bob'] = 'new'
+        self.assertEquals(self._authenticate('new')[0], 42)
+        self.assertEquals(self._authenticate('secret')[0], None)
+        self.assertEquals(self.backend.calls, 3)
+
+        # a rejected request drops the cached authentication.
+        self._authenticate('new')
+        self._authenticate('new')
+        self.assertEquals(self.backend.calls, 4)
+        self.assertEquals(self._authenticate('wrong')[0], None)
+        self._authenticate('new')
+        self.assertEquals(self.backend.calls, 6)
+
+        # so does an unknown user.
+        del self.backend.passwords['bob']
+        self.assertEquals(self.auth.get_user_id({'username': 'bob'}), None)
+        self.assertEquals(self._authenticate('new')[0], None)
+        self.assertEquals(self.backend.calls, 7)
+
+    def test_max_ttl(self):
+        auth = CachingAuthBackend(self.backend, ttl=3600)
+        self.assertEquals(auth._cache.ttl, MAX_TTL)
+
+    def test_expiration(self):
+        self.auth = CachingAuthBackend(self.backend, ttl=-1)
+        self._authenticate('secret')
+        self._authenticate('secret')
+        self.assertEquals(self.backend.calls, 2)
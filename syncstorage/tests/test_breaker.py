@@ -0,0 +1,135 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import threading
+import time
+
+from syncstorage.storage.breaker import (CircuitBreaker, CircuitOpenError,
+                                         CLOSED, OPEN, HALF_OPEN)
+
+from services.util import BackendError
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def _fail(self, breaker):
+        try:
+            with breaker.call():
+                raise BackendError()
+        except CircuitOpenError:
+            raise
+        except BackendError:
+            pass
+
+    def test_opens_after_max_failures(self):
+        breaker = CircuitBreaker('test', max_failures=3, reset_timeout=10)
+        self._fail(breaker)
+        self._fail(breaker)
+        # a success resets the count
+        with breaker.call():
+            pass
+        self._fail(breaker)
+        self._fail(breaker)
+        self.assertEquals(breaker.state, CLOSED)
+        self._fail(breaker)
+        self.assertEquals(breaker.state, OPEN)
+        self.assertFalse(breaker.allow())
+        self.assertRaises(CircuitOpenError, self._fail, breaker)
+        self.assertTrue(0 < breaker.retry_after() <= 10)
+
+    def test_other_errors_are_not_failures(self):
+        breaker = CircuitBreaker('test', max_failures=1)
+
+        def _call():
+            with breaker.call():
+                raise ValueError()
+
+        self.assertRaises(ValueError, _call)
+        self.assertEquals(breaker.state, CLOSED)
+
+    def test_half_open(self):
+        closed = []
+        breaker = CircuitBreaker('test', max_failures=1, reset_timeout=0.1,
+                                 on_close=lambda: closed.append(True))
+        self._fail(breaker)
+        self.assertEquals(breaker.state, OPEN)
+        time.sleep(0.2)
+        self.assertEquals(breaker.state, HALF_OPEN)
+
+        # checking the breaker doesn't claim the probe
+        self.assertTrue(breaker.available())
+        allowed = []
+        thread = threading.Thread(target=lambda:
+                                  allowed.append(breaker.available()))
+        thread.start()
+        thread.join()
+        self.assertEquals(allowed, [True])
+
+        # only one thread gets to probe the backend
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.available())
+        allowed = []
+
+        def _check():
+            allowed.append(breaker.available())
+            allowed.append(breaker.allow())
+
+        thread = threading.Thread(target=_check)
+        thread.start()
+        thread.join()
+        self.assertEquals(allowed, [False, False])
+
+        # a failed probe opens the breaker again
+        self._fail(breaker)
+        self.assertEquals(breaker.state, OPEN)
+        self.assertEquals(closed, [])
+
+        # a successful one closes it
+        time.sleep(0.2)
+        with breaker.call():
+            pass
+        self.assertEquals(breaker.state, CLOSED)
+        self.assertEquals(closed, [True])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestCircuitBreaker))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="test_suite")
@@ -0,0 +1,136 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import gc
+
+from sqlalchemy.exc import TimeoutError
+
+from syncstorage.storage.budget import ConnectionBudget
+from syncstorage.storage.sql import QueuePoolWithMaxBacklog
+from services.util import create_engine
+
+
+class TestConnectionBudget(unittest.TestCase):
+
+    def setUp(self):
+        self.budget = ConnectionBudget(4, min_per_host=1)
+
+    def _engine(self, key, pool_size=4):
+        # pool params are ignored for sqlite databases, so the pool
+        # class is given explicitly.
+        return create_engine("sqlite:///:memory:",
+                             poolclass=QueuePoolWithMaxBacklog,
+                             pool_size=pool_size, pool_timeout=1,
+                             max_overflow=0, budget=self.budget,
+                             budget_key=key)
+
+    def test_budget_is_shared(self):
+        engine1 = self._engine('host1')
+        engine2 = self._engine('host2')
+        conns = [engine1.connect() for i in range(3)]
+        conns.append(engine2.connect())
+        self.assertEquals(self.budget.utilization(),
+                          {'host1': 3, 'host2': 1})
+
+        # the budget is exhausted, and host1 has none to give back.
+        self.assertRaises(TimeoutError, engine1.connect)
+
+        # returned connections stay open, but can be reused.
+        conns.pop(0).close()
+        conns.append(engine1.connect())
+        self.assertEquals(self.budget.total, 4)
+
+    def test_minimum_is_reclaimed(self):
+        engine1 = self._engine('host1')
+        engine2 = self._engine('host2')
+        conns = [engine1.connect() for i in range(4)]
+        self.assertEquals(self.budget.utilization(), {'host1': 4})
+
+        # host2 can't get its minimum while they're all in use...
+        self.assertRaises(TimeoutError, engine2.connect)
+
+        # ...but takes it as soon as one of them is idle.
+        conns.pop().close()
+        conn = engine2.connect()
+        self.assertEquals(self.budget.utilization(),
+                          {'host1': 3, 'host2': 1})
+
+        # host2 is at its minimum, and host1 at its fair share, so
+        # host2 can't take more.
+        conns.pop().close()
+        conns.append(conn)
+        conns.append(engine2.connect())
+        self.assertEquals(self.budget.utilization(),
+                          {'host1': 2, 'host2': 2})
+        conns.pop(0).close()
+        self.assertRaises(TimeoutError, engine2.connect)
+        for conn in conns:
+            conn.close()
+
+    def test_idle_capacity_is_borrowed(self):
+        budget = self.budget = ConnectionBudget(6, min_per_host=1)
+        engine1 = self._engine('host1', pool_size=6)
+        engine2 = self._engine('host2', pool_size=6)
+
+        # host1 goes idle after a burst, and keeps its connections open.
+        conns = [engine1.connect() for i in range(6)]
+        for conn in conns:
+            conn.close()
+        self.assertEquals(budget.utilization(), {'host1': 6})
+
+        # host2 grows past its minimum, up to its fair share.
+        conns = [engine2.connect() for i in range(3)]
+        self.assertEquals(budget.utilization(), {'host1': 3, 'host2': 3})
+        self.assertRaises(TimeoutError, engine2.connect)
+        for conn in conns:
+            conn.close()
+
+    def test_dispose_releases_connections(self):
+        engine = self._engine('host1')
+        conns = [engine.connect() for i in range(3)]
+        for conn in conns:
+            conn.close()
+        self.assertEquals(self.budget.total, 3)
+        engine.dispose()
+        self.assertEquals(self.budget.total, 0)
+
+        # the connections of dead pools are given back too.
+        engine = self._engine('host1')
+        conn = engine.connect()
+        self.assertEquals(self.budget.total, 1)
+        del conn, engine
+        gc.collect()
+        self.assertEquals(self.budget.total, 0)
@@ -0,0 +1,81 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+from decimal import Decimal
+from cStringIO import StringIO
+
+from syncstorage.storage import codec
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_roundtrip(self):
+        values = [None, True, False, 0, 1, 127, 128, -1, -32, -33,
+                  2 ** 40, -2 ** 40, 2 ** 70, 1.5, '', 'abc', u'',
+                  u'\xe9t\xe9', u'x' * 300, 'x' * 70000, [], [1, [2, 3]],
+                  {}, {u'id': u'global', 'modified': Decimal('1.23')},
+                  dict((str(i), i) for i in range(100)), range(20)]
+        for value in values:
+            res = codec.decode(codec.encode(value))
+            self.assertEquals(res, value)
+            self.assertEquals(type(res), type(value))
+
+    def test_tuples_are_decoded_as_lists(self):
+        self.assertEquals(codec.decode(codec.encode((1, 2))), [1, 2])
+
+    def test_compression(self):
+        value = {'payload': 'x' * 2000}
+        raw = codec.encode(value)
+        compressed = codec.encode(value, compress_threshold=1000)
+        self.assertTrue(len(compressed) < len(raw))
+        self.assertEquals(codec.decode(compressed), value)
+
+        # values under the threshold are left alone.
+        self.assertEquals(codec.encode(value, compress_threshold=5000), raw)
+
+    def test_bad_data(self):
+        data = codec.encode({'a': 1})
+        self.assertRaises(codec.CodecError, codec.decode, data[:-1])
+        self.assertRaises(codec.CodecError, codec.decode, data + '\x00')
+        self.assertRaises(codec.CodecError, codec.decode, '\x02' + data[1:])
+        self.assertRaises(codec.CodecError, codec.encode, object())
+
+    def test_dumper(self):
+        dumper = codec.get_dumper(compress_threshold=10)
+        file = StringIO()
+        dumper(file).dump([u'a' * 100])
+        file.seek(0)
+        self.assertEquals(dumper(file).load(), [u'a' * 100])
@@ -0,0 +1,308 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import os
+import time
+import threading
+import unittest
+from tempfile import mkstemp
+
+from nose import SkipTest
+
+try:
+    import pylibmc  # NOQA
+except ImportError:
+    dbcheck = None
+else:
+    from syncstorage.scripts import dbcheck
+
+
+class FakeStorage(object):
+
+    def __init__(self, healthy=True, delay=0):
+        self.healthy = healthy
+        self.delay = delay
+        self.release = threading.Event()
+        self.closed = False
+
+    def is_healthy(self):
+        if self.delay:
+            self.release.wait(self.delay)
+        return self.healthy
+
+    def close(self):
+        self.closed = True
+
+
+class FakeApp(object):
+
+    def __init__(self, storages, cache_servers=('localhost:11211',)):
+        self.storages = storages
+        self.cache_servers = list(cache_servers)
+
+
+class FakeClient(object):
+
+    def __init__(self, servers, behaviors=None):
+        self.servers = servers
+        self.values = {}
+        self.casids = {}
+        self.connected = True
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def gets(self, key):
+        if key not in self.values:
+            return None, None
+        return self.values[key], self.casids[key]
+
+    def set(self, key, value):
+        self.values[key] = value
+        self.casids[key] = self.casids.get(key, 0) + 1
+        return True
+
+    def add(self, key, value):
+        if key in self.values:
+            return False
+        return self.set(key, value)
+
+    def cas(self, key, value, casid):
+        if self.casids.get(key) != casid:
+            return False
+        return self.set(key, value)
+
+    def disconnect_all(self):
+        self.connected = False
+
+
+class TestBackendChecker(unittest.TestCase):
+
+    def setUp(self):
+        if dbcheck is None:
+            raise SkipTest
+        fd, self.config_file = mkstemp()
+        os.close(fd)
+        self.apps = []
+        self._load_app = dbcheck.load_app_from_config
+        self._client = dbcheck.Client
+        dbcheck.load_app_from_config = lambda config_file: self.apps.pop(0)
+        dbcheck.Client = FakeClient
+        self.checker = None
+
+    def tearDown(self):
+        if self.checker is not None:
+            for storage in self.checker.storages.values():
+                storage.release.set()
+            self.checker.close()
+        dbcheck.load_app_from_config = self._load_app
+        dbcheck.Client = self._client
+        os.remove(self.config_file)
+
+    def _touch(self, offset):
+        mtime = os.stat(self.config_file).st_mtime + offset
+        os.utime(self.config_file, (mtime, mtime))
+
+    def _wait_for(self, predicate, timeout=2):
+        deadline = time.time() + timeout
+        while not predicate() and time.time() < deadline:
+            time.sleep(0.01)
+        return predicate()
+
+    def test_reload(self):
+        old_storage = FakeStorage()
+        self.apps.append(FakeApp({'a': old_storage}))
+        self.checker = dbcheck.BackendChecker(self.config_file,
+                                              max_workers=1)
+        self.assertTrue(self.checker.reload())
+        self.assertEquals(self.checker.storages, {'a': old_storage})
+        cache = self.checker.cache
+        self.assertEquals(cache.servers, ['localhost:11211'])
+
+        # nothing is reloaded until the file changes.
+        self.assertFalse(self.checker.reload())
+        self.assertFalse(old_storage.closed)
+
+        # the old storages are closed, and the memcache client is kept
+        # while the servers are the same.
+        new_storage = FakeStorage()
+        self.apps.append(FakeApp({'b': new_storage}))
+        self._touch(10)
+        self.assertTrue(self.checker.reload())
+        self.assertEquals(self.checker.storages, {'b': new_storage})
+        self.assertTrue(old_storage.closed)
+        self.assertTrue(self.checker.cache is cache)
+
+        self.apps.append(FakeApp({'b': FakeStorage()}, ['otherhost:11211']))
+        self._touch(10)
+        self.assertTrue(self.checker.reload())
+        self.assertFalse(cache.connected)
+        self.assertEquals(self.checker.cache.servers, ['otherhost:11211'])
+
+    def test_hung_hosts(self):
+        slow, fast = FakeStorage(delay=10), FakeStorage()
+        self.apps.append(FakeApp({'slow': slow, 'fast': fast}))
+        self.checker = checker = dbcheck.BackendChecker(
+            self.config_file, backend_timeout=0.2, max_workers=1)
+        checker.reload()
+
+        # the hung worker is replaced.
+        statuses = checker.ping(['slow'])
+        self.assertEquals(statuses, {'slow': None})
+        self.assertEquals(checker._workers, 2)
+
+        # the hung host is not pinged again, and the replacement worker
+        # takes care of the others.
+        statuses = checker.ping(['slow', 'fast'])
+        self.assertEquals(statuses['slow'], None)
+        self.assertTrue(statuses['fast'] is not None)
+        self.assertEquals(checker._workers, 2)
+
+        # once the ping completes, the surplus worker goes away.
+        slow.release.set()
+        self.assertTrue(self._wait_for(lambda: checker._workers == 1))
+        self.assertEquals(checker._hung, set())
+        statuses = checker.ping(['slow', 'fast'])
+        self.assertTrue(statuses['slow'] is not None)
+        self.assertTrue(statuses['fast'] is not None)
+
+    def test_status_transitions(self):
+        storage = FakeStorage()
+        self.apps.append(FakeApp({'a': storage}))
+        grader = dbcheck.HealthGrader(threshold=0.001, limit=0.002,
+                                      min_backoff=60, max_backoff=120,
+                                      window=1)
+        self.checker = checker = dbcheck.BackendChecker(
+            self.config_file, backend_timeout=1, max_workers=1,
+            grader=grader)
+
+        # a missing status stands for "ok", and is not written.
+        self.assertEquals(checker.check(), {'a': 'ok'})
+        cache = checker.cache
+        self.assertEquals(cache.get('status:a'), None)
+
+        # a slow backend is backed off, then back to normal.
+        storage.delay = 0.01
+        self.assertEquals(checker.check(), {'a': 'backoff:120'})
+        self.assertEquals(cache.get('status:a'), 'backoff:120')
+        storage.delay = 0
+        self.assertEquals(checker.check(), {'a': 'ok'})
+        self.assertEquals(cache.get('status:a'), 'ok')
+
+        storage.healthy = False
+        self.assertEquals(checker.check(), {'a': 'unhealthy'})
+        self.assertEquals(cache.get('status:a'), 'unhealthy')
+
+        # the statuses set by hand are left alone, even backoffs.
+        storage.healthy = True
+        for status in ('down', 'backoff:600'):
+            cache.set('status:a', status)
+            self.assertEquals(checker.check(), {})
+            self.assertEquals(cache.get('status:a'), status)
+
+        cache.set('status:a', 'ok')
+        storage.delay = 0.01
+        self.assertEquals(checker.check(), {'a': 'backoff:120'})
+        self.assertEquals(cache.get('status:a'), 'backoff:120')
+
+
+class TestHealthGrader(unittest.TestCase):
+
+    def setUp(self):
+        if dbcheck is None:
+            raise SkipTest
+
+    def test_histogram(self):
+        histogram = dbcheck.LatencyHistogram(window=4,
+                                             buckets=(0.1, 1, 10))
+        self.assertEquals(histogram.percentile(0.9), None)
+        for latency in (0.05, 0.5, 0.5, 5):
+            histogram.add(latency)
+        self.assertEquals(histogram.counts, [1, 2, 1, 0])
+        self.assertEquals(str(histogram), '<=0.1:1 <=1:2 <=10:1')
+        self.assertEquals(histogram.percentile(0), 0.05)
+        self.assertEquals(histogram.percentile(0.5), 0.5)
+        self.assertEquals(histogram.percentile(1), 5)
+
+        # only the last pings are kept.
+        histogram.add(50)
+        histogram.add(50)
+        self.assertEquals(histogram.counts, [0, 1, 1, 2])
+        self.assertEquals(histogram.percentile(0), 0.5)
+
+    def test_grades(self):
+        grader = dbcheck.HealthGrader(threshold=1, limit=11, min_backoff=60,
+                                      max_backoff=1060, percentile=1,
+                                      window=1)
+
+        def grade(latency):
+            histogram = grader.histogram()
+            histogram.add(latency)
+            return grader.grade(histogram)
+
+        self.assertEquals(grader.grade(grader.histogram()), 'ok')
+        self.assertEquals(grade(0.5), 'ok')
+        self.assertEquals(grade(1), 'ok')
+        self.assertEquals(grade(1.1), 'backoff:70')
+        self.assertEquals(grade(6), 'backoff:560')
+        self.assertEquals(grade(11), 'backoff:1060')
+        self.assertEquals(grade(100), 'backoff:1060')
+
+        self.assertRaises(ValueError, dbcheck.HealthGrader, threshold=2,
+                          limit=1)
+
+    def test_managed_status(self):
+        is_managed = dbcheck.is_managed_status
+        self.assertTrue(is_managed('ok'))
+        self.assertTrue(is_managed('unhealthy'))
+        self.assertFalse(is_managed('down'))
+        self.assertFalse(is_managed('draining'))
+        self.assertFalse(is_managed('backoff'))
+        self.assertFalse(is_managed('backoff:60'))
+
+        # only the backoff we wrote ourselves can be changed.
+        self.assertTrue(is_managed('backoff:60', 'backoff:60'))
+        self.assertFalse(is_managed('backoff:600', 'backoff:60'))
+        self.assertFalse(is_managed('down', 'unhealthy'))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestBackendChecker))
+    suite.addTest(unittest.makeSuite(TestHealthGrader))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="test_suite")
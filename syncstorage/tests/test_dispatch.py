@@ -0,0 +1,105 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+
+from routes import Mapper
+
+from syncstorage.dispatch import Dispatcher
+from syncstorage.wsgiapp import urls
+
+
+_PATHS = ['/1.0/bob/info/collections',
+          '/1.1/bob/info/collection_counts',
+          '/1/bob/info/quota',
+          '/1.0/bob/info/collection_usage',
+          '/1.0/bob/info/unknown',
+          '/1.0/bob/info',
+          '/1.0/bob/storage/',
+          '/1.0/bob/storage',
+          '/1.0/bob/storage/meta',
+          '/1.0/bob/storage/meta/global',
+          '/1.0/bob/storage/meta/global/',
+          '/1.0/bob/storage/meta.json',
+          '/1.0/bob/storage/meta/glo.bal',
+          '/1.0/bob/storage/meta/glo?b#a~l',
+          '/1.0/bob/storage/meta/glo\\bal',
+          '/1.0/bob/storage/meta/glo bal',
+          '/1.0/bob/storage/me ta/global',
+          '/1.0/b@b/storage/meta/global',
+          '/2.0/bob/storage/meta/global',
+          '/1.0/bob/storage/meta/global/more',
+          '/1.0/bob/storage/meta/gl\xc3\xa9bal',
+          '/1.0/bob/foo/meta',
+          '/1.0/bob',
+          '/',
+          '']
+
+
+class TestDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        # the mapper is built the same way SyncServerApp builds it.
+        self.mapper = Mapper()
+        for method, pattern, controller, action, extras in urls:
+            self.mapper.connect(None, pattern, controller=controller,
+                                action=action,
+                                conditions=dict(method=[method]), **extras)
+        self.dispatcher = Dispatcher(urls)
+
+    def _routematch(self, matcher, method, path):
+        environ = {'PATH_INFO': path, 'REQUEST_METHOD': method}
+        res = matcher.routematch(environ=environ)
+        if res is None:
+            return None
+        return res[0]
+
+    def test_same_matches_as_routes(self):
+        for method in ('GET', 'PUT', 'POST', 'DELETE', 'HEAD'):
+            for path in _PATHS:
+                expected = self._routematch(self.mapper, method, path)
+                res = self._routematch(self.dispatcher, method, path)
+                self.assertEquals(res, expected, (method, path))
+
+    def test_match(self):
+        match, route = self.dispatcher.match('GET',
+                                             '/1.0/bob/storage/meta/global')
+        self.assertEquals(match, {'api': u'1.0', 'username': u'bob',
+                                  'collection': u'meta', 'item': u'global',
+                                  'controller': u'storage',
+                                  'action': u'get_item', 'auth': u'True'})
+        self.assertEquals(route.method, 'GET')
+        self.assertEquals(self.dispatcher.match('PATCH', '/1.0/bob/storage'),
+                          None)
@@ -0,0 +1,137 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import os
+import unittest
+from tempfile import mkstemp
+
+from sqlalchemy.sql import select
+
+from syncstorage.scripts import gendata
+from syncstorage.storage.sql import SQLStorage
+
+
+class TestGenData(unittest.TestCase):
+
+    def setUp(self):
+        self.dbfiles = []
+        self.weights = gendata.parse_weights(gendata.DEFAULT_WEIGHTS)
+
+    def tearDown(self):
+        for dbfile in self.dbfiles:
+            os.remove(dbfile)
+
+    def _storage(self):
+        fd, dbfile = mkstemp()
+        os.close(fd)
+        self.dbfiles.append(dbfile)
+        return SQLStorage('sqlite:///' + dbfile, create_tables=True,
+                          fixed_collections=True, shard=True, shardsize=3)
+
+    def _generator(self, now=None):
+        return gendata.UserGenerator(self.weights, min_items=2,
+                                     max_items=20, seed=1, now=now)
+
+    def _rows(self, storage):
+        rows = []
+        for index in range(storage.shardsize):
+            query = 'select username, collection, id, modified, payload ' \
+                    'from wbo%d' % index
+            rows.extend([tuple(row) for row in
+                         storage._engine.execute(query).fetchall()])
+        return sorted(rows)
+
+    def test_generator(self):
+        items = list(self._generator(now=1000000000).items(7))
+        self.assertEquals(list(self._generator(now=1000000000).items(7)),
+                          items)
+        self.assertEquals(items[0][0], 'meta')
+        self.assertEquals(items[0][1]['id'], 'global')
+        for collection, item in items:
+            self.assertEquals(item['payload_size'], len(item['payload']))
+
+        # the users differ, and so do the runs started at other times.
+        self.assertNotEquals(list(self._generator(now=1000000000).items(8)),
+                             items)
+        other = list(self._generator(now=1000000100).items(7))
+        self.assertEquals([item['payload'] for collection, item in other],
+                          [item['payload'] for collection, item in items])
+        self.assertNotEquals(other, items)
+
+    def test_partitions(self):
+        loader = gendata.Loader(self._storage(), self._generator(), 5, 20)
+        self.assertEquals(loader.partitions, 3)
+        users = []
+        for partition in range(loader.partitions):
+            partition_users = list(loader._users(partition, 4))
+            # each partition holds the users of one shard.
+            self.assertEquals(set([user % 3 for user in partition_users]),
+                              set([partition]))
+            users.extend(partition_users)
+        self.assertEquals(sorted(users), range(5, 25))
+
+        # resuming skips the users already loaded.
+        self.assertEquals(list(loader._users(1, 13)), [16, 19, 22])
+
+    def test_resume(self):
+        # an uninterrupted run.
+        storage = self._storage()
+        gendata.Loader(storage, self._generator(), 1, 20, workers=2).run()
+        query = select([gendata.start.c.now])
+        now = storage._engine.execute(query).fetchone()[0]
+        expected = self._rows(storage)
+        self.assertTrue(expected)
+
+        # a run interrupted after the first half of the users, then
+        # resumed later on.
+        storage = self._storage()
+        gendata.Loader(storage, self._generator(), 1, 10, workers=2,
+                       now=now).run()
+        self.assertNotEquals(self._rows(storage), expected)
+        loader = gendata.Loader(storage, self._generator(now=now + 100), 1,
+                                20, workers=2)
+        self.assertEquals(loader.generator.now, now)
+        loader.run()
+        self.assertEquals(loader.users, 10)
+        self.assertEquals(self._rows(storage), expected)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestGenData))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="test_suite")
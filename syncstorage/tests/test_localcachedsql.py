@@ -0,0 +1,149 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import unittest
+import time
+from tempfile import mkstemp
+import os
+
+from syncstorage.storage import SyncStorage
+from syncstorage.storage.sql import SQLStorage
+from syncstorage.storage.localcachedsql import LocalCachedSQLStorage, LRUCache
+
+_UID = 1
+_PLD = '*' * 500
+
+# manual registration
+SyncStorage.register(LocalCachedSQLStorage)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        # b is now the least recently used
+        cache.set('c', 3)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('c'), 3)
+        self.assertEquals(len(cache), 2)
+
+    def test_ttl(self):
+        cache = LRUCache(ttl=0.1)
+        cache.set('a', 1)
+        self.assertEquals(cache.get('a'), 1)
+        time.sleep(0.2)
+        self.assertEquals(cache.get('a'), None)
+
+
+class TestLocalCachedSQLStorage(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.dbfile = mkstemp()
+        os.close(fd)
+        fn = 'syncstorage.storage.localcachedsql.LocalCachedSQLStorage'
+        self.storage = SyncStorage.get(fn, sqluri='sqlite:///%s' %
+                                       self.dbfile, create_tables=True)
+        # another process writing in the same database
+        self.sqlstorage = SQLStorage('sqlite:///%s' % self.dbfile)
+        self.storage.set_user(_UID, email='tarek@ziade.org')
+
+    def tearDown(self):
+        self.storage.delete_user(_UID)
+        if os.path.exists(self.dbfile):
+            os.remove(self.dbfile)
+
+    def test_stamps_and_counts(self):
+        self.storage.set_item(_UID, 'col1', '1', payload=_PLD)
+        stamps = self.storage.get_collection_timestamps(_UID)
+        self.assertEquals(stamps.keys(), ['col1'])
+        self.assertEquals(self.storage.get_collection_counts(_UID),
+                          {'col1': 1})
+
+        # these are cached now, and writes done by other processes
+        # are not seen.
+        self.sqlstorage.set_item(_UID, 'col2', '1', payload=_PLD)
+        self.assertEquals(self.storage.get_collection_timestamps(_UID),
+                          stamps)
+
+        # writes done through the storage are.
+        self.storage.set_item(_UID, 'col1', '2', payload=_PLD)
+        counts = self.storage.get_collection_counts(_UID)
+        self.assertEquals(counts, {'col1': 2, 'col2': 1})
+        self.storage.delete_item(_UID, 'col1', '2')
+        counts = self.storage.get_collection_counts(_UID)
+        self.assertEquals(counts, {'col1': 1, 'col2': 1})
+        self.assertEquals(self.storage.get_collection_max_timestamp(_UID,
+                          'col3'), None)
+
+    def test_meta_global(self):
+        self.assertEquals(self.storage.get_item(_UID, 'meta', 'global'), None)
+        self.storage.set_item(_UID, 'meta', 'global', payload=_PLD)
+        item = self.storage.get_item(_UID, 'meta', 'global')
+        self.assertEquals(item['payload'], _PLD)
+        item = self.storage.get_item(_UID, 'meta', 'global', fields=['id'])
+        self.assertEquals(item, {'id': 'global'})
+
+        self.storage.set_item(_UID, 'meta', 'global', payload='new')
+        item = self.storage.get_item(_UID, 'meta', 'global')
+        self.assertEquals(item['payload'], 'new')
+
+        self.storage.delete_storage(_UID)
+        self.assertEquals(self.storage.get_item(_UID, 'meta', 'global'), None)
+
+    def test_collection_names(self):
+        self.storage.set_collection(_UID, 'col1')
+        names = self.storage.get_collection_names(_UID)
+        self.assertEquals([name for id, name in names], ['col1'])
+        self.storage.set_item(_UID, 'col2', '1', payload=_PLD)
+        names = self.storage.get_collection_names(_UID)
+        self.assertEquals(sorted([name for id, name in names]),
+                          ['col1', 'col2'])
+        self.storage.delete_collection(_UID, 'col1')
+        names = self.storage.get_collection_names(_UID)
+        self.assertEquals([name for id, name in names], ['col2'])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestLRUCache))
+    suite.addTest(unittest.makeSuite(TestLocalCachedSQLStorage))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="test_suite")
@@ -35,6 +35,7 @@
 # ***** END LICENSE BLOCK *****
 import unittest
 import time
+import threading
 from decimal import Decimal
 from tempfile import mkstemp
 import os
@@ -47,7 +48,8 @@ else:
     MEMCACHED = True
     from syncstorage.storage.memcachedsql import MemcachedSQLStorage
     from syncstorage.storage.memcachedsql import QUOTA_RECALCULATION_PERIOD
-    from syncstorage.storage.cachemanager import _KB
+    from syncstorage.storage import cachemanager
+    from syncstorage.storage.cachemanager import _KB, AsyncWriter
 
 from nose import SkipTest
 
@@ -75,6 +77,7 @@ class TestMemcachedSQLStorage(unittest.TestCase):
         'use_quota': True,
         'quota_size': 5120,
         'create_tables': True,
+        'cached_collections': 'crypto,clients',
     }
 
     def setUp(self):
@@ -106,6 +109,9 @@ class TestMemcachedSQLStorage(unittest.TestCase):
         if os.path.exists(self.dbfile):
             os.remove(self.dbfile)
 
+    def _key(self, name):
+        return self.storage.cache.user_key(_UID, name)
+
     def _is_up(self):
         try:
             self.storage.cache.set('test', 1)
@@ -145,19 +151,19 @@ class TestMemcachedSQLStorage(unittest.TestCase):
         #   - the "global" wbo for the "meta" collection
         #   - the size of all wbos
         if self._is_up():
-            meta = self.storage.cache.get('1:meta:global')
+            meta = self.storage.cache.get(self._key('meta:global'))
             self.assertEquals(meta['id'], 'global')
-            size = self.storage.cache.get('1:size')
+            size = self.storage.cache.get(self._key('size'))
             self.assertEquals(size, len(_PLD))
 
         # this should remove the cache for meta global
         self.storage.delete_item(_UID, 'meta', 'global')
 
         if self._is_up():
-            meta = self.storage.cache.get('1:meta:global')
+            meta = self.storage.cache.get(self._key('meta:global'))
             self.assertEquals(meta, None)
-            size = self.storage.cache.get('1:size')
-            self.assertEquals(size, len(_PLD))
+            size = self.storage.cache.get(self._key('size'))
+            self.assertEquals(size, 0)
 
         # let's store some items in the meta collection
         # and checks that the global object is uploaded
@@ -167,7 +173,7 @@ class TestMemcachedSQLStorage(unittest.TestCase):
         self.storage.set_items(_UID, 'meta', items)
 
         if self._is_up():
-            global_ = self.storage.cache.get('1:meta:global')
+            global_ = self.storage.cache.get(self._key('meta:global'))
             self.assertEquals(global_['payload'], 'xyx')
 
         # this should remove the cache
@@ -176,7 +182,7 @@ class TestMemcachedSQLStorage(unittest.TestCase):
         self.assertEquals(len(items), 0)
 
         if self._is_up():
-            meta = self.storage.cache.get('1:meta:global')
+            meta = self.storage.cache.get(self._key('meta:global'))
             self.assertEquals(meta, None)
 
     def test_tabs(self):
@@ -190,28 +196,140 @@ class TestMemcachedSQLStorage(unittest.TestCase):
         # these calls should be cached
         res = self.storage.get_item(_UID, 'tabs', '1')
         self.assertEquals(res['payload'], _PLD)
-        tabs = self.storage.cache.get('1:tabs')
+        tabs = self.storage.cache.get(self._key('tabs'))
         self.assertEquals(tabs['1']['payload'], _PLD)
 
         # this should remove the cache
         self.storage.delete_item(_UID, 'tabs', '1')
-        tabs = self.storage.cache.get('1:tabs')
+        tabs = self.storage.cache.get(self._key('tabs'))
         self.assertFalse('1' in tabs)
 
         #  adding some stuff
         items = [{'id': '1', 'payload': 'xxx'},
                 {'id': '2', 'payload': 'xxx'}]
         self.storage.set_items(_UID, 'tabs', items)
-        tabs = self.storage.cache.get('1:tabs')
+        tabs = self.storage.cache.get(self._key('tabs'))
         self.assertEquals(len(tabs), 2)
 
         # this should remove the cache
         self.storage.delete_items(_UID, 'tabs')
         items = self.storage.get_items(_UID, 'tabs')
         self.assertEquals(len(items), 0)
-        tabs = self.storage.cache.get('1:tabs')
+        tabs = self.storage.cache.get(self._key('tabs'))
         self.assertEquals(tabs, {})
 
+    def test_concurrent_tabs_updates(self):
+        if not self._is_up():  # no memcached == no tabs
+            raise SkipTest
+
+        # several threads adding tabs for the same user should not
+        # overwrite each other's updates.
+        def _add_tabs(thread_num):
+            for num in range(10):
+                tab_id = '%d-%d' % (thread_num, num)
+                tab = {'id': tab_id, 'payload': 'xxx', 'modified': 1}
+                self.storage.cache.set_tabs(_UID, {tab_id: tab})
+
+        threads = [threading.Thread(target=_add_tabs, args=(num,))
+                   for num in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(len(self.storage.cache.get_tabs(_UID)), 50)
+
+        self.assertTrue(self.storage.cache.delete_tab(_UID, '0-0'))
+        self.assertFalse(self.storage.cache.delete_tab(_UID, '0-0'))
+        self.assertEquals(len(self.storage.cache.get_tabs(_UID)), 49)
+
+    def test_get_set_single_flight(self):
+        if not self._is_up():
+            raise SkipTest
+
+        calls = []
+
+        def _refill():
+            calls.append(1)
+            time.sleep(0.2)
+            return {'foo': 1}
+
+        # concurrent misses on the same key should call the refill once.
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+                       self.storage.cache.get_set('1:refill', _refill)))
+                   for num in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(results, [{'foo': 1}] * 10)
+
+        # when another client holds the lease, the stale copy is served.
+        self.storage.cache.delete('1:refill')
+        self.storage.cache.add('1:refill:lease', 1, 10)
+        self.assertEquals(self.storage.cache.get_set('1:refill', _refill),
+                          {'foo': 1})
+        self.assertEquals(len(calls), 1)
+
+        # when the other client's refill gives nothing, the waiters
+        # don't wait for the whole LEASE_WAIT.
+        self.storage.cache.add('1:none:lease', 1, 10)
+        timer = threading.Timer(0.1, self.storage.cache.delete,
+                                ['1:none:lease'])
+        timer.start()
+        start = time.time()
+        self.assertEquals(self.storage.cache.get_set('1:none', _refill),
+                          {'foo': 1})
+        self.assertTrue(time.time() - start < 1)
+        timer.join()
+
+    def test_cached_collections(self):
+        if not self._is_up():
+            raise SkipTest
+        self.storage.set_user(_UID, email='tarek@ziade.org')
+        self.storage.set_item(_UID, 'crypto', 'keys', payload=_PLD,
+                              sortindex=1)
+        self.storage.set_item(_UID, 'crypto', 'other', payload=_PLD,
+                              sortindex=2)
+
+        # the whole collection is now cached
+        items = self.storage.get_items(_UID, 'crypto', sort='index')
+        self.assertEquals([item['id'] for item in items], ['other', 'keys'])
+        key = self._key('collection:crypto')
+        self.assertEquals(len(self.storage.cache.get(key)['items']), 2)
+
+        item = self.storage.get_item(_UID, 'crypto', 'keys',
+                                     fields=['id', 'payload'])
+        self.assertEquals(item, {'id': 'keys', 'payload': _PLD})
+        self.assertEquals(self.storage.get_item(_UID, 'crypto', 'xxx'), None)
+
+        items = self.storage.get_items(_UID, 'crypto', fields=['id'],
+                                       filters={'id': ('in', ['keys'])})
+        self.assertEquals(items, [{'id': 'keys'}])
+
+        # writes are seen by the next read
+        self.storage.set_item(_UID, 'crypto', 'keys', payload='new')
+        item = self.storage.get_item(_UID, 'crypto', 'keys')
+        self.assertEquals(item['payload'], 'new')
+        self.storage.delete_item(_UID, 'crypto', 'other')
+        self.assertEquals(len(self.storage.get_items(_UID, 'crypto')), 1)
+
+        # a failed write to memcached still returns the items
+        def _set(*args, **kw):
+            raise BackendError()
+
+        self.storage.set_item(_UID, 'crypto', 'keys', payload='newer')
+        old_set = self.storage.cache.set
+        self.storage.cache.set = _set
+        try:
+            item = self.storage.get_item(_UID, 'crypto', 'keys')
+            self.assertEquals(item['payload'], 'newer')
+        finally:
+            self.storage.cache.set = old_set
+
     def test_size(self):
         # make sure we get the right size
         if not self._is_up():  # no memcached == no size
@@ -230,7 +348,7 @@ class TestMemcachedSQLStorage(unittest.TestCase):
 
         # removing the size in memcache to check that we
         # get back the right value
-        self.storage.cache.delete('%d:size' % _UID)
+        self.storage.cache.delete(self._key('size'))
         self.assertEquals(self.storage.get_total_size(_UID), wanted)
 
         # adding an item should increment the cached size.
@@ -241,13 +359,23 @@ class TestMemcachedSQLStorage(unittest.TestCase):
         # if we suffer a cache clear, then get_size_left should not
         # fall back to the database, while get_total_size should.
         quota_size = self.storage.quota_size
-        self.storage.cache.delete('%d:size' % _UID)
+        self.storage.cache.delete(self._key('size'))
         self.assertEquals(self.storage.get_size_left(_UID), quota_size)
         self.assertEquals(self.storage.get_total_size(_UID), wanted)
         # that should have re-populated the cache.
         self.assertEquals(self.storage.get_size_left(_UID),
                           quota_size - wanted)
 
+        # deleting items should decrement the cached size.
+        self.storage.delete_item(_UID, 'foo', '2')
+        wanted -= len(_PLD) / 1024.
+        self.assertEquals(self.storage.get_size_left(_UID),
+                          quota_size - wanted)
+        self.storage.delete_items(_UID, 'foo')
+        wanted -= len(_PLD) / 1024.
+        self.assertEquals(self.storage.get_size_left(_UID),
+                          quota_size - wanted)
+
     def test_collection_stamps(self):
         if not self._is_up():
             return
@@ -262,8 +390,8 @@ class TestMemcachedSQLStorage(unittest.TestCase):
 
         stamps = self.storage.get_collection_timestamps(_UID)  # pump cache
         if self._is_up():
-            cached_stamps = self.storage.cache.get('1:stamps')
-            self.assertEquals(stamps['tabs'], cached_stamps['tabs'])
+            cached_stamp = self.storage.cache.get(self._key('stamp:tabs'))
+            self.assertEquals(stamps['tabs'], cached_stamp)
 
         stamps2 = self.storage.get_collection_timestamps(_UID)
         self.assertEquals(len(stamps), len(stamps2))
@@ -274,8 +402,7 @@ class TestMemcachedSQLStorage(unittest.TestCase):
 
         # checking the stamps
         if self._is_up():
-            stamps = self.storage.cache.get('1:stamps')
-            keys = stamps.keys()
+            keys = self.storage.cache.get(self.storage._stamps_key(_UID))
             keys.sort()
             self.assertEquals(keys, ['foo', 'tabs'])
 
@@ -286,32 +413,99 @@ class TestMemcachedSQLStorage(unittest.TestCase):
 
         # checking the stamps
         if self._is_up():
-            stamps = self.storage.cache.get('1:stamps')
-            self.assertEqual(stamps['baz'], now)
+            stamp = self.storage.cache.get(self._key('stamp:baz'))
+            self.assertEqual(stamp, now)
 
         stamps = self.storage.get_collection_timestamps(_UID)
         if self._is_up():
-            _stamps = self.storage.cache.get('1:stamps')
-            keys = _stamps.keys()
+            keys = self.storage.cache.get(self.storage._stamps_key(_UID))
             keys.sort()
             self.assertEquals(keys, ['baz', 'foo', 'tabs'])
 
         # deleting the item should also update the stamp
         time.sleep(0.2)    # to make sure the stamps differ
         now = round_time()
-        cached_size = self.storage.cache.get('1:size')
+        cached_size = self.storage.cache.get(self._key('size'))
         self.storage.delete_item(_UID, 'baz', '2', storage_time=now)
         stamps = self.storage.get_collection_timestamps(_UID)
         self.assertEqual(stamps['baz'], now)
 
-        # that should have left the cached size alone.
-        self.assertEquals(self.storage.cache.get('1:size'), cached_size)
+        # that should have decremented the cached size.
+        self.assertTrue(self.storage.cache.get(self._key('size')) <
+                        cached_size)
 
-        # until we force it to be recalculated.
+        # recalculating it gives the same result.
         size = self.storage.get_collection_sizes(1)
-        self.assertEqual(self.storage.cache.get('1:size') / 1024.,
+        self.assertEqual(self.storage.cache.get(self._key('size')) / 1024.,
                          sum(size.values()))
 
+    def test_evicted_stamps(self):
+        if not self._is_up():
+            raise SkipTest
+        self.storage.set_user(_UID, email='tarek@ziade.org')
+        self.storage.set_item(_UID, 'foo', '1', payload=_PLD)
+        self.storage.set_item(_UID, 'bar', '1', payload=_PLD)
+        stamps = self.storage.get_collection_timestamps(_UID)
+
+        # a write never needs to read the stamps of the other collections
+        self.storage.cache.delete(self._key('stamp:bar'))
+        now = round_time()
+        self.storage.set_item(_UID, 'foo', '2', payload=_PLD,
+                              storage_time=now)
+        self.assertEquals(self.storage.cache.get(self._key('stamp:bar')),
+                          None)
+
+        # the missing stamps are read again from the database
+        new_stamps = self.storage.get_collection_timestamps(_UID)
+        self.assertEquals(new_stamps, {'foo': now, 'bar': stamps['bar']})
+
+    def test_stamps_race(self):
+        if not self._is_up():
+            raise SkipTest
+        self.storage.set_user(_UID, email='tarek@ziade.org')
+        self.storage.set_item(_UID, 'foo', '1', payload=_PLD)
+        self.storage.get_collection_timestamps(_UID)
+
+        # a list of names computed before a collection is created, and
+        # cached after it, is not used.
+        key = self.storage._stamps_key(_UID)
+        self.storage.cache.invalidate(key)
+        names = self.storage._fill_stamps(_UID, {})
+        self.storage.set_item(_UID, 'bar', '1', payload=_PLD)
+        self.assertTrue(self.storage.cache.add(key, names))
+        stamps = self.storage.get_collection_timestamps(_UID)
+        self.assertEquals(sorted(stamps.keys()), ['bar', 'foo'])
+
+    def test_stamps_shared_cache(self):
+        if not self._is_up():
+            raise SkipTest
+        kwds = self.STORAGE_CONFIG.copy()
+        kwds['sqluri'] = 'sqlite:///%s' % self.dbfile
+        other = SyncStorage.get(self.fn, **kwds)
+        old_wait = cachemanager.LEASE_WAIT
+        cachemanager.LEASE_WAIT = 0.1
+        try:
+            self.storage.set_user(_UID, email='tarek@ziade.org')
+            self.storage.set_item(_UID, 'foo', '1', payload=_PLD)
+            stamps = self.storage.get_collection_timestamps(_UID)
+            self.assertEquals(stamps.keys(), ['foo'])
+
+            # another webhead creates a collection.
+            other.set_item(_UID, 'bar', '1', payload=_PLD)
+
+            # while the list of names is refilled, the stale copy must
+            # not be served without the new collection.
+            key = self.storage._stamps_key(_UID)
+            self.storage.cache.delete(key)
+            self.storage.cache.add(key + ':lease', 1, 10)
+            stamps = self.storage.get_collection_timestamps(_UID)
+            self.assertEquals(sorted(stamps.keys()), ['bar', 'foo'])
+            stamps = other.get_collection_timestamps(_UID)
+            self.assertEquals(sorted(stamps.keys()), ['bar', 'foo'])
+        finally:
+            cachemanager.LEASE_WAIT = old_wait
+            other.close()
+
     def test_collection_sizes(self):
         if not self._is_up():  # no memcached
             return
@@ -377,6 +571,56 @@ class TestMemcachedSQLStorage(unittest.TestCase):
         stamps = self.storage.get_collection_timestamps(_UID)
         self.assertEquals(len(stamps), 0)
 
+    def test_flush_user_cache(self):
+        if not self._is_up():
+            raise SkipTest
+        self.storage.set_user(_UID, email='tarek@ziade.org')
+        self.storage.set_item(_UID, 'meta', 'global', payload=_PLD)
+        self.storage.set_item(_UID, 'tabs', '1', payload=_PLD)
+        generation = self.storage.cache.get_generation(_UID)
+        self.assertNotEquals(self.storage.cache.get(self._key('tabs')), None)
+
+        # all the keys of the user are dropped at once
+        self.storage.cache.flush_user_cache(_UID)
+        self.assertTrue(self.storage.cache.get_generation(_UID) > generation)
+        self.assertEquals(self.storage.cache.get(self._key('tabs')), None)
+        self.assertEquals(self.storage.cache.get(self._key('meta:global')),
+                          None)
+
+    def test_cache_down(self):
+        if not self._is_up():
+            raise SkipTest
+        self.storage.set_user(_UID, email='tarek@ziade.org')
+        self.storage.set_item(_UID, 'col1', '1', payload=_PLD)
+        self.storage.set_item(_UID, 'tabs', '1', payload=_PLD)
+        self.storage.set_item(2, 'tabs', '1', payload=_PLD)
+        self.storage.get_collection_timestamps(_UID)
+
+        # let's pretend memcached is down
+        breaker = self.storage.cache.breaker
+        breaker.reset_timeout = 0.2
+        for i in range(breaker.max_failures):
+            breaker.failure()
+        self.assertRaises(BackendError, self.storage.cache.get, 'test')
+
+        # everything goes to SQL, and tabs are empty
+        now = round_time()
+        self.storage.set_item(_UID, 'col1', '2', payload=_PLD,
+                              storage_time=now)
+        self.assertEquals(len(self.storage.get_items(_UID, 'col1')), 2)
+        self.assertEquals(self.storage.get_items(_UID, 'tabs'), [])
+        stamps = self.storage.get_collection_timestamps(_UID)
+        self.assertEquals(stamps, {'col1': now})
+
+        # once it's back, the cache of the users written meanwhile is
+        # dropped, since it missed the writes.  The others are kept.
+        time.sleep(0.3)
+        stamps = self.storage.get_collection_timestamps(_UID)
+        self.assertEquals(stamps, {'col1': now})
+        self.assertEquals(self.storage.get_items(_UID, 'tabs'), [])
+        self.assertEquals(len(self.storage.get_items(2, 'tabs')), 1)
+        self.assertEquals(self.storage.cache._pending_flushes, set())
+
     def test_get_max_timestamp_of_empty_collection(self):
         if not self._is_up():
             return
@@ -408,7 +652,7 @@ class TestMemcachedSQLStorage(unittest.TestCase):
                           payload_size)
 
         # Adjust the cache to pretend that hasn't been recalculated lately.
-        last_recalc_key = str(_UID) + ":size:ts"
+        last_recalc_key = storage.cache.user_key(_UID, "size", "ts")
         last_recalc = storage.cache.get(last_recalc_key)
         last_recalc -= QUOTA_RECALCULATION_PERIOD + 1
         storage.cache.set(last_recalc_key, last_recalc)
@@ -424,7 +668,8 @@ class TestMemcachedSQLStorage(unittest.TestCase):
 # This tests the MirroredCacheManager functionality by double-writing to
 # the same memcache instance.  It's much easier than arranging for two
 # memcache servers to be present, but it means that sizes can get incremeted
-# twice.  So we have to disable a couple of tests.
+# twice.  So we have to disable a couple of tests.  The mirror writes are
+# done synchronously, otherwise they would race with the primary ones.
 
 class TestMirroredMemcachedSQLStorage(TestMemcachedSQLStorage):
 
@@ -432,8 +677,10 @@ class TestMirroredMemcachedSQLStorage(TestMemcachedSQLStorage):
         'use_quota': True,
         'quota_size': 5120,
         'create_tables': True,
+        'cached_collections': 'crypto,clients',
         'cache_servers': ['localhost:11211'],
         'mirrored_cache_servers': ['localhost:11211'],
+        'mirror_async': False,
     }
 
     def test_meta_global(self):
@@ -443,10 +690,51 @@ class TestMirroredMemcachedSQLStorage(TestMemcachedSQLStorage):
         pass
 
 
+class TestAsyncWriter(unittest.TestCase):
+
+    def setUp(self):
+        if not MEMCACHED:
+            raise SkipTest
+
+    def test_writes_are_done_in_order(self):
+        writer = AsyncWriter('test')
+        done = []
+        for num in range(10):
+            writer.submit(done.append, num)
+        writer.join()
+        self.assertEquals(done, range(10))
+        self.assertEquals(writer.dropped, 0)
+
+    def test_writes_are_dropped(self):
+        writer = AsyncWriter('test', queue_size=1, timeout=0.1)
+        done = []
+
+        # block the writer, so that the queue fills up.
+        writer.submit(time.sleep, 0.3)
+        time.sleep(0.1)
+        writer.submit(done.append, 1)
+        writer.submit(done.append, 2)
+        writer.join()
+
+        # the first one was too old when it got out of the queue,
+        # the second one did not fit in it.
+        self.assertEquals(done, [])
+        self.assertEquals(writer.dropped, 2)
+
+    def test_stop(self):
+        writer = AsyncWriter('test')
+        done = []
+        writer.submit(done.append, 1)
+        writer.stop()
+        self.assertEquals(done, [1])
+        self.assertFalse(writer._thread.isAlive())
+
+
 def test_suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestMemcachedSQLStorage))
     suite.addTest(unittest.makeSuite(TestMirroredMemcachedSQLStorage))
+    suite.addTest(unittest.makeSuite(TestAsyncWriter))
     return suite
 
 if __name__ == "__main__":
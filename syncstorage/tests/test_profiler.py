@@ -0,0 +1,130 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from syncstorage.profiler import SamplingProfiler
+
+
+def _busy_app(environ, start_response):
+    deadline = time.time() + 0.05
+    while time.time() < deadline:
+        pass
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['ok']
+
+
+def _request(path, method='GET'):
+    return {'REQUEST_METHOD': method, 'PATH_INFO': path}
+
+
+class TestSamplingProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _read_profiles(self):
+        res = {}
+        for name in os.listdir(self.output_dir):
+            endpoint = name.split('-', 2)[-1][:-len('.folded')]
+            with open(os.path.join(self.output_dir, name)) as f:
+                res[endpoint] = f.read()
+        return res
+
+    def test_sampling(self):
+        profiler = SamplingProfiler(_busy_app, self.output_dir,
+                                    sample_rate=0, users=['bob'])
+        start_response = lambda *args: None
+        self.assertEquals(profiler(_request('/1.1/alice/info/collections'),
+                                   start_response), ['ok'])
+        profiler(_request('/1.1/bob/storage/history'), start_response)
+        profiler.flush()
+        profiles = self._read_profiles()
+        self.assertEquals(profiles.keys(), ['GET_get_collection'])
+
+        # each line is a stack of the app, and the number of samples.
+        for line in profiles['GET_get_collection'].splitlines():
+            stack, count = line.rsplit(' ', 1)
+            self.assertTrue(stack.startswith('_busy_app '))
+            self.assertTrue(int(count) > 0)
+
+        # one in sample_rate requests is sampled, whatever the user.
+        profiler.configure(sample_rate=2)
+        for i in range(4):
+            profiler(_request('/1.1/alice/storage/tabs', 'DELETE'),
+                     start_response)
+        profiler.flush()
+        self.assertTrue('DELETE_delete_collection' in self._read_profiles())
+
+    def test_rotation_and_control_file(self):
+        control_file = os.path.join(self.output_dir, 'control.conf')
+        profiler = SamplingProfiler(_busy_app, self.output_dir,
+                                    max_files=2, control_file=control_file)
+        start_response = lambda *args: None
+        with open(control_file, 'w') as f:
+            f.write('[profiler]\nendpoints = GET get_collections\n')
+
+        for i in range(3):
+            profiler(_request('/1.1/bob/info/collections'), start_response)
+            profiler.flush()
+            time.sleep(0.01)
+        profiles = [name for name in os.listdir(self.output_dir)
+                    if name.endswith('.folded')]
+        self.assertEquals(len(profiles), 2)
+        self.assertEquals(profiler.endpoints, set(['GET get_collections']))
+
+        # at least one file is kept.
+        self.assertRaises(ValueError, SamplingProfiler, _busy_app,
+                          self.output_dir, max_files=0)
+
+    def test_flush_after_last_request(self):
+        # the stacks are written once flush_interval is over, even though
+        # no request is being sampled anymore.
+        profiler = SamplingProfiler(_busy_app, self.output_dir,
+                                    users=['bob'], flush_interval=0.2)
+        profiler(_request('/1.1/bob/storage/history'), lambda *args: None)
+        self.assertEquals(self._read_profiles(), {})
+        deadline = time.time() + 2
+        while profiler._thread is not None and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEquals(self._read_profiles().keys(),
+                          ['GET_get_collection'])
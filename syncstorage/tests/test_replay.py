@@ -0,0 +1,116 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import time
+import threading
+import unittest
+
+from syncstorage.scripts import replay
+
+
+class RecordingTarget(object):
+    """Records the time at which each request is sent."""
+
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send(self, method, path, headers, body):
+        with self._lock:
+            self.sent.append((time.time(), method, path))
+        time.sleep(self.delay)
+        return 200
+
+
+def _trace(count, interval):
+    path = '/1.1/cuser1/info/collections'
+    return [{'time': index * interval, 'method': 'GET', 'user': 'cuser1',
+             'path': path} for index in range(count)]
+
+
+class TestReplay(unittest.TestCase):
+
+    def test_percentile(self):
+        samples = range(101)
+        self.assertEquals(replay._percentile(samples, 0), 0)
+        self.assertEquals(replay._percentile(samples, 0.5), 50)
+        self.assertEquals(replay._percentile(samples, 0.99), 99)
+        self.assertEquals(replay._percentile(samples, 1), 100)
+        self.assertEquals(replay._percentile([4], 0.99), 4)
+        self.assertEquals(replay._percentile([1, 2, 3, 4], 0.5), 3)
+
+    def test_open_loop(self):
+        # the requests are sent at their due time, even though the previous
+        # ones have not completed yet.
+        target = RecordingTarget(delay=0.3)
+        replayer = replay.Replayer(target, workers=5)
+        start = time.time()
+        duration = replayer.run(_trace(5, 0.05))
+        self.assertEquals(len(target.sent), 5)
+        for index, (sent, method, path) in enumerate(sorted(target.sent)):
+            self.assertTrue(abs(sent - start - index * 0.05) < 0.1)
+        self.assertTrue(duration < 0.3 + 4 * 0.05 + 0.2)
+
+        # the speed and the rate scale the schedule.
+        target = RecordingTarget()
+        replay.Replayer(target, workers=2).run(_trace(3, 0.2), speed=2)
+        sent = sorted(item[0] for item in target.sent)
+        self.assertTrue(abs(sent[2] - sent[0] - 0.2) < 0.08)
+        target = RecordingTarget()
+        replay.Replayer(target, workers=2).run(_trace(3, 1), rate=20)
+        sent = sorted(item[0] for item in target.sent)
+        self.assertTrue(abs(sent[2] - sent[0] - 0.1) < 0.08)
+
+    def test_latency_includes_queueing(self):
+        # with a single worker, the requests wait for the previous ones, and
+        # their latency is measured from their due time.
+        target = RecordingTarget(delay=0.1)
+        replayer = replay.Replayer(target, workers=1)
+        replayer.run(_trace(4, 0))
+        stats = replayer.report()['GET get_collections']
+        self.assertEquals(stats['count'], 4)
+        self.assertEquals(stats['errors'], 0)
+        self.assertTrue(stats['p99'] >= 0.35)
+        self.assertTrue(stats['service_p99'] < 0.2)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestReplay))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="test_suite")
@@ -0,0 +1,94 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+import os
+import unittest
+from tempfile import mkstemp
+
+from syncstorage import requeststats
+from syncstorage.requeststats import RequestStats
+from syncstorage.storage.sql import SQLStorage
+from syncstorage.tests.support import assert_query_budget
+
+_UID = 1
+
+
+class TestRequestStats(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.dbfile = mkstemp()
+        os.close(fd)
+        self.storage = SQLStorage('sqlite:///%s' % self.dbfile,
+                                  create_tables=True, fixed_collections=True)
+        self.storage.set_user(_UID, email='tarek@ziade.org')
+
+    def tearDown(self):
+        os.remove(self.dbfile)
+
+    def test_sql_accounting(self):
+        storage = self.storage
+        items = [{'id': str(i), 'payload': 'x'} for i in range(5)]
+        storage.set_items(_UID, 'bookmarks', items)
+
+        # nothing is counted outside of a request.
+        self.assertEquals(requeststats.current(), None)
+        storage.get_collection_timestamps(_UID)
+
+        with requeststats.collect() as stats:
+            self.assertTrue(requeststats.current() is stats)
+            self.assertEquals(len(list(storage.get_items(_UID, 'bookmarks',
+                                                         None))), 5)
+            storage.get_item(_UID, 'bookmarks', '1')
+        self.assertEquals(requeststats.current(), None)
+        self.assertEquals(stats.sql_statements, 2)
+        self.assertEquals(stats.rows, 6)
+        self.assertTrue(stats.sql_time > 0)
+        self.assertEquals(stats.cache_calls, 0)
+
+        # the stats go through the X-Debug-* headers.
+        headers = dict(stats.headers())
+        self.assertEquals(headers['X-Debug-SQL-Statements'], '2')
+        copy = RequestStats.from_headers(headers)
+        self.assertEquals(copy.rows, 6)
+        self.assertAlmostEquals(copy.sql_time, stats.sql_time, places=5)
+
+    def test_query_budget(self):
+        storage = self.storage
+        with requeststats.collect() as stats:
+            for i in range(3):
+                storage.get_item(_UID, 'bookmarks', str(i))
+        assert_query_budget(stats, sql_statements=3, cache_calls=0)
+        self.assertRaises(AssertionError, assert_query_budget, stats,
+                          sql_statements=1)
@@ -38,6 +38,10 @@ import unittest
 import os
 import time
 import threading
+import sqlite3
+from tempfile import mkstemp
+
+from sqlalchemy.pool import QueuePool
 
 from syncstorage.tests.support import initenv, cleanupenv
 from syncstorage.storage.sqlmappers import get_wbo_table_name
@@ -51,6 +55,7 @@ SyncStorage.register(SQLStorage)
 from services.auth import ServicesAuth
 from services.auth.sql import SQLAuth
 from services.util import BackendError
+from syncstorage.storage.breaker import CircuitOpenError
 ServicesAuth.register(SQLAuth)
 
 _UID = 1
@@ -389,6 +394,56 @@ class TestSQLStorage(unittest.TestCase):
         self.assertEquals(len(connections), 3)
         self.assertEquals(len(errors), 3)
 
+    def test_breaker(self):
+        storage = SQLStorage('sqlite:////no/such/directory/test.db',
+                             breaker_max_failures=2)
+        self.assertRaises(BackendError, storage.user_exists, _UID)
+        self.assertRaises(BackendError, storage.user_exists, _UID)
+
+        # the database is not even tried anymore.
+        self.assertEquals(storage.breaker.state, 'open')
+        self.assertRaises(CircuitOpenError, storage.user_exists, _UID)
+
+    def test_shared_pool_switch_db(self):
+        fd, dbfile = mkstemp()
+        os.close(fd)
+        self._add_cleanup(os.remove, dbfile)
+        storage = SQLStorage('sqlite:///' + dbfile, use_shared_pool=True)
+
+        # sqlite has no "use" statement, so the connections of the pool
+        # count them instead of running them.
+        uses = []
+
+        class Cursor(sqlite3.Cursor):
+            def execute(self, statement, *args):
+                if statement.startswith('use '):
+                    uses.append(statement)
+                    return self
+                return sqlite3.Cursor.execute(self, statement, *args)
+
+        class Connection(sqlite3.Connection):
+            def cursor(self, factory=Cursor):
+                return sqlite3.Connection.cursor(self, factory)
+
+        def connect():
+            return sqlite3.connect(dbfile, factory=Connection)
+
+        storage._engine.pool = QueuePool(connect, pool_size=1)
+
+        # the database is only switched on the first checkout.
+        for i in range(5):
+            res = storage._engine.execute('select 1')
+            self.assertEqual(res.fetchall(), [(1,)])
+        self.assertEqual(uses, ['use %s' % dbfile])
+
+        # a new connection gets switched again.
+        connection = storage._engine.connect()
+        connection.invalidate()
+        connection.close()
+        for i in range(5):
+            storage._engine.execute('select 1').close()
+        self.assertEqual(uses, ['use %s' % dbfile] * 2)
+
 
 def test_suite():
     suite = unittest.TestSuite()
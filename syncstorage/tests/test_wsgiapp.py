@@ -36,13 +36,18 @@
 # ***** END LICENSE BLOCK *****
 import unittest
 import os
+import time
 
 from webtest import TestApp
+from nose import SkipTest
+
+from services.util import BackendError
 
 from syncstorage import wsgiapp
 
 # This establishes the MOZSVC_UUID environment variable.
 import syncstorage.tests.support  # NOQA
+from syncstorage.tests.support import assert_query_budget
 
 
 class FakeMemcacheClient(object):
@@ -84,6 +89,30 @@ class TestWSGIApp(unittest.TestCase):
         sqluri = self.app.get_storage(request).sqluri
         assert sqluri.startswith("sqlite:////tmp/test-storage-host2")
 
+    def test_lazy_host_storages(self):
+        storages = self.app.storages
+        self.assertEquals(storages.loaded(), ['default'])
+        self.assertTrue("some-test-host" in storages)
+        self.assertFalse("unknown-host" in storages)
+        self.assertEquals(storages.get("unknown-host"), None)
+
+        # the storage is built on first use, and then reused.
+        storage = storages["some-test-host"]
+        self.assertTrue("some-test-host" in storages.loaded())
+        self.assertTrue(storages["some-test-host"] is storage)
+
+        # idle storages are closed, then rebuilt when needed.
+        closed = []
+        storage.close = lambda: closed.append(True)
+        storages.idle_timeout = 0.1
+        storages["some-test-host"]
+        time.sleep(0.2)
+        storages["another-test-host"]
+        self.assertFalse("some-test-host" in storages.loaded())
+        self.assertEquals(closed, [True])
+        self.assertTrue("default" in storages.loaded())
+        self.assertFalse(storages["some-test-host"] is storage)
+
     def test_dependant_options(self):
         config = dict(self.app.config)
         config['storage.check_node_status'] = True
@@ -96,6 +125,13 @@ class TestWSGIApp(unittest.TestCase):
         finally:
             wsgiapp.Client = old_client
 
+    def test_boolean_options(self):
+        config = dict(self.app.config)
+        config['storage.fast_path'] = 'false'
+        self.assertFalse(wsgiapp.make_app(config).app.fast_path)
+        config['storage.fast_path'] = 'true'
+        self.assertTrue(wsgiapp.make_app(config).app.fast_path)
+
     def test_checking_node_status_in_memcache(self):
         app = self.app
         app.cache = FakeMemcacheClient()
@@ -148,3 +184,143 @@ class TestWSGIApp(unittest.TestCase):
                            headers={"Host": "another-test-host"},
                            status=200)
         self.assertTrue("X-Weave-Backoff" not in r.headers)
+
+    def test_database_breaker(self):
+        testclient = TestApp(self.app, extra_environ={
+            "HTTP_HOST": "some-test-host",
+        })
+
+        class request:
+            host = "some-test-host"
+
+        # After a few errors, the node fails fast with a 503.
+        breaker = self.app.get_storage(request).breaker
+        for i in range(breaker.max_failures):
+            breaker.failure()
+        r = testclient.get("/__heartbeat__", status=503)
+        self.assertTrue(int(r.headers["Retry-After"]) > 0)
+        self.assertEquals(r.headers["X-Weave-Backoff"],
+                          r.headers["Retry-After"])
+
+        # The other nodes are not affected.
+        testclient.get("/__heartbeat__",
+                       headers={"Host": "another-test-host"}, status=200)
+
+        # Once the timeout is over, requests go through again, but only
+        # the ones that send a query probe the database.
+        breaker.reset_timeout = 0
+        self.assertEquals(self.app._before_call(request), {})
+        self.assertEquals(breaker._probe, None)
+        testclient.get("/__heartbeat__", status=200)
+
+    def test_fast_path(self):
+        class FakeAuth(object):
+            def check(self, request, match):
+                request.user = {'userid': 1, 'username': match['username']}
+
+        app = self.app
+        app.auth = FakeAuth()
+        app.fast_path = True
+        testclient = TestApp(app, extra_environ={
+            "HTTP_HOST": "some-test-host",
+        })
+        storage = app.storages["some-test-host"]
+
+        testclient.get("/1.0/bob/storage/meta/global", status=404)
+        storage.set_item(1, "meta", "global", payload="v1")
+        r = testclient.get("/1.0/bob/storage/meta/global", status=200)
+        self.assertEquals(r.json["payload"], "v1")
+        self.assertTrue("X-Weave-Timestamp" in r.headers)
+        etag = r.headers["ETag"]
+
+        # The body is reused until the collection changes.
+        r = testclient.get("/1.0/bob/storage/meta/global",
+                           headers={"If-None-Match": etag}, status=304)
+        storage.set_item(1, "meta", "global", payload="v2",
+                         storage_time=time.time() + 1)
+        r = testclient.get("/1.0/bob/storage/meta/global",
+                           headers={"If-None-Match": etag}, status=200)
+        self.assertEquals(r.json["payload"], "v2")
+        self.assertNotEquals(r.headers["ETag"], etag)
+
+        # A write done at the same timestamp is seen too.
+        stamp = r.json["modified"]
+        storage.set_item(1, "meta", "global", payload="v3",
+                         storage_time=stamp)
+        r = testclient.get("/1.0/bob/storage/meta/global", status=200)
+        self.assertEquals(r.json["payload"], "v3")
+        self.assertEquals(r.json["modified"], stamp)
+
+        r = testclient.get("/1.0/bob/info/collections", status=200)
+        self.assertEquals(r.json.keys(), ["meta"])
+        self.assertEquals(r.headers["X-Weave-Records"], "1")
+
+    def test_fast_path_sees_flushes(self):
+        try:
+            from syncstorage.storage.memcachedsql import MemcachedSQLStorage
+        except ImportError:
+            raise SkipTest
+
+        class FakeAuth(object):
+            def check(self, request, match):
+                request.user = {'userid': 1, 'username': match['username']}
+
+        app = self.app
+        app.auth = FakeAuth()
+        app.fast_path = True
+        sqluri = app.storages["some-test-host"].sqluri
+        storage = MemcachedSQLStorage(sqluri, create_tables=True)
+        try:
+            storage.cache.set("test", 1)
+        except BackendError:
+            raise SkipTest
+        app.storages["some-test-host"] = storage
+        testclient = TestApp(app, extra_environ={
+            "HTTP_HOST": "some-test-host",
+        })
+
+        storage.set_item(1, "meta", "global", payload="v1")
+        r = testclient.get("/1.0/bob/storage/meta/global", status=200)
+        self.assertEquals(r.json["payload"], "v1")
+
+        # another process drops the storage of the user.
+        other = MemcachedSQLStorage(sqluri)
+        try:
+            other.delete_storage(1)
+        finally:
+            other.close()
+        testclient.get("/1.0/bob/storage/meta/global", status=404)
+        r = testclient.get("/1.0/bob/info/collections", status=200)
+        self.assertEquals(r.json, {})
+
+    def test_debug_headers(self):
+        class FakeAuth(object):
+            def check(self, request, match):
+                request.user = {'userid': 1, 'username': match['username']}
+
+        app = self.app
+        app.auth = FakeAuth()
+        app.debug_token = "secret"
+        testclient = TestApp(app, extra_environ={
+            "HTTP_HOST": "some-test-host",
+        })
+        storage = app.storages["some-test-host"]
+        storage.set_items(1, "bookmarks",
+                          [{"id": str(i), "payload": "x"} for i in range(10)])
+        storage.set_item(1, "meta", "global", payload="v1")
+
+        # The stats are only sent to the clients giving the token.
+        r = testclient.get("/1.0/bob/info/collections")
+        self.assertTrue("X-Debug-SQL-Statements" not in r.headers)
+        r = testclient.get("/1.0/bob/info/collections",
+                           headers={"X-Debug-Token": "wrong"})
+        self.assertTrue("X-Debug-SQL-Statements" not in r.headers)
+
+        # The number of queries doesn't grow with the number of items.
+        budgets = [("/1.0/bob/info/collections", 2),
+                   ("/1.0/bob/storage/bookmarks?full=1", 3),
+                   ("/1.0/bob/storage/meta/global", 2)]
+        for url, budget in budgets:
+            r = testclient.get(url, headers={"X-Debug-Token": "secret"})
+            assert_query_budget(r, sql_statements=budget)
+        self.assertEquals(r.headers["X-Debug-Rows"], "1")
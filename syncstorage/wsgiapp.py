@@ -36,12 +36,28 @@
 """
 Application entry point.
 """
-from webob.exc import HTTPServiceUnavailable
+import math
+import time
+import threading
+from hashlib import md5
+
+from paste.deploy.converters import asbool
+from webob import Request, Response
+from webob.exc import (HTTPServiceUnavailable, HTTPNotModified, HTTPNotFound,
+                       HTTPException)
 
 from services.baseapp import set_app, SyncServerApp
+from services.events import REQUEST_STARTS, REQUEST_ENDS, notify
 from services.wsgiauth import Authentication
-from syncstorage.controller import StorageController
+from services.util import round_time, BackendError
+from services.formatters import json_response
+from syncstorage import requeststats
+from syncstorage.authcache import CachingAuthBackend
+from syncstorage.controller import StorageController, _WBO_FIELDS
+from syncstorage.dispatch import Dispatcher
 from syncstorage.storage import get_storage
+from syncstorage.storage.breaker import OPEN
+from syncstorage.storage.localcachedsql import LRUCache
 
 try:
     from pylibmc import Client
@@ -94,6 +110,96 @@ urls = [('GET', _url('/_API_/_USERNAME_/info/collections'),
 controllers = {'storage': StorageController}
 
 
+class HostStorages(object):
+    """Mapping of the hosted nodes to their storage backends.
+
+    The backend of a node is only built when it is first looked up, so that
+    the startup time and memory of a worker don't grow with the number of
+    nodes in the config.  Lookups are thread-safe.
+
+    If idle_timeout is given, backends that have not been looked up for
+    that many seconds are closed, and rebuilt on their next lookup.
+    Iterating over the mapping builds all the backends.
+    """
+
+    def __init__(self, factory, hostnames, default, idle_timeout=None):
+        self._factory = factory
+        self._hostnames = set(hostnames)
+        self._hostnames.add('default')
+        self._storages = {'default': default}
+        self._last_used = {}
+        self._lock = threading.Lock()
+        self.idle_timeout = idle_timeout
+        self._next_eviction = 0
+
+    def __contains__(self, hostname):
+        return hostname in self._hostnames
+
+    def __len__(self):
+        return len(self._hostnames)
+
+    def __iter__(self):
+        return iter(list(self._hostnames))
+
+    def __getitem__(self, hostname):
+        storage = self._storages.get(hostname)
+        if storage is None:
+            if hostname not in self._hostnames:
+                raise KeyError(hostname)
+            with self._lock:
+                storage = self._storages.get(hostname)
+                if storage is None:
+                    storage = self._factory(hostname)
+                    self._storages[hostname] = storage
+        if self.idle_timeout:
+            now = time.time()
+            self._last_used[hostname] = now
+            if now >= self._next_eviction:
+                self._evict_idle(now)
+        return storage
+
+    def __setitem__(self, hostname, storage):
+        with self._lock:
+            self._hostnames.add(hostname)
+            self._storages[hostname] = storage
+
+    def get(self, hostname, default=None):
+        try:
+            return self[hostname]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        for hostname in self:
+            yield hostname, self[hostname]
+
+    def itervalues(self):
+        for hostname, storage in self.iteritems():
+            yield storage
+
+    def loaded(self):
+        """Returns the hostnames whose backend is currently built."""
+        return self._storages.keys()
+
+    def _evict_idle(self, now):
+        with self._lock:
+            if now < self._next_eviction:
+                return
+            self._next_eviction = now + self.idle_timeout
+            for hostname, last_used in self._last_used.items():
+                if hostname == 'default':
+                    continue
+                if now - last_used > self.idle_timeout:
+                    del self._last_used[hostname]
+                    storage = self._storages.pop(hostname, None)
+                    close = getattr(storage, 'close', None)
+                    if close is not None:
+                        close()
+
+
 class StorageServerApp(SyncServerApp):
     """Storage application"""
     def __init__(self, urls, controllers, config=None,
@@ -102,8 +208,21 @@ class StorageServerApp(SyncServerApp):
                                                auth_class)
         self.config = config
 
-        # Collecting the host-specific config and building connectors.
-        self.storages = {'default': get_storage(config)}
+        # The successful authentications can be cached for a few seconds,
+        # to save a lookup and a password check on each request.
+        auth_cache_ttl = int(config.get('auth.cache_ttl', 0))
+        if auth_cache_ttl > 0 and self.auth is not None:
+            auth_cache_size = int(config.get('auth.cache_size', 10000))
+            self.auth.backend = CachingAuthBackend(self.auth.backend,
+                                                   ttl=auth_cache_ttl,
+                                                   max_size=auth_cache_size)
+
+        # The urls are matched by a precompiled dispatch table rather
+        # than by walking the Routes mapper.
+        self.mapper = Dispatcher(urls)
+
+        # Collecting the host-specific config.  The connectors are only
+        # built when a host gets its first request.
         hostnames = set()
         host_token = 'host:'
         for cfgkey in config:
@@ -114,9 +233,14 @@ class StorageServerApp(SyncServerApp):
                 # E.g: "host:localhost.storage.sqluri" => "localhost"
                 hostname = cfgkey[len(host_token):].rsplit(".", 2)[0]
                 hostnames.add(hostname)
-        for hostname in hostnames:
-            host_cfg = self._host_specific(hostname, config)
-            self.storages[hostname] = get_storage(host_cfg)
+
+        def build_storage(hostname):
+            return get_storage(self._host_specific(hostname, config))
+
+        idle_timeout = int(config.get('storage.host_idle_timeout', 0))
+        self.storages = HostStorages(build_storage, hostnames,
+                                     get_storage(config),
+                                     idle_timeout=idle_timeout)
 
         # If we need to check node status, then we need to
         # obtain a memcache client object.
@@ -131,6 +255,121 @@ class StorageServerApp(SyncServerApp):
                                       '127.0.0.1:11211')
             self.cache = Client(servers.split(','))
 
+        # The most frequent requests can skip most of the stack, and reuse
+        # the bodies they last sent.  The bodies are kept along with the
+        # data they were built from, i.e. the collection timestamps or the
+        # meta/global item.
+        self.fast_path = asbool(self.config.get('storage.fast_path', False))
+        cache_size = self.config.get('storage.fast_path_cache_size', 10000)
+        self._fast_path_cache = LRUCache(max_size=int(cache_size))
+
+        # The storage calls of each request are counted, and sent back as
+        # X-Debug-* headers to the clients giving this token.
+        debug_token = self.config.get('storage.debug_token')
+        self.debug_token = debug_token and str(debug_token) or None
+
+    def __call__(self, environ, start_response):
+        stats = requeststats.start()
+        try:
+            if (self.debug_token is not None and
+                environ.get('HTTP_X_DEBUG_TOKEN') == self.debug_token):
+                start_response = self._debug_start_response(start_response,
+                                                             stats)
+            return self._call(environ, start_response)
+        finally:
+            requeststats.stop()
+
+    def _debug_start_response(self, start_response, stats):
+        """Adds the stats of the request to its response headers."""
+        def _start_response(status, headers, exc_info=None):
+            headers = list(headers) + stats.headers()
+            return start_response(status, headers, exc_info)
+        return _start_response
+
+    def _call(self, environ, start_response):
+        if self.fast_path and environ.get('REQUEST_METHOD') == 'GET':
+            response = self._fast_path(environ)
+            if response is not None:
+                return response(environ, start_response)
+        return super(StorageServerApp, self).__call__(environ, start_response)
+
+    def _fast_path(self, environ):
+        """Serves info/collections and meta/global.
+
+        Returns None if the request has to go through the full stack.
+        """
+        path = environ.get('PATH_INFO', '').rstrip('/')
+        match = self.mapper.match('GET', path)
+        if match is None:
+            return None
+        match = match[0]
+        action = match['action']
+        if action == 'get_collections':
+            # other formats are left to convert_response()
+            accept = environ.get('HTTP_ACCEPT', '')
+            if 'newlines' in accept or 'whoisi' in accept:
+                return None
+        elif action != 'get_item' or match['collection'] != 'meta' or \
+                match['item'] != 'global':
+            return None
+
+        request = Request(environ)
+        server_time = round_time()
+        # the request events are sent like for the other requests, so
+        # that the per-request state of the storages gets cleaned up.
+        response = None
+        notify(REQUEST_STARTS, request)
+        try:
+            try:
+                if self.auth is not None:
+                    self.auth.check(request, match)
+                headers = self._before_call(request)
+                response = self._fast_path_response(request, action)
+            except HTTPException, response:
+                headers = {}
+            except BackendError:
+                headers = {'Retry-After': str(self.retry_after)}
+                response = HTTPServiceUnavailable(headers=headers)
+            response.headers['X-Weave-Timestamp'] = str(server_time)
+            response.headers.update(headers)
+            return response
+        finally:
+            notify(REQUEST_ENDS, response)
+
+    def _fast_path_response(self, request, action):
+        user_id = request.user['userid']
+        storage = self.get_storage(request)
+        key = request.host, user_id, action
+        # The timestamps can't tell apart two writes done at the same
+        # time, so meta/global is checked against the item itself.
+        if action == 'get_collections':
+            version = storage.get_collection_timestamps(user_id)
+        else:
+            version = storage.get_item(user_id, 'meta', 'global',
+                                       fields=_WBO_FIELDS)
+            if version is None:
+                raise HTTPNotFound()
+
+        cached = self._fast_path_cache.get(key)
+        if cached is None or cached[0] != version:
+            response = json_response(version)
+            if action == 'get_collections':
+                response.headers['X-Weave-Records'] = str(len(version))
+            etag = md5(response.body).hexdigest()
+            cached = (version, response.body, response.content_type,
+                      response.headers.get('X-Weave-Records'), etag)
+            self._fast_path_cache.set(key, cached)
+
+        version, body, content_type, records, etag = cached
+        if etag in request.if_none_match:
+            response = HTTPNotModified()
+        else:
+            response = Response(body, content_type=content_type)
+        response.headers['ETag'] = '"%s"' % etag
+        if records is not None:
+            response.headers['X-Weave-Records'] = records
+        return response
+
     def get_storage(self, request):
         host = request.host
         if host not in self.storages:
@@ -201,6 +440,19 @@ class StorageServerApp(SyncServerApp):
                         backoff = str(self.retry_after)
                     headers["X-Weave-Backoff"] = backoff
 
+        # If the database of the node has been failing, don't wait for
+        # yet another timeout and send a 503 right away.  Once the breaker
+        # is half-open the request goes through: the probe is only claimed
+        # by the first one that actually sends a query, so that requests
+        # served without the database don't lock out the others.
+        breaker = getattr(self.get_storage(request), 'breaker', None)
+        if breaker is not None and breaker.state == OPEN:
+            retry_after = str(int(math.ceil(breaker.retry_after())) or 1)
+            headers["Retry-After"] = retry_after
+            headers["X-Weave-Backoff"] = retry_after
+            raise HTTPServiceUnavailable(headers=headers,
+                        body_template="server issue: database is unavailable")
+
         return headers
 
     def _debug_server(self, request):
@@ -213,7 +465,7 @@ class StorageServerApp(SyncServerApp):
             res.append('- memcached servers: %s</li>' %
                        ', '.join(cache_servers))
 
-        if storage.get_name() in ('sql', 'memcached'):
+        if storage.get_name() in ('sql', 'memcached', 'localcached'):
             res.append('- sqluri: %s' % storage.sqluri)
         return res
 